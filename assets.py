@@ -0,0 +1,136 @@
+'''
+Self-hosted, bundled and fingerprinted CSS/JS
+Bootstrap, jQuery and Popper used to come from three CDNs on every page. The build bundles them
+(checked against their subresource integrity hashes) with our own CSS into one CSS and one JS
+file, names each after a hash of its contents, writes gzip and brotli copies next to it and
+records the names in a manifest. A file's name changes whenever its contents do, so it can be
+cached for a year
+
+    python assets.py
+
+writes static/dist/ (run it before deploying, app.yaml serves static/dist/ straight from GAE's
+static file servers). Templates get URLs from asset_url() and, until there's a manifest, fall
+back to the CDN tags they always had
+'''
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    #No .br copies then
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DIST_DIR = os.path.join(ROOT, 'static', 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+DIST_URL = '/static/dist/'
+
+#Fingerprinted files never change, so they can be kept for as long as browsers will keep anything
+FAR_FUTURE = 365 * 24 * 3600
+
+#Third party files, pinned by url and subresource integrity hash (what the templates' CDN tags use too)
+VENDOR = {
+    'bootstrap.css': ('https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css',
+                      'sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk'),
+    'jquery.js': ('https://code.jquery.com/jquery-3.5.1.slim.min.js',
+                  'sha384-DfXdz2htPH0lsSSs5nCTpuj/zy4C+OGpamoFVy38MVBnE+IbbVYUew+OrCXaRkfj'),
+    'popper.js': ('https://cdn.jsdelivr.net/npm/popper.js@1.16.0/dist/umd/popper.min.js',
+                  'sha384-Q6E9RHvbIyZFJoft+2mJbHaEWldlvI9IOYy5n3zV9zzTtmI3UksdQRVvoxMfooAo'),
+    'bootstrap.js': ('https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/js/bootstrap.min.js',
+                     'sha384-OgVRvuATP1z7JjHLkuOU7Xw704+h835Lr+6QL9UvYjZE3Ipu6Tp75j7Bh/kR0JKI'),
+}
+
+#What goes into each bundle, in order: VENDOR names or paths under static/
+BUNDLES = {
+    'app.css': ['bootstrap.css', 'css/style.css'],
+    'app.js': ['jquery.js', 'popper.js', 'bootstrap.js'],
+}
+
+_manifest = None
+
+
+def integrity(data):
+    return 'sha384-' + base64.b64encode(hashlib.sha384(data).digest()).decode('ascii')
+
+
+def fetch_vendor(name):
+    url, expected = VENDOR[name]
+    with urllib.request.urlopen(url, timeout=30) as response:
+        data = response.read()
+    if integrity(data) != expected:
+        raise ValueError('{} from {} does not match its integrity hash'.format(name, url))
+    return data
+
+
+def read_part(part):
+    if part in VENDOR:
+        return fetch_vendor(part)
+    with open(os.path.join(ROOT, 'static', part), 'rb') as source:
+        return source.read()
+
+
+def fingerprinted(name, data):
+    stem, extension = os.path.splitext(name)
+    return '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:12], extension)
+
+
+def write_file(path, data):
+    with open(path, 'wb') as output:
+        output.write(data)
+
+
+def build(dist_dir=DIST_DIR):
+    '''
+    Write every bundle, its compressed copies and the manifest to dist_dir, returns the manifest
+    Old bundles are left for pages still cached with their names, delete them once those have gone
+    '''
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {}
+    for name, parts in sorted(BUNDLES.items()):
+        #Parts go on their own lines, so a script without a trailing newline or semicolon can't run into the next
+        separator = b'\n;\n' if name.endswith('.js') else b'\n'
+        data = separator.join(read_part(part) for part in parts)
+        filename = fingerprinted(name, data)
+        path = os.path.join(dist_dir, filename)
+        write_file(path, data)
+        write_file(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            write_file(path + '.br', brotli.compress(data, quality=11))
+        manifest[name] = filename
+        logging.info('%s -> %s (%d bytes)', name, filename, len(data))
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(path=MANIFEST_PATH):
+    '''
+    {bundle name: fingerprinted file name}, empty when the assets haven't been built
+    '''
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (IOError, ValueError):
+        return {}
+
+
+def asset_url(name):
+    '''
+    The URL of bundle name, or None if it hasn't been built (templates use the CDN tags then)
+    '''
+    global _manifest
+    if _manifest is None:
+        _manifest = load_manifest()
+    filename = _manifest.get(name)
+    return DIST_URL + filename if filename else None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    build()
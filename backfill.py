@@ -0,0 +1,45 @@
+'''
+Put the search fields (name_lower and name_trigrams, see name_search.py, and terms, see
+text_search.py) on messages written before they existed, and the shard field when
+CREATED_SHARDS is set (run it again after changing CREATED_SHARDS)
+Safe to run again, and to run while the app is up: it only touches messages whose
+fields are missing or out of date
+
+    python backfill.py
+
+With --counters it recounts the message counters (counters.py) from the messages instead,
+for a guestbook that had messages before the counters.
+Messages written or deleted while that runs may be miscounted, so run it when it's quiet
+
+    python backfill.py --counters
+
+Uses the same STORAGE_BACKEND and Firestore settings as the app
+'''
+import argparse
+import logging
+
+import storage as storage_module
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill fields and counters for existing messages')
+    parser.add_argument('--counters', action='store_true', help='rebuild the message counters instead')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    storage = storage_module.from_env()
+
+    if args.counters:
+        counted = storage.rebuild_counters(lambda counted: logging.info('%d messages counted', counted))
+        logging.info('Done, counters rebuilt from %d messages', counted)
+        return
+
+    def progress(checked, updated):
+        logging.info('%d messages checked, %d updated', checked, updated)
+
+    updated = storage.backfill_fields(progress)
+    logging.info('Done, %d messages updated', updated)
+
+
+if __name__ == '__main__':
+    main()
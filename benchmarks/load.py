@@ -0,0 +1,348 @@
+'''
+Load test for the guestbook endpoints
+Seeds a number of messages with a realistic (Zipf-like) spread of names, then drives
+/, /?search_str=...&sort_by=..., POST /new_entry.html and the delete_data path at a chosen
+concurrency and reports throughput and p50/p95/p99 latency per endpoint
+
+By default it runs the app in-process through Flask's test client, so it measures the
+app plus whatever STORAGE_BACKEND is set to, with no HTTP server in the way:
+
+    STORAGE_BACKEND=memory python benchmarks/load.py --messages 100000 --concurrency 8 --duration 30
+
+or against a running server (seeding then goes through STORAGE_BACKEND, which must be the
+same Firestore the server uses, or pass --no-seed):
+
+    python benchmarks/load.py --url http://localhost:8080 --no-seed --concurrency 32
+
+--output writes the results as JSON, and --baseline compares against an earlier results
+file and exits with status 1 if any endpoint's p95 got worse by more than --tolerance
+'''
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage as storage_module
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Eve', 'Frank', 'Grace', 'Heidi', 'Ivan', 'Judy', 'Mallory',
+               'Niaj', 'Olivia', 'Peggy', 'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter', 'Yolanda']
+LAST_NAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Robinson', 'Wright',
+              'Thompson', 'Evans', 'Walker', 'White', 'Roberts', 'Green', 'Hall', 'Wood', 'Jackson', 'Clarke']
+WORDS = ['lovely', 'day', 'thanks', 'for', 'having', 'us', 'great', 'party', 'see', 'you', 'soon', 'what', 'a',
+         'fantastic', 'time', 'congratulations', 'best', 'wishes', 'from', 'all', 'of', 'the', 'family']
+
+SORT_BYS = ['created', 'name', 'message']
+DIRECTIONS = ['ASCENDING', 'DESCENDING']
+
+
+class NamePool(object):
+    '''
+    Names drawn with Zipf-like weights, a few people post a lot and most post once or twice
+    '''
+
+    def __init__(self, size=2000, exponent=1.1, seed=1):
+        rng = random.Random(seed)
+        base = ['{} {}'.format(first, last) for first in FIRST_NAMES for last in LAST_NAMES]
+        #Past the plain first/last combinations, number them like the 2nd Alice Smith
+        self.names = [base[i % len(base)] + ('' if i < len(base) else ' {}'.format(i // len(base) + 1))
+                      for i in range(size)]
+        rng.shuffle(self.names)
+        self.weights = [1.0 / (rank ** exponent) for rank in range(1, size + 1)]
+
+    def pick(self, rng, count=1):
+        return rng.choices(self.names, weights=self.weights, k=count)
+
+
+def make_message(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))).capitalize()
+
+
+def seed_messages(storage, count, names, rng, batch_size=500, workers=8):
+    '''
+    Write count messages straight into storage, spread over the last 30 days
+    '''
+    started = time.perf_counter()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    step = datetime.timedelta(days=30) / max(count, 1)
+
+    def make_batch(first, size):
+        picked = names.pick(rng, size)
+        return [(storage.new_id(), {
+            u'name': picked[i],
+            u'message': make_message(rng),
+            u'created': now - step * (count - first - i),
+        }) for i in range(size)]
+
+    if isinstance(storage, storage_module.MemoryStorage):
+        #Memory backend, one big bulk load is much faster than lots of little ones
+        storage.add_messages(make_batch(0, count))
+    else:
+        batch_size = min(batch_size, storage.max_batch_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for first in range(0, count, batch_size):
+                futures.append(executor.submit(storage.add_messages, make_batch(first, min(batch_size, count - first))))
+                if len(futures) >= workers * 4:
+                    futures.pop(0).result()
+            for future in futures:
+                future.result()
+    elapsed = time.perf_counter() - started
+    print('Seeded {} messages in {:.1f}s ({:.0f}/s)'.format(count, elapsed, count / elapsed if elapsed else 0))
+
+
+class InProcessClient(object):
+    '''
+    Requests through Flask's test client, one client (and cookie jar) per thread
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, data=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        return response.status_code
+
+
+class HttpClient(object):
+    '''
+    Requests over HTTP with urllib, redirects are not followed so a POST costs one request
+    '''
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method, path, data=None):
+        opener = getattr(self.local, 'opener', None)
+        if opener is None:
+            opener = self.local.opener = urllib.request.build_opener(
+                self.NoRedirect, urllib.request.HTTPCookieProcessor())
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+
+def make_requests(names):
+    '''
+    Endpoint name -> function(rng) returning (method, path, form data)
+    '''
+    def listing(rng):
+        return 'GET', '/?' + urllib.parse.urlencode({'sort_by': rng.choice(SORT_BYS), 'sort_direction': rng.choice(DIRECTIONS)}), None
+
+    def search(rng):
+        query = {'search_str': names.pick(rng)[0], 'sort_by': rng.choice(SORT_BYS), 'sort_direction': rng.choice(DIRECTIONS)}
+        return 'GET', '/?' + urllib.parse.urlencode(query), None
+
+    def new_entry(rng):
+        form = {'name': names.pick(rng)[0], 'message': make_message(rng), 'sort_by': 'created', 'search_str': '',
+                'sort_direction': 'ASCENDING'}
+        return 'POST', '/new_entry.html', form
+
+    def delete(rng):
+        #Only ever one (unpopular) name at a time, clearing everything would end the test
+        form = {'search_str': rng.choice(names.names[len(names.names) // 2:]), 'delete_data': 'on',
+                'sort_by_select': 'created', 'sort_direction': 'ASCENDING'}
+        return 'POST', '/', form
+
+    return collections.OrderedDict([('index', listing), ('search', search), ('new_entry', new_entry), ('delete', delete)])
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    #Nearest rank
+    rank = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def run_load(client, requests, mix, concurrency, duration, max_requests, seed):
+    '''
+    Fire requests picked by weight from mix from concurrency threads until duration seconds
+    have gone or max_requests have been made, returns {endpoint: (latencies, errors)}
+    '''
+    endpoints = [name for name in requests if mix.get(name)]
+    weights = [mix[name] for name in endpoints]
+    results = dict((name, ([], [0])) for name in endpoints)
+    results_lock = threading.Lock()
+    made = [0]
+    deadline = time.perf_counter() + duration
+
+    def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        while time.perf_counter() < deadline:
+            with results_lock:
+                if max_requests and made[0] >= max_requests:
+                    return
+                made[0] += 1
+            endpoint = rng.choices(endpoints, weights=weights)[0]
+            method, path, data = requests[endpoint](rng)
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, data)
+                failed = status >= 400
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - started
+            with results_lock:
+                results[endpoint][0].append(elapsed)
+                if failed:
+                    results[endpoint][1][0] += 1
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, i) for i in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - started
+
+
+def summarise(results, wall_time):
+    summary = collections.OrderedDict()
+    for endpoint, (latencies, errors) in results.items():
+        ordered = sorted(latencies)
+        summary[endpoint] = collections.OrderedDict([
+            ('requests', len(ordered)),
+            ('errors', errors[0]),
+            ('throughput_rps', len(ordered) / wall_time if wall_time else 0.0),
+            ('mean_ms', 1000 * sum(ordered) / len(ordered) if ordered else None),
+            ('p50_ms', 1000 * percentile(ordered, 0.50) if ordered else None),
+            ('p95_ms', 1000 * percentile(ordered, 0.95) if ordered else None),
+            ('p99_ms', 1000 * percentile(ordered, 0.99) if ordered else None),
+            ('max_ms', 1000 * ordered[-1] if ordered else None),
+        ])
+    return summary
+
+
+def print_summary(summary, wall_time):
+    print('{:<10} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for endpoint, row in summary.items():
+        if not row['requests']:
+            continue
+        print('{:<10} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            endpoint, row['requests'], row['errors'], row['throughput_rps'],
+            row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms']))
+    total = sum(row['requests'] for row in summary.values())
+    print('{} requests in {:.1f}s, {:.1f} req/s overall'.format(total, wall_time, total / wall_time if wall_time else 0))
+
+
+def compare(summary, baseline, tolerance):
+    '''
+    Endpoints whose p95 is more than tolerance (a fraction) worse than in baseline
+    '''
+    regressions = []
+    for endpoint, row in summary.items():
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not before or before.get('p95_ms') is None or row['p95_ms'] is None:
+            continue
+        if row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f}ms -> {:.2f}ms'.format(endpoint, before['p95_ms'], row['p95_ms']))
+    return regressions
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the guestbook endpoints')
+    parser.add_argument('--url', help='base URL of a running server, default is to run the app in-process')
+    parser.add_argument('--messages', type=int, default=10000, help='messages to seed first (1k to 1M)')
+    parser.add_argument('--no-seed', action='store_true', help="don't seed anything")
+    parser.add_argument('--names', type=int, default=2000, help='distinct names to spread the messages over')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run for')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0 means no limit)')
+    parser.add_argument('--mix', default='index=60,search=30,new_entry=9,delete=1',
+                        help='relative weights of the endpoints')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='earlier --output file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown against the baseline')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    names = NamePool(args.names, seed=args.seed)
+
+    if args.url:
+        client = HttpClient(args.url)
+        storage = None if args.no_seed else storage_module.from_env()
+    else:
+        #Every request comes from the same address and would soon be rate limited, which isn't what's being measured
+        os.environ.setdefault('POST_RATE_LIMIT', '0')
+        os.environ.setdefault('CLEAR_RATE_LIMIT', '0')
+        import main as guestbook
+        client = InProcessClient(guestbook.app)
+        storage = guestbook.storage
+    if storage is not None and args.messages:
+        seed_messages(storage, args.messages, names, rng)
+
+    requests = make_requests(names)
+    mix = parse_mix(args.mix)
+    results, wall_time = run_load(client, requests, mix, args.concurrency, args.duration, args.requests, args.seed)
+    summary = summarise(results, wall_time)
+    print_summary(summary, wall_time)
+
+    report = collections.OrderedDict([
+        ('timestamp', datetime.datetime.now(datetime.timezone.utc).isoformat()),
+        ('config', collections.OrderedDict([
+            ('target', args.url or 'in-process'),
+            ('storage_backend', os.getenv('STORAGE_BACKEND', 'firestore')),
+            ('messages', 0 if args.no_seed else args.messages),
+            ('names', args.names),
+            ('concurrency', args.concurrency),
+            ('duration', args.duration),
+            ('mix', mix),
+            ('python', platform.python_version()),
+        ])),
+        ('wall_time_s', wall_time),
+        ('endpoints', summary),
+    ])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print('Results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(summary, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print('Regressions against {}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('No p95 regressions against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Micro-benchmark for the listing's per-row decode: full to_dict() dicts vs projected Message records
+Runs without Firestore. Rows are plain dicts shaped like stored messages, copied with
+copy.deepcopy() the way DocumentSnapshot.to_dict() does, so the numbers cover the Python
+side of decoding (copying and allocation) but not network or protobuf time
+
+    python benchmarks/records.py --rows 100000 --extra-fields 4
+'''
+import argparse
+import copy
+import datetime
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import records
+
+
+class FakeSnapshot(object):
+    '''
+    Just enough of a DocumentSnapshot for records.from_snapshot()
+    '''
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+def make_rows(count, extra_fields, projected):
+    created = datetime.datetime(2020, 7, 16, tzinfo=datetime.timezone.utc)
+    rows = []
+    for i in range(count):
+        data = {
+            u'name': u'Guest {}'.format(i % 500),
+            u'message': u'Lovely wedding, thanks for having us! #{}'.format(i),
+            u'created': created + datetime.timedelta(seconds=i),
+        }
+        if not projected:
+            for field in range(extra_fields):
+                data[u'extra_{}'.format(field)] = {u'note': u'x' * 40, u'tags': [u'a', u'b', u'c']}
+        rows.append(FakeSnapshot(u'doc{:020d}'.format(i), data))
+    return rows
+
+
+def decode_dicts(snapshots):
+    messages = []
+    for message in snapshots:
+        message_dict = message.to_dict()
+        message_dict["id"] = message.id
+        messages.append(message_dict)
+    return messages
+
+
+def decode_records(snapshots):
+    return [records.from_snapshot(message) for message in snapshots]
+
+
+def measure(label, decode, snapshots):
+    gc.collect()
+    started = time.perf_counter()
+    result = decode(snapshots)
+    elapsed = time.perf_counter() - started
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = decode(snapshots)
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = len(snapshots)
+    print('{:<28} {:>8.1f} ms  {:>7.2f} us/row  kept {:>7.1f} MB ({:>5.0f} B/row)  peak {:>7.1f} MB'.format(
+        label, elapsed * 1000, elapsed * 1e6 / rows, kept / 1e6, kept / rows, peak / 1e6))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--extra-fields', type=int, default=4, help='unused fields stored on every document')
+    args = parser.parse_args()
+
+    print('{} rows, {} extra stored fields per document'.format(args.rows, args.extra_fields))
+    measure('to_dict() + id (all fields)', decode_dicts, make_rows(args.rows, args.extra_fields, projected=False))
+    measure('to_dict() + id (projected)', decode_dicts, make_rows(args.rows, args.extra_fields, projected=True))
+    measure('Message (projected)', decode_records, make_rows(args.rows, args.extra_fields, projected=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Cold start profile: import time of main.py and the latency of the first requests
+Starts a fresh interpreter --runs times. Each one imports main.py with -X importtime and
+sends one request (--warmup sends /_ah/warmup first, like GAE does for a new instance), then a
+second one, through Flask's test client. Reports the median of each, and the modules that
+took longest to import in the slowest run
+
+    STORAGE_BACKEND=memory python benchmarks/startup.py --runs 5
+
+Against Firestore (or the emulator) the first request includes making the client and its
+first RPCs, which is what --warmup moves out of the user's way
+'''
+import argparse
+import collections
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+client = main.app.test_client()
+timings = {'import_ms': (imported - started) * 1000}
+if sys.argv[1] == '1':
+    client.get('/_ah/warmup')
+    timings['warmup_ms'] = (time.perf_counter() - imported) * 1000
+for name in ('first_request_ms', 'second_request_ms'):
+    before = time.perf_counter()
+    client.get(sys.argv[2])
+    timings[name] = (time.perf_counter() - before) * 1000
+print(json.dumps(timings))
+'''
+
+
+def parse_importtime(stderr):
+    '''
+    [(cumulative ms, module)] from -X importtime output, module names keep the indent that shows nesting
+    '''
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        modules.append((int(cumulative_us) / 1000.0, module.rstrip()))
+    return modules
+
+
+def run_once(warmup, path):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD, '1' if warmup else '0', path],
+                            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Child failed:\n' + result.stderr[-2000:])
+    return json.loads(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile main.py import time and first request latency')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start')
+    parser.add_argument('--path', default='/', help='path of the first requests')
+    parser.add_argument('--warmup', action='store_true', help='send /_ah/warmup before the first request')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    runs = []
+    slowest = None
+    for _ in range(args.runs):
+        timings, modules = run_once(args.warmup, args.path)
+        runs.append(timings)
+        if slowest is None or timings['import_ms'] > slowest[0]['import_ms']:
+            slowest = (timings, modules)
+
+    medians = collections.OrderedDict((name, statistics.median(run[name] for run in runs)) for name in runs[0])
+    for name, value in medians.items():
+        print('{:<20} {:9.1f} ms'.format(name, value))
+
+    top = sorted(slowest[1], reverse=True)[:args.top]
+    print('\nSlowest imports (cumulative, slowest run):')
+    for cumulative_ms, module in top:
+        print('{:9.1f} ms  {}'.format(cumulative_ms, module))
+
+    if args.output:
+        report = collections.OrderedDict([
+            ('storage_backend', os.getenv('STORAGE_BACKEND', 'firestore')),
+            ('python', platform.python_version()),
+            ('runs', runs),
+            ('median', medians),
+            ('slowest_imports', [{'module': module.strip(), 'cumulative_ms': ms} for ms, module in top]),
+        ])
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
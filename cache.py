@@ -0,0 +1,227 @@
+'''
+Small in-process caches used by main.py
+Everything here is per instance, nothing is shared between GAE instances
+'''
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread safe LRU cache where each entry also expires ttl seconds after it was set
+    Keeps hit/miss counters so we can tell if the cache is earning its keep
+    A max_entries of 0 switches the cache off (every get is a miss and set does nothing)
+    '''
+
+    def __init__(self, max_entries=256, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        #Bumped by every invalidate() so a value read before a write can't be cached after it
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    #Expired, no point keeping it around
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        '''
+        Store value under key
+        Pass the generation seen before building value to skip storing it if an invalidate() happened meanwhile
+        '''
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        '''
+        Remove every entry whose key matches predicate(key), or everything when predicate is None
+        Returns the number of entries removed
+        '''
+        with self._lock:
+            self.generation += 1
+            if predicate is None:
+                keys = list(self._entries)
+            else:
+                keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class FragmentCache(object):
+    '''
+    A thread safe LRU of rendered strings bounded by their total size rather than their number,
+    for pieces of HTML (see message_row() in main.py)
+    Entries never expire, keys have to change whenever what was rendered would (e.g. include an update time)
+    A max_bytes of 0 switches it off
+    '''
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(key, value):
+        #Roughly what an entry holds on to, the string plus the key and dict slot around it
+        return len(value) + 100
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= self._size(key, old)
+            self._entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.bytes -= self._size(old_key, old_value)
+                self.evictions += 1
+
+    def get_or_render(self, key, render):
+        '''
+        The cached string for key, or render() (cached for next time)
+        '''
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls for the same key: the first caller runs the function and
+    everyone who asks for that key while it's still running waits and gets the same result
+    (or the same exception)
+    Nothing is kept once the call finishes, so the next caller after that starts a fresh one
+    '''
+
+    def __init__(self):
+        self.leaders = 0
+        self.collapsed = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, wait=None):
+        '''
+        function() for key, or the result of the call already in flight for key
+        wait, if given, is a context manager the waiting callers wait inside (for timing)
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            if wait is None:
+                flight.done.wait()
+            else:
+                with wait:
+                    flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'collapsed': self.collapsed,
+            }
@@ -0,0 +1,47 @@
+'''
+Sharded counters for the message totals Firestore would otherwise have to count
+There's a counter for all messages, one per name and one per day (UTC) messages were created
+on. Each counter is split over a number of shard documents in the counters collection and
+every change goes to one of them at random, so a busy counter isn't one hot document.
+Reading a counter means reading all its shards, which doesn't depend on how many messages
+there are. Changes go in the same batch as the message writes/deletes they count, so they
+commit (or don't) together
+'''
+import datetime
+import hashlib
+
+TOTAL = u'total'
+
+#Counters one message touches, so a batch of n message writes carries up to n * this many counter writes
+WRITES_PER_MESSAGE = 3
+
+
+def name_counter(name):
+    #Names can have characters document ids can't, so use a hash
+    return u'name-' + hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+
+def day_of(created):
+    if created.tzinfo is not None:
+        created = created.astimezone(datetime.timezone.utc)
+    return created.date()
+
+
+def day_counter(day):
+    return u'day-' + day.isoformat()
+
+
+def tally(messages, sign=1):
+    '''
+    {counter id: change} for adding (sign 1) or removing (sign -1) messages, records.Message-like
+    things with name and created
+    '''
+    changes = {}
+    for message in messages:
+        for counter in (TOTAL, name_counter(message.name), day_counter(day_of(message.created))):
+            changes[counter] = changes.get(counter, 0) + sign
+    return changes
+
+
+def shard_id(counter, shard):
+    return u'{}-{}'.format(counter, shard)
@@ -0,0 +1,114 @@
+'''
+Bulk deletion of Firestore documents
+Pages through document references with a keys only projection and commits bounded
+chunks of deletes concurrently, so deleting any number of documents runs in constant
+memory and never hits the 500 writes per batch limit
+'''
+import concurrent.futures
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import firestore
+
+import retries
+
+#Firestore refuses batches of more than 500 writes
+MAX_BATCH_SIZE = 500
+
+#Errors worth another go, anything else is a real problem
+RETRYABLE_ERRORS = (
+    api_exceptions.Aborted,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+)
+
+#What a delete that has to find its document gets when the document has gone already
+MISSING_ERRORS = (api_exceptions.NotFound, api_exceptions.FailedPrecondition)
+
+
+def iter_snapshot_chunks(query, chunk_size=MAX_BATCH_SIZE, fields=(), keep=None):
+    '''
+    Yield lists of (at most chunk_size) document snapshots matched by query
+    Only document names (plus any extra fields asked for) come back from Firestore and
+    we page with start_after, so we never hold more than one chunk of snapshots
+    keep, if given, is called with each snapshot and only the ones it passes are yielded
+    '''
+    query = query.select([firestore.FieldPath.document_id()] + list(fields)).order_by(firestore.FieldPath.document_id())
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        snapshots = list(page.limit(chunk_size).stream())
+        if not snapshots:
+            return
+        yield [snapshot for snapshot in snapshots if keep is None or keep(snapshot)]
+        if len(snapshots) < chunk_size:
+            return
+        last = snapshots[-1]
+
+
+def commit_deletes(db, snapshots, max_retries=5, base_delay=0.5, extra_writes=None):
+    '''
+    Delete the documents of snapshots in a single batch, retrying transient failures with jittered
+    exponential backoff, and return how many were deleted
+    extra_writes(snapshots, batch), if given, adds more writes that have to commit along with the deletes
+    Each delete only goes through if its document is still there, so when another job got to one
+    first, or a retry follows an attempt that did commit, the batch fails instead of applying
+    extra_writes twice. The documents are then deleted a batch each, leaving out the ones that have gone
+    '''
+    def commit():
+        batch = db.batch()
+        for snapshot in snapshots:
+            batch.delete(snapshot.reference, option=db.write_option(exists=True))
+        if extra_writes is not None:
+            extra_writes(snapshots, batch)
+        batch.commit()
+        return len(snapshots)
+
+    try:
+        return retries.retry_with_backoff(commit, RETRYABLE_ERRORS, max_retries, base_delay, 'Delete chunk')
+    except MISSING_ERRORS:
+        if len(snapshots) == 1:
+            return 0
+    return sum(commit_deletes(db, [snapshot], max_retries, base_delay, extra_writes) for snapshot in snapshots)
+
+
+def delete_query(db, query, chunk_size=MAX_BATCH_SIZE, max_workers=8, max_retries=5, progress=None,
+                 fields=(), keep=None, on_delete=None):
+    '''
+    Delete every document matched by query and return how many went
+    fields and keep are handed to iter_snapshot_chunks() to delete only some of the matches
+    on_delete(snapshots, batch), if given, adds writes to the batch deleting snapshots (the batch
+    has to stay under MAX_BATCH_SIZE writes in all, so pass a smaller chunk_size to leave room),
+    they're only committed along with deletes of documents that were still there
+    Chunks are committed by a pool of max_workers threads with at most 2 * max_workers chunks
+    in flight at once, which is what keeps memory flat
+    progress, if given, is called with the running total after every committed chunk
+    '''
+    chunk_size = max(1, min(chunk_size, MAX_BATCH_SIZE))
+    deleted = 0
+    pending = set()
+
+    def collect(done):
+        nonlocal deleted
+        for future in done:
+            #result() re-raises if the chunk ran out of retries
+            deleted += future.result()
+            if progress is not None:
+                progress(deleted)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for snapshots in iter_snapshot_chunks(query, chunk_size, fields, keep):
+                if not snapshots:
+                    continue
+                if len(pending) >= 2 * max_workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(commit_deletes, db, snapshots, max_retries, extra_writes=on_delete))
+            done, pending = concurrent.futures.wait(pending)
+            collect(done)
+        finally:
+            for future in pending:
+                future.cancel()
+    return deleted
@@ -0,0 +1,70 @@
+'''
+gunicorn settings for serving the guestbook in production (app.yaml's entrypoint uses this)
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Workers are forked before the app is imported (no preload_app), so each worker imports
+main.py itself and builds its own Firestore client and gRPC channel. gRPC channels
+don't survive a fork, so they must never be made in the master and inherited
+Tune it with
+    WEB_CONCURRENCY          worker processes (default 2)
+    GUNICORN_THREADS         threads per worker with the gthread worker (default 8)
+    GUNICORN_WORKER_CLASS    gthread (default), sync or gevent (pip install gevent, best for many /events streams)
+    GUNICORN_CONNECTIONS     most open connections per gevent worker (default 1000)
+    MAX_EVENT_STREAMS        most /events streams per worker (default: half the threads with gthread,
+                             none with sync, 1000 with gevent, none on App Engine standard)
+    PORT                     port to listen on (GAE sets it, default 8080)
+'''
+import os
+
+bind = ':' + os.getenv('PORT', '8080')
+
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS', '1000'))
+
+#See the docstring, every worker has to make its own Firestore client
+preload_app = False
+
+#Long enough for a slow Firestore page read, and for the write-behind queue to flush on shutdown
+timeout = 60
+graceful_timeout = 30
+#Behind GAE's front end, which keeps connections open
+keepalive = 75
+
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def event_streams_limit():
+    '''
+    /events streams a worker can hold and still have threads for pages, each gthread or sync stream
+    keeps a thread for as long as it's open
+    '''
+    if os.getenv('GAE_ENV', '').startswith('standard'):
+        #GAE standard's front end buffers responses, so a stream never reaches the browser
+        return 0
+    if worker_class == 'gevent':
+        return 1000
+    if worker_class == 'gthread':
+        return max(0, threads - max(2, threads // 2))
+    return 0
+
+
+def post_fork(server, worker):
+    #main.py is imported after this (no preload_app), so it sees the limit
+    os.environ.setdefault('MAX_EVENT_STREAMS', str(event_streams_limit()))
+    if worker_class != 'gevent':
+        return
+    #gRPC (under the Firestore client) has to be told about gevent before any channel is made,
+    #and that has to come after patching, which gunicorn otherwise only does later on
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+    except ImportError:
+        #No grpc with the memory backend
+        return
+    grpc_gevent.init_gevent()
@@ -0,0 +1,94 @@
+'''
+HTTP caching and compression for the listing and the JSON API
+Listing responses carry a weak ETag worked out from what's on the page, so a client (or CDN)
+that already has it gets a 304 with no body from If-None-Match. Bodies of text responses
+are compressed with brotli when the client takes it and the brotli package is installed,
+with gzip otherwise. COMPRESS=0 turns the compression off
+'''
+import gzip
+import hashlib
+import json
+import os
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    #gzip only then
+    brotli = None
+
+COMPRESS = os.getenv('COMPRESS', '1') != '0'
+
+#Not worth compressing anything smaller than this
+MIN_COMPRESS_SIZE = 512
+
+COMPRESSIBLE_TYPES = frozenset(['text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'])
+
+
+def make_etag(*parts):
+    '''
+    An ETag value that changes whenever any of parts does, parts have to be json-able (datetimes are fine)
+    '''
+    key = json.dumps(parts, default=str, separators=(',', ':'), sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def is_fresh(etag):
+    '''
+    True if the request's If-None-Match already has etag, so a 304 will do
+    '''
+    return flask.request.if_none_match.contains_weak(etag)
+
+
+def not_modified(etag):
+    response = flask.Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def conditional(response, etag):
+    '''
+    Put etag on response and turn it into a 304 if the client already has it
+    Cache-Control no-cache lets clients and CDNs keep the page but makes them check it's current every time
+    '''
+    response = flask.make_response(response)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(flask.request)
+
+
+def precompressed(path):
+    '''
+    (Content-Encoding, file suffix) of the best precompressed copy of path (path.br, path.gz) the client takes,
+    (None, '') for path itself
+    '''
+    accepted = flask.request.accept_encodings
+    if accepted['br'] and os.path.exists(path + '.br'):
+        return 'br', '.br'
+    if accepted['gzip'] and os.path.exists(path + '.gz'):
+        return 'gzip', '.gz'
+    return None, ''
+
+
+def compress(response):
+    '''
+    after_request hook compressing text bodies for clients that accept it
+    Streamed and file responses, and anything already encoded, are left alone
+    '''
+    if (not COMPRESS or response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+    accepted = flask.request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,162 @@
+'''
+Background jobs for slow admin actions (for now that's just clearing messages)
+Job state is kept by the storage backend (the Firestore 'jobs' collection) so any instance can report on it,
+and a running clear job doubles up as a tombstone that hides the doomed messages
+from listings straight away, long before they're actually deleted
+'''
+import collections
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+import cache
+
+#How often a running job writes its progress (and heartbeat) back to storage
+PROGRESS_INTERVAL = 1.0
+
+#A 'running' job that hasn't had a heartbeat for this long died with its instance,
+#stop honouring its tombstone so the messages it didn't get to come back
+STALE_AFTER = datetime.timedelta(minutes=2)
+
+#Messages named search_str ('' for everybody) created at or before cutoff are hidden
+Tombstone = collections.namedtuple('Tombstone', ['search_str', 'cutoff'])
+
+#Tombstones for jobs started on this instance, these apply before other instances know about them
+_local_tombstones = {}
+_local_lock = threading.Lock()
+
+#Running jobs from every instance, re-read from storage at most every couple of seconds
+_running_cache = cache.LRUCache(1, 2.0)
+
+
+def created_now():
+    '''
+    The current time as new_entry() stores it in 'created'
+    new_entry() writes a naive datetime.now() which Firestore takes to be UTC, so label it the same way
+    '''
+    return datetime.datetime.now().replace(tzinfo=datetime.timezone.utc)
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def is_hidden(message, tombstones):
+    '''
+    True if one of tombstones covers the records.Message message
+    '''
+    for tombstone in tombstones:
+        if tombstone.search_str in ('', message.name) and message.created <= tombstone.cutoff:
+            return True
+    return False
+
+
+def is_stale(job):
+    heartbeat = job.get('heartbeat')
+    if heartbeat is None:
+        return False
+    return utc_now() - heartbeat > STALE_AFTER
+
+
+def start_clear_job(storage, search_str, clear_func, on_finish=None):
+    '''
+    Start clearing search_str's messages ('' for all of them) on a background thread
+    clear_func(search_str, cutoff, progress) does the deleting and returns how many went
+    on_finish(search_str) is called once the job has stopped, whether it worked or not
+    Returns the job id straight away
+    '''
+    job_id = uuid.uuid4().hex
+    cutoff = created_now()
+    storage.save_job(job_id, {
+        u'kind': u'clear',
+        u'search_str': search_str,
+        u'cutoff': cutoff,
+        u'status': u'running',
+        u'deleted': 0,
+        u'started': utc_now(),
+        u'heartbeat': utc_now(),
+        u'finished': None,
+        u'error': None,
+    })
+    with _local_lock:
+        _local_tombstones[job_id] = Tombstone(search_str, cutoff)
+
+    thread = threading.Thread(target=_run_clear_job, args=(storage, job_id, search_str, cutoff, clear_func, on_finish),
+                              name='clear-job-' + job_id, daemon=True)
+    thread.start()
+    return job_id
+
+
+def _run_clear_job(storage, job_id, search_str, cutoff, clear_func, on_finish):
+    last_report = [0.0]
+
+    def progress(deleted):
+        now = time.monotonic()
+        if now - last_report[0] >= PROGRESS_INTERVAL:
+            last_report[0] = now
+            storage.update_job(job_id, {u'deleted': deleted, u'heartbeat': utc_now()})
+
+    try:
+        deleted = clear_func(search_str, cutoff, progress)
+        storage.update_job(job_id, {u'status': u'done', u'deleted': deleted, u'finished': utc_now()})
+    except Exception as error:
+        logging.exception('Clear job %s failed', job_id)
+        storage.update_job(job_id, {u'status': u'failed', u'error': str(error), u'finished': utc_now()})
+    finally:
+        with _local_lock:
+            _local_tombstones.pop(job_id, None)
+        _running_cache.invalidate()
+        if on_finish is not None:
+            on_finish(search_str)
+
+
+def active_tombstones(storage):
+    '''
+    Tombstones for every clear job currently running on any instance
+    '''
+    running = _running_cache.get('running')
+    if running is None:
+        running = {}
+        for job_id, job in storage.running_jobs().items():
+            if not is_stale(job):
+                running[job_id] = Tombstone(job['search_str'], job['cutoff'])
+        _running_cache.set('running', running)
+    with _local_lock:
+        if not _local_tombstones:
+            return list(running.values())
+        merged = dict(running)
+        merged.update(_local_tombstones)
+    return list(merged.values())
+
+
+def get_job_status(storage, job_id, count_remaining=None):
+    '''
+    Report on a job as a dict, or None if there's no such job
+    count_remaining(search_str, cutoff), if given, counts what a running clear job still has to delete
+    '''
+    job = storage.get_job(job_id)
+    if job is None:
+        return None
+    status = job['status']
+    if status == u'running' and is_stale(job):
+        status = u'stalled'
+
+    remaining = 0
+    if status != u'done':
+        remaining = None
+        if count_remaining is not None:
+            remaining = count_remaining(job['search_str'], job['cutoff'])
+
+    return {
+        'id': job_id,
+        'kind': job['kind'],
+        'search_str': job['search_str'],
+        'status': status,
+        'deleted': job['deleted'],
+        'remaining': remaining,
+        'started': job['started'].isoformat() if job.get('started') else None,
+        'finished': job['finished'].isoformat() if job.get('finished') else None,
+        'error': job.get('error'),
+    }
@@ -0,0 +1,158 @@
+'''
+Server-Sent Events feed of messages as they're added and removed
+There's one storage.watch() per instance, started when the first viewer connects, and every
+connected viewer gets a small queue the watch callback fans events out into, filtered by that
+viewer's search. A connection waiting on its queue does no work at all, it only wakes for an
+event or the odd heartbeat, so idle viewers cost a blocked thread each (or a greenlet each under
+gevent, which is the way to have thousands of them, see the README)
+'''
+import json
+import logging
+import queue
+import threading
+
+import name_search
+
+#Sent every this many seconds on a quiet stream so proxies don't time it out and dead clients get noticed
+HEARTBEAT = 15.0
+
+#How long a client waits before reconnecting after the stream drops, in ms
+RETRY = 5000
+
+#Events held for a viewer that isn't keeping up before they're dropped (and told to reload)
+QUEUE_SIZE = 100
+
+_CLOSE = object()
+
+
+def format_event(kind, data):
+    '''
+    One SSE event, data is anything json.dumps() takes (datetimes go out as ISO strings)
+    '''
+    return u'event: {}\ndata: {}\n\n'.format(kind, json.dumps(data, default=lambda value: value.isoformat()))
+
+
+def event_data(kind, value):
+    if kind == 'cleared':
+        return {'search_str': value.search_str, 'cutoff': value.cutoff}
+    return {'id': value.id, 'name': value.name, 'message': value.message, 'created': value.created}
+
+
+class Subscription(object):
+
+    def __init__(self, search_str, search_mode, queue_size):
+        self.search_str = search_str
+        self.search_mode = search_mode
+        self.events = queue.Queue(maxsize=queue_size)
+
+    def wants(self, kind, value):
+        if kind == 'cleared':
+            #A clear of everything, or of a name this viewer's search can show
+            return value.search_str == '' or name_search.matches(value.search_str, self.search_str, self.search_mode)
+        return name_search.matches(value.name, self.search_str, self.search_mode)
+
+
+class LiveFeed(object):
+    '''
+    Fans storage.watch() events out to the connected viewers
+    on_event(kind, value), if given, is also called with every event (main.py uses it to drop
+    cached pages when another instance writes)
+    '''
+
+    def __init__(self, storage, max_subscribers=1000, queue_size=QUEUE_SIZE, on_event=None):
+        self.storage = storage
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.on_event = on_event
+        self.published = 0
+        self.dropped = 0
+        self._subscriptions = set()
+        self._stop_watch = None
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscriptions), 'published': self.published, 'dropped': self.dropped,
+                    'watching': self._stop_watch is not None}
+
+    def subscribe(self, search_str, search_mode=u'exact'):
+        '''
+        A new Subscription for a viewer, or None if there are already max_subscribers
+        '''
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                return None
+            if self._stop_watch is None:
+                self._stop_watch = self.storage.watch(self._publish)
+            subscription = Subscription(search_str, search_mode, self.queue_size)
+            self._subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def stop(self):
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, set()
+            stop_watch, self._stop_watch = self._stop_watch, None
+        for subscription in subscriptions:
+            self._close(subscription)
+        if stop_watch is not None:
+            stop_watch()
+
+    def _close(self, subscription):
+        #Make room for the close if need be, the viewer reloads after it anyway
+        while True:
+            try:
+                subscription.events.put_nowait(_CLOSE)
+                return
+            except queue.Full:
+                try:
+                    subscription.events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _publish(self, kind, value):
+        if self.on_event is not None:
+            try:
+                self.on_event(kind, value)
+            except Exception:
+                logging.exception('Live feed on_event failed')
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self.published += 1
+        event = None
+        for subscription in subscriptions:
+            if not subscription.wants(kind, value):
+                continue
+            if event is None:
+                event = format_event(kind, event_data(kind, value))
+            try:
+                subscription.events.put_nowait(event)
+            except queue.Full:
+                #Too far behind to catch up, cut it loose and let it reload
+                with self._lock:
+                    self._subscriptions.discard(subscription)
+                    self.dropped += 1
+                self._close(subscription)
+
+    def stream(self, subscription, heartbeat=HEARTBEAT):
+        '''
+        Generator of SSE text for subscription, for a streamed flask.Response
+        Unsubscribes when the client goes away (the generator is closed) or the feed stops
+        '''
+        try:
+            yield u'retry: {}\n\n'.format(RETRY)
+            while True:
+                try:
+                    event = subscription.events.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield u': heartbeat\n\n'
+                    continue
+                if event is _CLOSE:
+                    yield format_event('reload', {})
+                    return
+                yield event
+        finally:
+            self.unsubscribe(subscription)
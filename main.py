@@ -1,88 +1,236 @@
+import atexit
+import base64
+import collections
 import datetime
+import json
 import logging
+import mimetypes
 import os
 import secrets
 import string
-import hashlib
 
-import mock
-from flask import Flask, session, render_template, request, redirect, url_for, send_from_directory
-from google.cloud import firestore
-import google.auth.credentials
-
-try:
-  import googleclouddebugger
-  googleclouddebugger.enable(
-    breakpoint_enable_canary=True
-  )
-except ImportError:
-  pass
+from flask import Flask, session, render_template, request, redirect, url_for, send_from_directory, jsonify, Response, stream_with_context
+from markupsafe import Markup
+
+import assets
+import cache
+import http_caching
+import jobs
+import live_feed as live_feed_module
+import message_view as message_view_module
+import metrics
+import name_search
+import rate_limit
+import records
+import storage as storage_module
+import submissions
+import text_search
+import write_behind
+
+#Cloud Debugger slows down every cold start, so it's only loaded on GAE and only with CLOUD_DEBUGGER=1
+if os.getenv('CLOUD_DEBUGGER', '') == '1' and os.getenv('GAE_ENV', '').startswith('standard'):
+  try:
+    import googleclouddebugger
+    googleclouddebugger.enable(
+      breakpoint_enable_canary=True
+    )
+  except ImportError:
+    pass
 
 
 app = Flask(__name__)
 #create a key for session vars
-app.secret_key = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for i in range(8))
+#Set SECRET_KEY so every instance signs sessions with the same key, otherwise each process makes its own
+app.secret_key = os.getenv('SECRET_KEY') or ''.join(secrets.choice(string.ascii_uppercase + string.digits) for i in range(8))
+
+#Number of messages shown on each page of the listing
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '20'))
+
+#What get_query_data() and validate_vars() hand back (still unpacks like a plain tuple)
+QueryData = collections.namedtuple('QueryData', ['sort_by', 'search_str', 'sort_direction', 'page_token', 'search_mode'])
+
+#Stream index.html out as it renders instead of building the whole page first (STREAM_PAGES=1)
+#Only worth it where responses reach the browser as they're sent, App Engine standard buffers them
+STREAM_PAGES = os.getenv('STREAM_PAGES', '') == '1'
+
+#Rendered listing pages keyed on the QueryData for the page
+#Writes and deletes on this instance invalidate it, the TTL covers writes made by other instances
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '256'))
+PAGE_CACHE_TTL = float(os.getenv('PAGE_CACHE_TTL', '30'))
+page_cache = cache.LRUCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+
+#Rendered listing rows keyed on message id and version (Firestore's update time), so building a page only
+#renders the rows that are new or changed since they were last shown. Bounded by FRAGMENT_CACHE_BYTES, 0 turns it off
+fragment_cache = cache.FragmentCache(int(os.getenv('FRAGMENT_CACHE_BYTES', str(4 * 1024 * 1024))))
+
+#Full text search results keyed on the search's terms, each entry is every match ranked best first
+#so paging through them costs nothing more, it's invalidated along with the page cache
+search_cache = cache.LRUCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+#Most messages a Firestore text search reads before ranking what it's got
+SEARCH_CANDIDATES = int(os.getenv('SEARCH_CANDIDATES', '500'))
+
+#Message counts from storage.counts(), which read every shard of a counter so are kept for a few seconds
+counts_cache = cache.LRUCache(256, float(os.getenv('COUNTS_TTL', '10')))
+#Most days of history /stats will give
+MAX_STATS_DAYS = 366
+
+#Where messages live, Firestore (production or the emulator) unless STORAGE_BACKEND=memory
+storage = storage_module.from_env()
+
+#Optional in-memory view of the whole collection kept up to date by an on_snapshot listener
+#Off unless MESSAGE_VIEW=1, listings use Firestore queries while it's warming up or disconnected
+#(the memory backend is already an in-memory index so it doesn't need one)
+message_view = None
+if os.getenv('MESSAGE_VIEW', '') == '1' and isinstance(storage, storage_module.FirestoreStorage):
+    message_view = message_view_module.MessageView(storage.db, on_change=lambda name: invalidate_page_cache(name))
+
+#Optional write-behind mode: new_entry() queues messages and a worker commits them in batches
+#Off unless WRITE_BEHIND=1, when the queue fills up new_entry() falls back to writing synchronously
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '') == '1'
+#How many of a session's uncommitted message ids we remember for read-your-own-writes
+MAX_SESSION_PENDING = 20
+write_queue = None
+if WRITE_BEHIND:
+    write_queue = write_behind.WriteBehindQueue(
+        storage.create_messages,
+        max_batch=min(int(os.getenv('WRITE_BEHIND_BATCH', '100')), storage.max_batch_size),
+        max_delay=float(os.getenv('WRITE_BEHIND_DELAY', '0.5')),
+        max_depth=int(os.getenv('WRITE_BEHIND_DEPTH', '5000')),
+        retryable_errors=storage.retryable_errors,
+        on_commit=lambda written: [invalidate_page_cache(data[u'name']) for data in written],
+    )
+    #Flush whatever's still queued when the instance shuts down
+    atexit.register(write_queue.close)
+
+#Concurrent identical listing reads share one trip to storage, COALESCE_LISTINGS=0 turns that off
+listing_flights = cache.SingleFlight() if os.getenv('COALESCE_LISTINGS', '1') != '0' else None
+
+#Token bucket limits on the requests that write, see rate_limit.py. POST_RATE_LIMIT is for new entries and
+#CLEAR_RATE_LIMIT for the delete box, both count/seconds per IP address and per session, 0 turns one off
+#Buckets are per instance unless RATE_LIMIT_REDIS_URL points them at a redis every instance shares
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', '')
+rate_limiter = rate_limit.RateLimiter(
+    rate_limit.RedisStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL
+    else rate_limit.MemoryStore(int(os.getenv('RATE_LIMIT_KEYS', str(rate_limit.MAX_KEYS)))),
+    {
+        'post': rate_limit.parse_rule(os.getenv('POST_RATE_LIMIT', '10/60')),
+        'clear': rate_limit.parse_rule(os.getenv('CLEAR_RATE_LIMIT', '3/600')),
+    },
+)
+
+#Server-Sent Events for /events, every viewer on this instance shares one storage watch which
+#starts with the first of them. Its events also drop cached pages, so writes made by other instances
+#show up straight away instead of after PAGE_CACHE_TTL while anyone's watching
+#Each stream holds a thread under gthread or sync workers, gunicorn.conf.py sets this low enough to leave
+#threads for everything else there. 0 switches live updates off, the default on App Engine standard, whose
+#front end buffers responses so a stream would only hold a thread until the request deadline
+MAX_EVENT_STREAMS = int(os.getenv('MAX_EVENT_STREAMS', '0' if os.getenv('GAE_ENV', '').startswith('standard') else '1000'))
+live_feed = live_feed_module.LiveFeed(
+    storage, MAX_EVENT_STREAMS,
+    on_event=lambda kind, value: invalidate_page_cache(value.search_str if kind == 'cleared' else value.name),
+)
+
+def cache_gauges():
+    gauges = [
+        ('guestbook_page_cache_entries', 'Pages in the rendered page cache', page_cache.stats()['entries']),
+        ('guestbook_fragment_cache_bytes', 'Size of the rendered rows in the fragment cache', fragment_cache.bytes),
+    ]
+    if write_queue is not None:
+        gauges.append(('guestbook_write_behind_depth', 'Messages waiting in the write-behind queue', write_queue.depth()))
+    gauges.append(('guestbook_event_streams', 'Open /events streams', live_feed.stats()['subscribers']))
+    return gauges
+
+def cache_counters():
+    stats = page_cache.stats()
+    counters = [
+        ('guestbook_page_cache_hits', 'Page cache hits', stats['hits']),
+        ('guestbook_page_cache_misses', 'Page cache misses', stats['misses']),
+        ('guestbook_fragment_cache_hits', 'Listing rows served from the fragment cache', fragment_cache.hits),
+        ('guestbook_fragment_cache_misses', 'Listing rows rendered', fragment_cache.misses),
+    ]
+    if listing_flights is not None:
+        flights = listing_flights.stats()
+        counters.append(('guestbook_listing_reads', 'Listing reads that went to storage', flights['leaders']))
+        counters.append(('guestbook_listing_reads_collapsed', 'Listing reads that shared one already in flight', flights['collapsed']))
+    counters.append(('guestbook_rate_limited', 'Requests turned away by the rate limits', rate_limiter.rejected))
+    return counters
+
+#Fingerprinted CSS/JS bundle URLs for the templates, see assets.py
+app.jinja_env.globals['asset_url'] = assets.asset_url
+
+def message_row(message):
+    '''
+    One listing row (message_row.html) for the templates, from fragment_cache when it's been rendered before
+    '''
+    return Markup(fragment_cache.get_or_render(
+        (message.id, message.version()), lambda: app.jinja_env.get_template('message_row.html').render(item=message)))
 
+app.jinja_env.globals['message_row'] = message_row
 
-if os.getenv('GAE_ENV', '').startswith('standard'):
-    # production
-    db = firestore.Client()
-else:
-    # localhost
-    os.environ["FIRESTORE_DATASET"] = "test"
-    os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8001"
-    os.environ["FIRESTORE_EMULATOR_HOST_PATH"] = "localhost:8001/firestore"
-    os.environ["FIRESTORE_HOST"] = "http://localhost:8001"
-    os.environ["FIRESTORE_PROJECT_ID"] = "test"
+#gzip/brotli for text responses, see http_caching.py
+app.after_request(http_caching.compress)
 
-    credentials = mock.Mock(spec=google.auth.credentials.Credentials)
-    db = firestore.Client(project="test2", credentials=credentials)
+#Per-request timing and Firestore counts, only does anything with METRICS=1
+if metrics.ENABLED:
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.finish_request)
+    metrics.add_gauges(cache_gauges)
+    metrics.add_counters(cache_counters)
 
-def clear_db(db, search_str):
+def clear_db(storage, search_str, cutoff=None, progress=None):
     '''
     Clear either all or selected user data
-    Clear Firestore fields using batch commands to execute the action 'at once'
+    With a cutoff only messages created at or before it are deleted
+    Returns the number of messages deleted
     '''
-    #Get a new write batch obj
-    batch = db.batch()
+    def log_progress(deleted):
+        logging.info('clear_db(%r): %d messages deleted so far', search_str, deleted)
+        if progress is not None:
+            progress(deleted)
 
-    if search_str != '':
-        #One user's data only
-        db_ref = db.collection(u'messages').where(u'name', u'==', search_str)
-    else:
-        #All users' data
-        db_ref = db.collection(u'messages')
-
-    #Delete all or name's preexisting messages (documents)
-    for doc in db_ref.get():
-        #setup the delete instructions
-        batch.delete(doc.reference)
-    #action the batch
-    batch.commit()
-
-def form_resub_chk():
-    '''
-    Uses a session variable 'form_data_hash' to indentify form resubmission
-    'form_data_hash' is created from the previous data submitted in this session
-    '''
-    result = True
-    # grab form fields needed
-    str2hash = request.form.get("name").strip() + request.form.get("message").strip()
-    # encoding form data using encode()
-    # then sending to md5() and hexdigest() to hash and convert to string
-    hashedformdata =hashlib.md5(str2hash.encode()).hexdigest()
-
-    if 'form_data_hash' in session:
-        if hashedformdata == session['form_data_hash']:
-            #its already been submitted!
-            result = False
-        else:
-            #new data so setup the session variable
-            session['form_data_hash'] = hashedformdata
+    return storage.delete_messages(search_str, cutoff, log_progress)
+
+def start_clear_job(storage, search_str):
+    '''
+    Kick off clear_db() as a background job and return its id
+    The job's tombstone hides the messages from listings until they're gone
+    '''
+    job_id = jobs.start_clear_job(storage, search_str,
+                                  lambda search_str, cutoff, progress: clear_db(storage, search_str, cutoff, progress),
+                                  on_finish=invalidate_page_cache)
+    invalidate_page_cache(search_str)
+    return job_id
+
+def invalidate_page_cache(search_str):
+    '''
+    Drop the cached pages that could show messages written or deleted for search_str
+    An empty search_str means everybody's messages so it drops the lot
+    Any write could change any text search (and the counts) so those all go
+    '''
+    search_cache.invalidate()
+    counts_cache.invalidate()
+    if search_str == '':
+        page_cache.invalidate()
     else:
-        #create session variable coz there ain't one yet!
-        session['form_data_hash'] = hashedformdata
-    return result
+        #search_str is the name written or deleted, which prefix/contains searches other than its own can show too
+        page_cache.invalidate(lambda key: name_search.matches(search_str, key.search_str, key.search_mode))
+
+def client_ip():
+    #GAE puts the caller's address in this header (and drops any the caller sent), X-Forwarded-For can be made up
+    return request.headers.get('X-Appengine-User-Ip') or request.remote_addr or ''
+
+def rate_limited(action):
+    '''
+    A 429 response if this client has run out of action requests, None if it can go ahead
+    Call it before anything touches storage, so turned away requests cost no Firestore writes or reads
+    '''
+    if 'client_id' not in session:
+        session['client_id'] = secrets.token_hex(8)
+    retry_after = rate_limiter.check(action, ['ip:' + client_ip(), 'session:' + session['client_id']])
+    if not retry_after:
+        return None
+    return ('Too many requests, try again in {} seconds\n'.format(retry_after), 429,
+            {'Content-Type': 'text/plain', 'Retry-After': str(retry_after)})
 
 def get_query_data():
     sort_by = request.args.get('sort_by')
@@ -92,9 +240,13 @@ def get_query_data():
 
     sort_direction = request.args.get('sort_direction')
 
-    return(validate_vars(sort_by, search_str, sort_direction))
+    page_token = request.args.get('page_token')
+
+    search_mode = request.args.get('search_mode')
+
+    return(validate_vars(sort_by, search_str, sort_direction, page_token, search_mode))
 
-def validate_vars(sort_by, search_str, sort_direction):
+def validate_vars(sort_by, search_str, sort_direction, page_token=None, search_mode=None):
     sort_types = ['created','name','message']
 
     #Validate sort_by var
@@ -107,7 +259,14 @@ def validate_vars(sort_by, search_str, sort_direction):
     #Validate sort_direction
     sort_direction = validate_direction(sort_direction)
 
-    return tuple((sort_by,search_str,sort_direction))
+    #Validate search_mode
+    search_mode = name_search.validate_mode(search_mode)
+
+    #Only keep a page token that decodes and belongs to the current sort order
+    if decode_page_token(page_token, name_search.sort_field(fix_firestore_names(sort_by), search_str, search_mode)) is None:
+        page_token = None
+
+    return QueryData(sort_by, search_str, sort_direction, page_token, search_mode)
 
 def validate_search_str(search_str):
     if search_str != '':
@@ -120,6 +279,252 @@ def validate_direction(sort_direction):
         sort_direction = 'ASCENDING'
     return sort_direction
 
+def flip_direction(sort_direction):
+    if sort_direction == 'DESCENDING':
+        return 'ASCENDING'
+    return 'DESCENDING'
+
+def encode_page_token(message, sort_type, page):
+    '''
+    Build an opaque page token from the first/last message on a page
+    page is 'next' or 'prev' and says which way the cursor points
+    '''
+    value = name_search.sort_value(message, sort_type)
+    if isinstance(value, datetime.datetime):
+        #Timestamps don't survive json so tag them
+        value = {'dt': value.isoformat()}
+    payload = {'f': sort_type, 'v': value, 'id': message.id, 'p': page}
+    token = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode())
+    return token.decode().rstrip('=')
+
+def decode_page_token(page_token, sort_type):
+    '''
+    Turn a page token back into a cursor dict, or None if it's missing, mangled
+    or was made for a different sort order (the cursor would be meaningless then)
+    '''
+    if not page_token:
+        return None
+    try:
+        padded = page_token + '=' * (-len(page_token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if payload['f'] != sort_type or payload['p'] not in ('next', 'prev') or not isinstance(payload['id'], str):
+            return None
+        value = payload['v']
+        if sort_type == u'created':
+            #Anything but an aware timestamp can't be compared with the created times
+            value = datetime.datetime.fromisoformat(value['dt'])
+            if value.tzinfo is None:
+                return None
+        elif not isinstance(value, str):
+            return None
+        return {'value': value, 'id': payload['id'], 'page': payload['p']}
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+def get_messages_page(storage, sort_type, sort_direction, search_str, page_token=None, page_size=PAGE_SIZE,
+                      search_mode=u'exact'):
+    '''
+    Fetch one page of messages with keyset (cursor) pagination, from the in-memory
+    message view when that's switched on and up to date, otherwise from storage
+    search_str is looked for in search_mode (see name_search.py)
+    Only page_size + 1 documents get read, the extra one tells us if there's another page,
+    so the cost of a page view depends on the page size and not the size of the collection
+    Messages waiting to be deleted by a running clear job are left out
+    Returns (messages, prev_token, next_token), a token is None when there's no such page
+    '''
+    #Prefix searches are always in name order
+    sort_type = name_search.sort_field(sort_type, search_str, search_mode)
+    cursor = decode_page_token(page_token, sort_type)
+    #A 'prev' cursor walks backwards from the first message of the page we came from
+    backwards = cursor is not None and cursor['page'] == 'prev'
+    direction = flip_direction(sort_direction) if backwards else sort_direction
+    tombstones = jobs.active_tombstones(storage)
+    start = (cursor['value'], cursor['id']) if cursor is not None else None
+
+    if message_view is not None and message_view.usable():
+        hidden = (lambda message: jobs.is_hidden(message, tombstones)) if tombstones else None
+        messages = message_view.page(sort_type, direction, search_str, start, page_size + 1, hidden, search_mode)
+        last_read, scanned_out = None, False
+    else:
+        messages, last_read, scanned_out = storage.page(sort_type, direction, search_str, start, page_size + 1, tombstones,
+                                                        search_mode)
+
+    has_more = len(messages) > page_size or scanned_out
+    messages = messages[:page_size]
+    #Where the next page in this direction starts, and where a page the other way would
+    far_edge = last_read if scanned_out else (messages[-1] if messages else None)
+    near_edge = messages[0] if messages else None
+
+    prev_token = None
+    next_token = None
+    if backwards:
+        if not messages and not scanned_out:
+            #Everything before the cursor has gone, just start again
+            return get_messages_page(storage, sort_type, sort_direction, search_str, None, page_size, search_mode)
+        messages.reverse()
+        if has_more and far_edge is not None:
+            prev_token = encode_page_token(far_edge, sort_type, 'prev')
+        if near_edge is not None:
+            next_token = encode_page_token(near_edge, sort_type, 'next')
+    else:
+        if cursor is not None and near_edge is not None:
+            prev_token = encode_page_token(near_edge, sort_type, 'prev')
+        if has_more and far_edge is not None:
+            next_token = encode_page_token(far_edge, sort_type, 'next')
+    return messages, prev_token, next_token
+
+def search_messages(storage, terms):
+    '''
+    Every message matching all of the text_search terms, ranked best first, from the in-memory
+    message view when that's switched on and up to date, otherwise from storage
+    Messages waiting to be deleted by a running clear job are left out
+    Returns (messages, complete) like Storage.search_messages()
+    '''
+    key = tuple(terms)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = search_cache.generation
+    if message_view is not None and message_view.usable():
+        found, complete = message_view.search(terms), True
+    else:
+        found, complete = storage.search_messages(terms, SEARCH_CANDIDATES)
+    tombstones = jobs.active_tombstones(storage)
+    if tombstones:
+        found = [message for message in found if not jobs.is_hidden(message, tombstones)]
+    result = (text_search.rank(found, terms), complete)
+    search_cache.set(key, result, generation)
+    return result
+
+def read_listing(query_data, generation):
+    '''
+    get_messages_page() for the listing query_data asks for, sharing the read with an identical one already in flight
+    generation is the page cache generation from before the read
+    Returns (messages, prev_token, next_token)
+    '''
+    sort_type = fix_firestore_names(query_data.sort_by)
+
+    def read_page():
+        #logging.warning(sort_direction + ' ' + sort_type)
+        # get a page of messages from the Firestore
+        return get_messages_page(storage, sort_type, query_data.sort_direction, query_data.search_str, query_data.page_token,
+                                 search_mode=query_data.search_mode)
+
+    if listing_flights is None:
+        return read_page()
+    #Join an identical read that's already running, unless something's been written or deleted
+    #since it started (that bumps the cache generation), so we're never staler than the read itself
+    return listing_flights.do((query_data, generation), read_page, metrics.span('coalesced'))
+
+def listing_etag(query_data, messages, prev_token, next_token):
+    '''
+    ETag for a page of the listing, from the query, how many messages there are and the messages
+    on the page (messages are never edited, so their ids and created times say when they last changed)
+    '''
+    total = message_counts(storage)['total']
+    latest = max([message.created for message in messages]) if messages else None
+    return http_caching.make_etag(list(query_data), total, latest, [message.id for message in messages],
+                                  prev_token, next_token)
+
+def message_counts(storage, name=None, days=0):
+    '''
+    storage.counts() for all messages, name's (if given) and each of the last days days, UTC
+    '''
+    key = (name, days)
+    counts = counts_cache.get(key)
+    if counts is None:
+        generation = counts_cache.generation
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        counts = storage.counts(name, [today - datetime.timedelta(days=ago) for ago in range(days)])
+        counts_cache.set(key, counts, generation)
+    return counts
+
+def session_pending_messages():
+    '''
+    This session's messages still sitting in the write-behind queue, as (id, data) pairs
+    Drops the ids that have been committed since from the session
+    '''
+    doc_ids = session.get('pending_writes')
+    if not doc_ids or write_queue is None:
+        return []
+    pending = write_queue.pending(doc_ids)
+    if len(pending) != len(doc_ids):
+        session['pending_writes'] = [doc_id for doc_id, data in pending]
+    return pending
+
+def merge_pending_messages(messages, pending, sort_type, sort_direction, search_str, first_page, last_page,
+                           search_mode=u'exact'):
+    '''
+    Slot uncommitted messages into a page of messages, so people see their own posts straight away
+    A pending message joins the page if it sorts between the page's first and last messages,
+    or before the first on the first page, or after the last on the last page
+    '''
+    sort_field = name_search.sort_field(sort_type, search_str, search_mode)
+    def sort_key(message):
+        if search_str != '' and sort_field == u'name' and search_mode == u'exact':
+            #These listings are ordered by document id alone
+            return (message.id,)
+        return (name_search.sort_value(message, sort_field), message.id)
+
+    descending = sort_direction == 'DESCENDING'
+    def before(a, b):
+        return a > b if descending else a < b
+
+    extra = []
+    for doc_id, data in pending:
+        if not name_search.matches(data[u'name'], search_str, search_mode):
+            continue
+        message = records.from_dict(doc_id, data)
+        key = sort_key(message)
+        if messages and not first_page and before(key, sort_key(messages[0])):
+            continue
+        if messages and not last_page and before(sort_key(messages[-1]), key):
+            continue
+        extra.append(message)
+    if not extra:
+        return messages
+    return sorted(messages + extra, key=sort_key, reverse=descending)
+
+class LazyPage(object):
+    '''
+    A page of messages that isn't fetched until something first loops over it
+    fetch() returns (messages, prev_token, next_token) like get_messages_page()
+    Lets a streamed index.html go out before Firestore has answered, the template
+    reads page.prev_token/page.next_token after its loop so they're set by then
+    '''
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self.messages = None
+        self.prev_token = None
+        self.next_token = None
+
+    def load(self):
+        if self.messages is None:
+            self.messages, self.prev_token, self.next_token = self._fetch()
+        return self.messages
+
+    def __iter__(self):
+        return iter(self.load())
+
+def stream_listing(context, cache_key=None, cache_generation=None):
+    '''
+    Render index.html a piece at a time, and if cache_key is given keep the pieces
+    so the finished page can go in the page cache like a normally rendered one
+    '''
+    app.update_template_context(context)
+    chunks = []
+    for chunk in app.jinja_env.get_template("index.html").stream(context):
+        if cache_key is not None:
+            chunks.append(chunk)
+        yield chunk
+    if cache_key is not None:
+        page = context['page']
+        page_cache.set(cache_key, {'messages': page.messages, 'prev_token': page.prev_token, 'next_token': page.next_token,
+                                   'html': ''.join(chunks),
+                                   'etag': listing_etag(cache_key, page.messages, page.prev_token, page.next_token)},
+                       cache_generation)
+
 #Convert query string and form fields into Firestore fields
 def fix_firestore_names(sort_by):
     sort_type = u'created'
@@ -132,7 +537,25 @@ def fix_firestore_names(sort_by):
 #Setup static route for favicon
 @app.route('/favicon.ico')
 def favicon():
-    return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
+    #Not fingerprinted, so only kept for a day (app.yaml serves it the same way on GAE)
+    return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon',
+                               max_age=24 * 3600)
+
+@app.route('/static/dist/<path:filename>')
+def dist_asset(filename):
+    '''
+    A fingerprinted bundle from assets.py, for when Flask serves static files (GAE's static handler does it in production)
+    Sends the precompressed copy the client can take, and far-future caching since the name changes with the contents
+    '''
+    encoding, suffix = http_caching.precompressed(os.path.join(assets.DIST_DIR, filename))
+    response = send_from_directory(assets.DIST_DIR, filename + suffix, max_age=assets.FAR_FUTURE,
+                                   mimetype=mimetypes.guess_type(filename)[0])
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
 '''
 Arrive here either to create the new message form (new_entry.html) or to extract its posted content
 '''
@@ -140,26 +563,36 @@ Arrive here either to create the new message form (new_entry.html) or to extract
 def new_entry():
     if (request.method == "POST"):
         #Grab form data if it's not already been submitted
-        messages_ref = db.collection(u'messages')
         if (request.form.get("message") is not None):
-            #Check for resubmission
-            if form_resub_chk():
-                # add message to Firestore
-                message_ref = messages_ref.document()  # create a message document reference
-                # now you can create or update the message document (set: if it exists, update it. If not, create a new one).
-                message_ref.set({
-                    u'name': u'{}'.format(request.form.get("name").strip().title()),
-                    u'message': u'{}'.format(request.form.get("message").strip().capitalize()),
-                    u'created': datetime.datetime.now(),
-                    })
+            limited = rate_limited('post')
+            if limited is not None:
+                return limited
+            name = submissions.normalise_name(request.form.get("name"))
+            message = submissions.normalise_message(request.form.get("message"))
+            #The same post from any session on any instance gets the same id, so resubmissions
+            #are turned away by the create-if-absent write
+            message_id = submissions.idempotency_key(name, message)
+            message_data = {
+                u'name': name,
+                u'message': message,
+                u'created': jobs.created_now(),
+                }
+            if write_queue is not None and write_queue.submit(message_id, message_data):
+                #Remember it so this session sees it before it's committed
+                #(once, a resubmission still in the queue is accepted again under the same id)
+                pending_writes = session.get('pending_writes', [])
+                if message_id not in pending_writes:
+                    session['pending_writes'] = (pending_writes + [message_id])[-MAX_SESSION_PENDING:]
+            elif storage.create_message(message_id, message_data):
+                invalidate_page_cache(name)
         #Check them form vars
-        sort_by,search_str,sort_direction = validate_vars(request.form.get("sort_by"), request.form.get("search_str"), request.form.get("sort_direction"))
+        sort_by,search_str,sort_direction,page_token,search_mode = validate_vars(request.form.get("sort_by"), request.form.get("search_str"), request.form.get("sort_direction"), None, request.form.get("search_mode"))
         #Redirect back to index.html
-        return redirect(url_for('index', sort_by=sort_by, search_str=search_str,sort_direction=sort_direction))
+        return redirect(url_for('index', sort_by=sort_by, search_str=search_str,sort_direction=sort_direction,search_mode=search_mode))
     else:
         #Create the page together with query string vars
-        sort_by,search_str,sort_direction = get_query_data()
-        return render_template("new_entry.html", sort_by=sort_by, search_str=search_str,sort_direction=sort_direction)
+        sort_by,search_str,sort_direction,page_token,search_mode = get_query_data()
+        return render_template("new_entry.html", sort_by=sort_by, search_str=search_str,sort_direction=sort_direction,search_mode=search_mode)
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -168,10 +601,15 @@ def index():
     sort_by = 'created'
     sort_direction = 'ASCENDING'
     search_str = ''
+    search_mode = u'exact'
+    #A new search/sort always starts from the first page
+    page_token = None
+    clear_job = None
 
     if (request.method == "POST"):
         search_str = request.form.get("search_str")
         search_str = validate_search_str(search_str)
+        search_mode = name_search.validate_mode(request.form.get("search_mode"))
 
         if (request.form.get("sort_direction") is not None):
             sort_direction = request.form.get("sort_direction")
@@ -188,48 +626,209 @@ def index():
         sort_type = fix_firestore_names(sort_by)
 
         if (request.form.get("delete_data") is not None):
-            clear_db(db, search_str)
+            limited = rate_limited('clear')
+            if limited is not None:
+                return limited
+            #Deleting can take a while, so it runs in the background and we just hand back the job id
+            #Only ever deletes the exact name searched for (or everything), whatever the search mode
+            clear_job = start_clear_job(storage, search_str)
     else:
-        sort_by,search_str,sort_direction = get_query_data()
+        sort_by,search_str,sort_direction,page_token,search_mode = get_query_data()
         sort_type = fix_firestore_names(sort_by)
 
-    #logging.warning(sort_direction + ' ' + sort_type)
-    # get all messages from the Firestore
-    # a reference to the messages collection
-    messages_ref = db.collection(u'messages')
-    if search_str != '':
-        #Select fields assoicated with search_str
-        if sort_by == 'name':
-            #Avoid order by clause cannot contain a field with an equality filter name
-            #Coz the search is from the name field!!
-            messages_gen = messages_ref.where(u'name', u'==', search_str).stream()
-        else:
-            #Setup search for ordered documents
-            messages_gen = messages_ref.where(u'name', u'==', search_str).order_by(sort_type, direction=sort_direction).stream()
+    query_data = QueryData(sort_by, search_str, sort_direction, page_token, search_mode)
+    with metrics.span('session'):
+        pending = session_pending_messages()
+    #Pages with the clear job banner or this session's uncommitted posts are one offs,
+    #don't serve them from (or put them in) the cache
+    cacheable = clear_job is None and not pending
+    #Only plain GETs of those get an ETag
+    conditional = cacheable and request.method == "GET"
+    cached = page_cache.get(query_data) if cacheable else None
+    if cached is not None:
+        if not conditional:
+            return cached['html']
+        if http_caching.is_fresh(cached['etag']):
+            return http_caching.not_modified(cached['etag'])
+        return http_caching.conditional(cached['html'], cached['etag'])
+    cache_generation = page_cache.generation
+
+    def fetch_page():
+        messages, prev_token, next_token = read_listing(query_data, cache_generation)
+        if pending:
+            messages = merge_pending_messages(messages, pending, sort_type, sort_direction, search_str,
+                                              prev_token is None, next_token is None, search_mode)
+        return messages, prev_token, next_token
+
+    page = LazyPage(fetch_page)
+    #Exact name searches and the full listing have a counter to show, other searches don't
+    message_count = None
+    if search_str == '' or search_mode == u'exact':
+        counts = message_counts(storage, search_str or None)
+        message_count = counts['total'] if search_str == '' else counts['name']
+    #A contains search too short for the trigram index runs as a prefix search, label it as one and say why
+    short_search = name_search.too_short(search_str, search_mode)
+    context = dict(page=page, sort_by=sort_by, search_str=search_str, sort_direction=sort_direction,
+                   search_mode=name_search.effective_mode(search_str, search_mode) if short_search else search_mode,
+                   short_search=short_search, clear_job=clear_job, message_count=message_count,
+                   live_updates=MAX_EVENT_STREAMS > 0)
+    if STREAM_PAGES:
+        #Send the top of the page now, the messages follow once Firestore answers
+        #(so there's no ETag, that would need the messages first)
+        return Response(stream_with_context(stream_listing(context, query_data if cacheable else None, cache_generation)))
+
+    page.load()
+    etag = None
+    if cacheable:
+        etag = listing_etag(query_data, page.messages, page.prev_token, page.next_token)
+        if conditional and http_caching.is_fresh(etag):
+            #The client has this page already, don't even render it
+            return http_caching.not_modified(etag)
+    with metrics.span('render'):
+        html = render_template("index.html", **context)
+    if not cacheable:
+        return html
+    page_cache.set(query_data, {'messages': page.messages, 'prev_token': page.prev_token, 'next_token': page.next_token,
+                                'html': html, 'etag': etag}, cache_generation)
+    if not conditional:
+        return html
+    return http_caching.conditional(html, etag)
+
+
+@app.route("/api/messages", methods=["GET"])
+def api_messages():
+    '''
+    A page of the listing as JSON, takes the same query string as /
+    search_mode in the result is the mode the search ran in (a short contains search runs as prefix)
+    Sends an ETag and answers If-None-Match with a 304, so polling it is cheap when nothing's changed
+    '''
+    query_data = get_query_data()
+    cached = page_cache.get(query_data)
+    if cached is not None:
+        messages, prev_token, next_token, etag = cached['messages'], cached['prev_token'], cached['next_token'], cached['etag']
     else:
-        #Get all message documents
-        messages_gen = messages_ref.order_by(sort_type, direction=sort_direction).stream()
-        #direction=firestore.Query.DESCENDING
-    # messages generator: holds all message documents (these documents need to be converted to dicts)
-    messages = []
-    for message in messages_gen:
-        message_dict = message.to_dict()  # converting DocumentSnapshot into a dictionary
-
-        message_dict["id"] = message.id  # adding message ID to the dict, because it's not there by default
-        messages.append(message_dict)  # appending the message dict to the messages list
-
-        # logging.warning(type(message))  # Type is DocumentSnapshot (google/cloud/firestore_v1/document.py)
-        #logging.warning(message.get("message"))  # this is how you get data from DocumentSnapshot
+        messages, prev_token, next_token = read_listing(query_data, page_cache.generation)
+        etag = listing_etag(query_data, messages, prev_token, next_token)
+    if http_caching.is_fresh(etag):
+        return http_caching.not_modified(etag)
+    return http_caching.conditional(jsonify({
+        'messages': [{'id': message.id, 'name': message.name, 'message': message.message,
+                      'created': message.created.isoformat()} for message in messages],
+        'prev_token': prev_token,
+        'next_token': next_token,
+        'search_mode': name_search.effective_mode(query_data.search_str, query_data.search_mode),
+    }), etag)
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    '''
+    Message counts from the counters: the total, one name's (?name=) and one a day for
+    the last ?days= days (default 30), so they cost the same whatever the size of the guestbook
+    '''
+    name = request.args.get('name', '')
+    name = validate_search_str(name) or None
+    try:
+        days = min(max(int(request.args.get('days', '30')), 0), MAX_STATS_DAYS)
+    except ValueError:
+        days = 30
+    counts = message_counts(storage, name, days)
+    return jsonify({
+        'total': counts['total'],
+        'name': name,
+        'name_count': counts['name'],
+        'days': [{'day': day.isoformat(), 'count': count} for day, count in sorted(counts['days'].items())],
+    })
+
+
+@app.route("/search", methods=["GET"])
+def search():
+    '''
+    Full text search over the message text, PAGE_SIZE ranked results a page
+    All the terms have to be in a message for it to turn up
+    '''
+    query = request.args.get('q', '').strip()
+    try:
+        start = max(0, int(request.args.get('start', '0')))
+    except ValueError:
+        start = 0
+    terms = text_search.query_terms(query)
+    results, complete = search_messages(storage, terms) if terms else ([], True)
+    prev_start = max(0, start - PAGE_SIZE) if start > 0 else None
+    next_start = start + PAGE_SIZE if start + PAGE_SIZE < len(results) else None
+    with metrics.span('render'):
+        return render_template("search.html", q=query, terms=terms, results=results[start:start + PAGE_SIZE],
+                               total=len(results), complete=complete, prev_start=prev_start, next_start=next_start)
+
+
+@app.route("/events", methods=["GET"])
+def events():
+    '''
+    Server-Sent Events stream of messages added to and removed from the listing for search_str/search_mode
+    (added, removed and cleared events, see live_feed.py), so the page can update without reloading
+    '''
+    if MAX_EVENT_STREAMS <= 0:
+        #Live updates are off, a 204 tells EventSource not to reconnect
+        return '', 204
+    search_str = validate_search_str(request.args.get('search_str', ''))
+    search_mode = name_search.validate_mode(request.args.get('search_mode'))
+    subscription = live_feed.subscribe(search_str, search_mode)
+    if subscription is None:
+        #Full up, the browser's EventSource tries again later
+        return 'Too many live streams, try again later\n', 503, {'Content-Type': 'text/plain', 'Retry-After': '30'}
+    response = Response(live_feed.stream(subscription), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    #Stops nginx style proxies holding events back to fill a buffer
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    '''
+    Progress of a background job, e.g. the one started by ticking 'delete_data'
+    '''
+    status = jobs.get_job_status(storage, job_id, storage.count_messages)
+    if status is None:
+        return jsonify({'error': 'no such job'}), 404
+    return jsonify(status)
+
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    stats = page_cache.stats()
+    if listing_flights is not None:
+        stats['listing_flights'] = listing_flights.stats()
+    if write_queue is not None:
+        stats['write_behind'] = write_queue.stats()
+    stats['live_feed'] = live_feed.stats()
+    stats['rate_limit'] = rate_limiter.stats()
+    stats['fragment_cache'] = fragment_cache.stats()
+    return jsonify(stats)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    '''
+    Request, phase and Firestore RPC histograms in Prometheus text format (needs METRICS=1)
+    '''
+    if not metrics.ENABLED:
+        return 'Metrics are switched off, set METRICS=1\n', 404, {'Content-Type': 'text/plain'}
+    return metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
-        # interesting in-built time features
-        # logging.warning(message.read_time)
-        #logging.warning(message.create_time)
-        # logging.warning(message.update_time)
 
-    mes_flag = False
-    #A flag to enable jinjar to post up message status
-    if len(messages) != 0: mes_flag = True
-    return render_template("index.html", messages=messages, mess_flag=mes_flag, sort_by=sort_by, search_str=search_str,sort_direction=sort_direction)
+@app.route("/_ah/warmup", methods=["GET"])
+def warmup():
+    '''
+    GAE's warmup request (inbound_services: warmup in app.yaml), sent to a new instance before any
+    user request so the user doesn't pay for the Firestore client, its channel and the template compiles
+    '''
+    storage.warm_up()
+    if message_view is not None:
+        message_view.start()
+    for template in ('index.html', 'new_entry.html', 'search.html'):
+        app.jinja_env.get_template(template)
+    return '', 200, {'Content-Type': 'text/plain'}
 
 
 @app.route("/basic", methods=["GET"])
@@ -238,8 +837,7 @@ def basic():
 
 
 if __name__ == '__main__':
-    if os.getenv('GAE_ENV', '').startswith('standard'):
-        app.debug = True
-        app.run()  # production
-    else:
-        app.run(port=8080, host="localhost", debug=True)  # localhost
+    #Local development only, production runs under gunicorn (see gunicorn.conf.py and app.yaml)
+    #FLASK_DEBUG=0 turns the debugger and reloader off, e.g. to benchmark the dev server
+    app.run(port=int(os.getenv('PORT', '8080')), host="localhost", debug=os.getenv('FLASK_DEBUG', '1') != '0',
+            threaded=True)  # localhost
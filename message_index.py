@@ -0,0 +1,227 @@
+'''
+Messages held in memory with sorted indexes, shared by the in-memory storage backend
+and the on_snapshot message view
+Every message is indexed by (created, id), (name, id) and (message, id), overall and per
+name, so a keyset page is a bisect plus a slice
+Prefix searches use a (lower cased name, id) index and contains searches a trigram to ids map,
+see name_search.py, and text searches a term to ids map (text_search.py)
+'''
+import bisect
+
+import name_search
+import text_search
+
+#Fields the listing can be sorted by
+SORT_FIELDS = (u'created', u'name', u'message')
+
+
+class SortedKeys(object):
+    '''
+    A plain sorted list of (value, document id) keys kept in order with bisect
+    '''
+
+    def __init__(self):
+        self.keys = []
+
+    def add(self, key):
+        bisect.insort(self.keys, key)
+
+    def remove(self, key):
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            del self.keys[position]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class MessageIndex(object):
+    '''
+    records.Message objects indexed for keyset paging
+    Not thread safe by itself, whoever owns it holds a lock around every call
+    '''
+
+    def __init__(self):
+        self.records = {}
+        self._indexes = dict((field, SortedKeys()) for field in SORT_FIELDS)
+        self._by_name = {}
+        self._name_lower = SortedKeys()
+        self._trigrams = {}
+        self._terms = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, doc_id):
+        return self.records.get(doc_id)
+
+    def _keys(self, record):
+        return dict((field, (getattr(record, field), record.id)) for field in SORT_FIELDS)
+
+    def _add_search_keys(self, record, name_lower, append=False):
+        if append:
+            self._name_lower.keys.append((name_lower, record.id))
+        else:
+            self._name_lower.add((name_lower, record.id))
+        for trigram in name_search.trigrams(name_lower):
+            self._trigrams.setdefault(trigram, set()).add(record.id)
+        for term in text_search.message_terms(record.message):
+            self._terms.setdefault(term, set()).add(record.id)
+
+    def add(self, record):
+        '''
+        Index record, replacing any message with the same id
+        Returns the message it replaced, or None
+        '''
+        old = self.remove(record.id)
+        self.records[record.id] = record
+        name_indexes = self._by_name.get(record.name)
+        if name_indexes is None:
+            name_indexes = self._by_name[record.name] = dict((field, SortedKeys()) for field in SORT_FIELDS)
+        for field, key in self._keys(record).items():
+            self._indexes[field].add(key)
+            name_indexes[field].add(key)
+        self._add_search_keys(record, name_search.name_lower(record.name))
+        return old
+
+    def add_many(self, new_records):
+        '''
+        Index a lot of records at once, appending every key and then re-sorting each
+        index once, rather than bisect-inserting them one at a time (which is quadratic)
+        '''
+        #Last one wins if an id turns up twice, and everything being replaced goes
+        #before any keys are appended, as remove() needs the indexes sorted
+        new_records = dict((record.id, record) for record in new_records)
+        for doc_id in new_records:
+            self.remove(doc_id)
+        touched = set()
+        for record in new_records.values():
+            self.records[record.id] = record
+            name_indexes = self._by_name.get(record.name)
+            if name_indexes is None:
+                name_indexes = self._by_name[record.name] = dict((field, SortedKeys()) for field in SORT_FIELDS)
+            for field, key in self._keys(record).items():
+                self._indexes[field].keys.append(key)
+                name_indexes[field].keys.append(key)
+            self._add_search_keys(record, name_search.name_lower(record.name), append=True)
+            touched.add(record.name)
+        for sorted_keys in self._indexes.values():
+            sorted_keys.keys.sort()
+        self._name_lower.keys.sort()
+        for name in touched:
+            for sorted_keys in self._by_name[name].values():
+                sorted_keys.keys.sort()
+
+    def remove(self, doc_id):
+        '''
+        Drop a message, returns it (or None if it wasn't there)
+        '''
+        record = self.records.pop(doc_id, None)
+        if record is None:
+            return None
+        name_indexes = self._by_name[record.name]
+        for field, key in self._keys(record).items():
+            self._indexes[field].remove(key)
+            name_indexes[field].remove(key)
+        if not len(name_indexes[u'created']):
+            del self._by_name[record.name]
+        lower = name_search.name_lower(record.name)
+        self._name_lower.remove((lower, doc_id))
+        for trigram in name_search.trigrams(lower):
+            ids = self._trigrams[trigram]
+            ids.discard(doc_id)
+            if not ids:
+                del self._trigrams[trigram]
+        for term in text_search.message_terms(record.message):
+            ids = self._terms[term]
+            ids.discard(doc_id)
+            if not ids:
+                del self._terms[term]
+        return record
+
+    def matching(self, search_str):
+        '''
+        All messages, or just search_str's, in no particular order
+        '''
+        if search_str == '':
+            return list(self.records.values())
+        name_indexes = self._by_name.get(search_str)
+        if name_indexes is None:
+            return []
+        return [self.records[key[1]] for key in name_indexes[u'created'].keys]
+
+    def count(self, search_str):
+        '''
+        How many messages search_str (an exact name) has
+        '''
+        name_indexes = self._by_name.get(search_str)
+        return len(name_indexes[u'created']) if name_indexes is not None else 0
+
+    def count_created(self, start, end):
+        '''
+        How many messages were created from start up to (not including) end
+        '''
+        keys = self._indexes[u'created'].keys
+        return bisect.bisect_left(keys, (end,)) - bisect.bisect_left(keys, (start,))
+
+    def search(self, terms):
+        '''
+        Every message whose text has all of terms, in no particular order
+        '''
+        if not terms:
+            return []
+        id_sets = sorted((self._terms.get(term, set()) for term in terms), key=len)
+        return [self.records[doc_id] for doc_id in id_sets[0].intersection(*id_sets[1:])]
+
+    def page(self, sort_type, direction, search_str, start, limit, hidden=None, search_mode=u'exact'):
+        '''
+        Up to limit messages in sort_type/direction order after the (value, id) key start
+        (from the beginning when start is None), leaving out any hidden(message) says to
+        Prefix searches are in name_lower order whatever sort_type says (name_search.sort_field())
+        Same answer Firestore gives for the equivalent keyset query
+        '''
+        mode = name_search.effective_mode(search_str, search_mode)
+        lo = 0
+        if mode == u'prefix':
+            keys = self._name_lower.keys
+            needle = name_search.name_lower(search_str)
+            lo = bisect.bisect_left(keys, (needle,))
+            hi = bisect.bisect_left(keys, (needle + name_search.PREFIX_END,))
+        elif mode == u'contains':
+            keys = self._contains_keys(sort_type, search_str)
+            hi = len(keys)
+        elif search_str != '':
+            name_indexes = self._by_name.get(search_str)
+            if name_indexes is None:
+                return []
+            keys = name_indexes[sort_type].keys
+            hi = len(keys)
+        else:
+            keys = self._indexes[sort_type].keys
+            hi = len(keys)
+
+        if direction == 'DESCENDING':
+            position = hi if start is None else min(hi, bisect.bisect_left(keys, tuple(start), lo, hi))
+            candidates = (keys[i] for i in range(position - 1, lo - 1, -1))
+        else:
+            position = lo if start is None else max(lo, bisect.bisect_right(keys, tuple(start), lo, hi))
+            candidates = (keys[i] for i in range(position, hi))
+
+        messages = []
+        for key in candidates:
+            record = self.records[key[1]]
+            if hidden is not None and hidden(record):
+                continue
+            messages.append(record)
+            if len(messages) >= limit:
+                break
+        return messages
+
+    def _contains_keys(self, sort_type, search_str):
+        #Only the messages that have every trigram of the search, smallest set first
+        needle = name_search.name_lower(search_str)
+        id_sets = sorted((self._trigrams.get(trigram, set()) for trigram in name_search.trigrams(needle)), key=len)
+        doc_ids = set(id_sets[0]).intersection(*id_sets[1:])
+        records = [self.records[doc_id] for doc_id in doc_ids]
+        return sorted((getattr(record, sort_type), record.id) for record in records
+                      if needle in name_search.name_lower(record.name))
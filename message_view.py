@@ -0,0 +1,134 @@
+'''
+Instance-local materialized view of the messages collection
+One Firestore on_snapshot listener per instance keeps a message_index.MessageIndex
+(sorted by created, name and message, plus per-name indexes for search_str lookups)
+up to date, and index() pages through that instead of querying Firestore
+The whole collection lives in memory, so this is for guestbooks that fit in an instance
+'''
+import logging
+import threading
+import time
+
+import message_index
+import records
+
+#A change batch at least this big (and at least an eighth of the view) rebuilds the whole index
+#from the snapshot with add_many() instead of adding the changes one at a time
+REBUILD_CHANGES = 64
+
+
+class MessageView(object):
+    '''
+    The messages collection mirrored into memory by an on_snapshot listener
+    Nothing should be read from it unless usable() says so, index() falls back to
+    querying Firestore while the view is warming up or after the listener has dropped
+    '''
+
+    def __init__(self, db, collection=u'messages', on_change=None, retry_delay=5.0):
+        self.db = db
+        self.collection = collection
+        #Called with the name of every message that gets added, changed or removed
+        self.on_change = on_change
+        self.retry_delay = retry_delay
+        self.ready = False
+        self.snapshots = 0
+        self._watch = None
+        self._last_start = 0.0
+        self._lock = threading.RLock()
+        self._index = message_index.MessageIndex()
+
+    def start(self):
+        '''
+        Start (or restart after a dropped connection) the listener, cheap to call on every request
+        '''
+        with self._lock:
+            if self._watch is not None and getattr(self._watch, 'is_active', True):
+                return
+            if time.monotonic() - self._last_start < self.retry_delay:
+                return
+            if self._watch is not None:
+                logging.warning('Message view listener dropped, restarting it')
+                self._watch.unsubscribe()
+            self._last_start = time.monotonic()
+            self.ready = False
+            self._index = message_index.MessageIndex()
+            self._watch = self.db.collection(self.collection).on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+            self.ready = False
+
+    def usable(self):
+        #Never waits for the listener, a request that finds it busy just goes to Firestore
+        if self._lock.acquire(blocking=False):
+            try:
+                self.start()
+            finally:
+                self._lock.release()
+        return self.ready and self._watch is not None and getattr(self._watch, 'is_active', True)
+
+    def __len__(self):
+        return len(self._index)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        if not self.ready or len(changes) >= max(REBUILD_CHANGES, len(self._index) // 8):
+            changed_names = self._rebuild(docs, changes)
+        else:
+            changed_names = self._apply(changes)
+        if self.on_change is not None:
+            for name in changed_names:
+                self.on_change(name)
+
+    def _rebuild(self, docs, changes):
+        '''
+        Index the whole snapshot at once, outside the lock so pages can still be read from the old
+        index (or from Firestore while warming up), then swap it in
+        Returns the names to pass to on_change(), none for the first snapshot as nothing was served from the view yet
+        '''
+        fresh = message_index.MessageIndex()
+        fresh.add_many(records.from_snapshot(document) for document in docs)
+        changed_names = set()
+        if self.ready:
+            #Only this listener's thread changes the index, so it can be read without the lock
+            for change in changes:
+                for record in (self._index.get(change.document.id), fresh.get(change.document.id)):
+                    if record is not None:
+                        changed_names.add(record.name)
+        with self._lock:
+            self._index = fresh
+            self.snapshots += 1
+            self.ready = True
+        return changed_names
+
+    def _apply(self, changes):
+        changed_names = set()
+        with self._lock:
+            for change in changes:
+                document = change.document
+                if change.type.name == 'REMOVED':
+                    old = self._index.remove(document.id)
+                else:
+                    record = records.from_snapshot(document)
+                    old = self._index.add(record)
+                    changed_names.add(record.name)
+                if old is not None:
+                    changed_names.add(old.name)
+            self.snapshots += 1
+        return changed_names
+
+    def search(self, terms):
+        '''
+        See message_index.MessageIndex.search()
+        '''
+        with self._lock:
+            return self._index.search(terms)
+
+    def page(self, sort_type, direction, search_str, start, limit, hidden=None, search_mode=u'exact'):
+        '''
+        See message_index.MessageIndex.page()
+        '''
+        with self._lock:
+            return self._index.page(sort_type, direction, search_str, start, limit, hidden, search_mode)
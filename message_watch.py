@@ -0,0 +1,159 @@
+'''
+Firestore listeners behind the live feed (live_feed.py)
+One on_snapshot listener on recent messages reports messages as they're added and removed,
+and one on running jobs reports clear jobs as they start (that's how deletes of older
+messages get out, a clear job hides them everywhere as soon as it starts)
+The messages listener only covers messages created since it started, so it doesn't read the
+whole collection, and it's swapped for a fresh one every window seconds so what it holds
+on to doesn't keep growing. With created shards it's one listener a shard, on the (shard, created)
+index the listing uses, since the single-field created index may be switched off then
+'''
+import datetime
+import logging
+import threading
+import time
+
+import jobs
+import records
+
+#A fresh messages listener also covers this much before it started, so nothing falls in the gap
+OVERLAP = datetime.timedelta(seconds=60)
+
+
+def _active(watch):
+    return watch is not None and getattr(watch, 'is_active', True)
+
+
+class _Watches(object):
+    '''
+    Several listeners that start, stop and drop out as one
+    '''
+
+    def __init__(self, watches):
+        self.watches = watches
+
+    @property
+    def is_active(self):
+        return all(_active(watch) for watch in self.watches)
+
+    def unsubscribe(self):
+        for watch in self.watches:
+            watch.unsubscribe()
+
+
+class MessageWatch(object):
+    '''
+    callback(kind, value) is called from the listener threads with
+    ('added', records.Message), ('removed', records.Message) or ('cleared', jobs.Tombstone)
+    What's already there when a listener starts isn't reported, only changes after that
+    '''
+
+    def __init__(self, db, callback, collection=u'messages', jobs_collection=u'jobs', window=3600.0,
+                 check_every=5.0, shards=0):
+        self.db = db
+        self.callback = callback
+        self.collection = collection
+        self.jobs_collection = jobs_collection
+        self.shards = shards
+        self.window = window
+        self.check_every = check_every
+        self._messages = None
+        self._messages_started = 0.0
+        self._jobs = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            self._messages = self._listen_messages()
+            self._messages_started = time.monotonic()
+            self._jobs = self._listen_jobs()
+        self._thread = threading.Thread(target=self._run, name='message-watch', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            for watch in (self._messages, self._jobs):
+                if watch is not None:
+                    watch.unsubscribe()
+            self._messages = self._jobs = None
+
+    def _run(self):
+        #Keep both listeners going, and renew the messages one every window
+        while not self._stopped.wait(self.check_every):
+            try:
+                if not _active(self._jobs):
+                    logging.warning('Live feed jobs listener dropped, restarting it')
+                    with self._lock:
+                        self._jobs = self._listen_jobs()
+                if not _active(self._messages) or time.monotonic() - self._messages_started >= self.window:
+                    self._renew_messages()
+            except Exception:
+                logging.exception('Live feed listener restart failed, trying again shortly')
+
+    def _renew_messages(self):
+        ready = threading.Event()
+        fresh = self._listen_messages(ready)
+        #Let the old one run until the new one has caught up, a message or two may be reported twice
+        ready.wait(30.0)
+        with self._lock:
+            old, self._messages = self._messages, fresh
+            self._messages_started = time.monotonic()
+        if old is not None:
+            old.unsubscribe()
+
+    def _listen_messages(self, ready=None):
+        since = jobs.created_now() - OVERLAP
+        collection = self.db.collection(self.collection)
+        if self.shards:
+            queries = [collection.where(u'shard', u'==', shard).where(u'created', u'>', since)
+                       for shard in range(self.shards)]
+        else:
+            queries = [collection.where(u'created', u'>', since)]
+        #Listeners still to send their first snapshot, ready is set once they all have
+        waiting = [len(queries)]
+        lock = threading.Lock()
+
+        def listener():
+            first = [True]
+
+            def on_snapshot(docs, changes, read_time):
+                if first[0]:
+                    #What was there already
+                    first[0] = False
+                    with lock:
+                        waiting[0] -= 1
+                        if waiting[0] == 0 and ready is not None:
+                            ready.set()
+                    return
+                for change in changes:
+                    if change.type.name == 'MODIFIED':
+                        #Messages aren't edited, only backfilled with extra fields
+                        continue
+                    kind = 'removed' if change.type.name == 'REMOVED' else 'added'
+                    self.callback(kind, records.from_snapshot(change.document))
+
+            return on_snapshot
+
+        watches = [query.on_snapshot(listener()) for query in queries]
+        return watches[0] if len(watches) == 1 else _Watches(watches)
+
+    def _listen_jobs(self):
+        first = [True]
+
+        def on_snapshot(docs, changes, read_time):
+            if first[0]:
+                first[0] = False
+                return
+            for change in changes:
+                if change.type.name != 'ADDED':
+                    continue
+                job = change.document.to_dict()
+                if job.get(u'kind') == u'clear':
+                    self.callback('cleared', jobs.Tombstone(job[u'search_str'], job[u'cutoff']))
+
+        query = self.db.collection(self.jobs_collection).where(u'status', u'==', u'running')
+        return query.on_snapshot(on_snapshot)
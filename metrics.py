@@ -0,0 +1,205 @@
+'''
+Per-request hot path instrumentation
+Timing spans for the phases of a request (Firestore reads, decoding snapshots, rendering,
+session handling) plus Firestore RPC and document-read counts, collected into histograms
+that main.py serves in Prometheus text format at /metrics and summarises in each
+response's Server-Timing header
+Off unless METRICS=1, and when it's off span() hands back one shared do-nothing
+context manager and the record_* functions return straight away
+'''
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+import flask
+
+ENABLED = os.getenv('METRICS', '') == '1'
+
+#Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram(object):
+    '''
+    A Prometheus style histogram with one series per tuple of label values
+    '''
+
+    def __init__(self, name, help_text, label_names=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series[0][position] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_values, (counts, count, total) in sorted(self._series.items()):
+                labels = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(self.label_names, label_values)]
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(labels + ['le="{}"'.format(bound)]), cumulative))
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(labels + ['le="+Inf"']), count))
+                suffix = '{{{}}}'.format(','.join(labels)) if labels else ''
+                lines.append('{}_count{} {}'.format(self.name, suffix, count))
+                lines.append('{}_sum{} {}'.format(self.name, suffix, total))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('guestbook_request_seconds', 'Time spent handling a request', ['endpoint', 'method'])
+PHASE_SECONDS = Histogram('guestbook_phase_seconds', 'Time spent in each phase of a request', ['endpoint', 'phase'])
+FIRESTORE_RPCS = Histogram('guestbook_firestore_rpcs', 'Firestore RPCs made per request', ['endpoint'], COUNT_BUCKETS)
+FIRESTORE_READS = Histogram('guestbook_firestore_document_reads', 'Firestore documents read per request', ['endpoint'],
+                            COUNT_BUCKETS)
+
+#Functions returning extra (name, help, value) gauges to put on /metrics, e.g. cache stats
+_gauges = []
+#Same for counters, values that only ever go up (until a restart)
+_counters = []
+
+_noop_span = contextlib.nullcontext()
+
+
+class RequestStats(object):
+    '''
+    What one request has done so far, kept on flask.g while metrics are on
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.rpcs = 0
+        self.reads = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+def _current():
+    if not flask.has_request_context():
+        return None
+    return flask.g.get('request_stats')
+
+
+class _Span(object):
+    __slots__ = ('phase', 'started')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_phase(self.phase, time.perf_counter() - self.started)
+        return False
+
+
+def span(phase):
+    '''
+    with metrics.span('render'): ... times the block as a phase of the current request
+    '''
+    if not ENABLED:
+        return _noop_span
+    return _Span(phase)
+
+
+def record_phase(phase, seconds):
+    if not ENABLED:
+        return
+    stats = _current()
+    if stats is not None:
+        stats.add(phase, seconds)
+
+
+def record_rpc(reads=0):
+    '''
+    Count one Firestore RPC that read reads documents
+    '''
+    if not ENABLED:
+        return
+    stats = _current()
+    if stats is not None:
+        stats.rpcs += 1
+        stats.reads += reads
+
+
+def add_gauges(function):
+    '''
+    Register function() -> list of (name, help, value) to be reported on /metrics
+    '''
+    _gauges.append(function)
+
+
+def add_counters(function):
+    '''
+    Register function() -> list of (name, help, value) counters to be reported on /metrics
+    Each gets _total on the end of its name, the way Prometheus names counters
+    '''
+    _counters.append(function)
+
+
+def start_request():
+    if ENABLED:
+        flask.g.request_stats = RequestStats()
+
+
+def finish_request(response):
+    '''
+    Fold the request's numbers into the histograms and add the Server-Timing header
+    '''
+    stats = _current() if ENABLED else None
+    if stats is None:
+        return response
+    total = time.perf_counter() - stats.started
+    endpoint = flask.request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(total, endpoint, flask.request.method)
+    for phase, seconds in stats.phases.items():
+        PHASE_SECONDS.observe(seconds, endpoint, phase)
+    FIRESTORE_RPCS.observe(stats.rpcs, endpoint)
+    FIRESTORE_READS.observe(stats.reads, endpoint)
+
+    timings = ['{};dur={:.2f}'.format(phase, seconds * 1000) for phase, seconds in stats.phases.items()]
+    timings.append('total;dur={:.2f}'.format(total * 1000))
+    timings.append('rpc;desc="{} RPCs, {} reads"'.format(stats.rpcs, stats.reads))
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def render_prometheus():
+    lines = []
+    for histogram in (REQUEST_SECONDS, PHASE_SECONDS, FIRESTORE_RPCS, FIRESTORE_READS):
+        lines.extend(histogram.render())
+    for function in _gauges:
+        for name, help_text, value in function():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value))
+    for function in _counters:
+        for name, help_text, value in function():
+            name += '_total'
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,97 @@
+'''
+Searching messages by name
+exact    - the name as typed (title cased, like new_entry() stores it), the original search
+prefix   - names starting with the search, ignoring case, a range query on the lower cased
+           name_lower field
+contains - names with the search anywhere in them, ignoring case. Every message stores the
+           trigrams of its name in name_trigrams, the query asks for one of the search's
+           trigrams with array_contains and the rest of the check happens as the results come in
+Both extra fields are written by the storage backend along with each message (and put on
+old messages by backfill.py), so every lookup goes through an index
+'''
+
+SEARCH_MODES = (u'exact', u'prefix', u'contains')
+
+#Searches shorter than this can't be split into trigrams, contains does a prefix search for them instead
+#(and says so, see too_short())
+TRIGRAM_LENGTH = 3
+
+#Sorts after any character that turns up in a name, so [prefix, prefix + PREFIX_END) is every name starting with prefix
+PREFIX_END = u'\uf8ff'
+
+
+def validate_mode(search_mode):
+    if search_mode not in SEARCH_MODES:
+        return u'exact'
+    return search_mode
+
+
+def name_lower(name):
+    return u' '.join(name.split()).lower()
+
+
+def trigrams(text):
+    '''
+    The distinct three character slices of text, in order of first appearance
+    '''
+    seen = []
+    for position in range(len(text) - TRIGRAM_LENGTH + 1):
+        trigram = text[position:position + TRIGRAM_LENGTH]
+        if trigram not in seen:
+            seen.append(trigram)
+    return seen
+
+
+def search_fields(name):
+    '''
+    The extra fields stored on a message so it can be found by prefix and contains searches
+    '''
+    lower = name_lower(name)
+    return {u'name_lower': lower, u'name_trigrams': trigrams(lower)}
+
+
+def too_short(search_str, search_mode):
+    '''
+    True for a contains search without a whole trigram, which runs as a prefix search
+    '''
+    return search_mode == u'contains' and search_str != '' and len(name_lower(search_str)) < TRIGRAM_LENGTH
+
+
+def effective_mode(search_str, search_mode):
+    '''
+    The mode a search really runs in, no search at all is always exact
+    '''
+    if search_str == '':
+        return u'exact'
+    if too_short(search_str, search_mode):
+        return u'prefix'
+    return search_mode
+
+
+def sort_field(sort_type, search_str, search_mode):
+    '''
+    The field a listing is really ordered by, prefix searches only come in name order
+    '''
+    if effective_mode(search_str, search_mode) == u'prefix':
+        return u'name_lower'
+    return sort_type
+
+
+def sort_value(message, field):
+    if field == u'name_lower':
+        return name_lower(message.name)
+    return getattr(message, field)
+
+
+def matches(name, search_str, search_mode):
+    '''
+    True if a message by name turns up in the search
+    '''
+    mode = effective_mode(search_str, search_mode)
+    if search_str == '':
+        return True
+    if mode == u'exact':
+        return name == search_str
+    if mode == u'prefix':
+        return name_lower(name).startswith(name_lower(search_str))
+    return name_lower(search_str) in name_lower(name)
@@ -0,0 +1,168 @@
+'''
+Token bucket rate limits for the endpoints that write to Firestore
+Each client gets a bucket per action, per IP address and per session, holding up to burst
+tokens and refilled at rate tokens a second. Each request takes a token from all of its
+buckets, and is turned away when any of them is empty
+Buckets live in a bounded LRU in each instance, or in redis (RATE_LIMIT_REDIS_URL, needs the
+redis package) so the limits hold across instances
+'''
+import collections
+import logging
+import math
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    #Per instance buckets only then
+    redis = None
+
+#burst tokens at most, refilled at rate tokens a second
+Rule = collections.namedtuple('Rule', ['rate', 'burst'])
+
+#Most buckets kept in memory, the least recently used go first (and come back full, which is no worse
+#than the fresh bucket a new IP address gets anyway)
+MAX_KEYS = 100000
+
+
+def parse_rule(text):
+    '''
+    A Rule from 'count/seconds' (count requests in a burst, count more every seconds), None for '0' or ''
+    '''
+    if text in ('', '0'):
+        return None
+    count, _, seconds = text.partition('/')
+    count, seconds = int(count), float(seconds or '1')
+    if count <= 0 or seconds <= 0:
+        raise ValueError('Bad rate limit {!r}, use count/seconds'.format(text))
+    return Rule(count / seconds, count)
+
+
+def refill(tokens, updated, now, rule):
+    return min(rule.burst, tokens + max(0.0, now - updated) * rule.rate)
+
+
+def wait_for(tokens, rule, cost=1):
+    '''
+    Seconds until a bucket with tokens in it has cost tokens
+    '''
+    return max(0.0, (cost - tokens) / rule.rate)
+
+
+class MemoryStore(object):
+    '''
+    Buckets in this process, in an LRU of at most max_keys of them
+    '''
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.evictions = 0
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rule, cost=1):
+        '''
+        Take cost tokens from key's bucket if it has them
+        Returns 0 if it did, or the seconds until it will have them
+        '''
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = refill(bucket[0], bucket[1], now, rule) if bucket is not None else rule.burst
+            waiting = wait_for(tokens, rule, cost)
+            if not waiting:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        return waiting
+
+
+#Same bucket as MemoryStore.take(), done in one go on the redis server so instances can't race
+#Numbers come back as strings, redis would cut a Lua number down to an integer
+_TAKE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local taken = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    taken = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {taken, tostring(tokens)}
+'''
+
+
+class RedisStore(object):
+    '''
+    Buckets shared by every instance in redis, each expires once it would be full again
+    If redis can't be reached requests are let through, a limiter outage shouldn't be a guestbook outage
+    '''
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError('RATE_LIMIT_REDIS_URL needs the redis package, pip install redis')
+        self.prefix = prefix
+        self.errors = 0
+        self._client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self._take = self._client.register_script(_TAKE_SCRIPT)
+
+    def __len__(self):
+        #Not worth a round trip
+        return 0
+
+    def take(self, key, rule, cost=1):
+        try:
+            taken, tokens = self._take(keys=[self.prefix + key], args=[rule.rate, rule.burst, cost, time.time()])
+        except redis.RedisError:
+            self.errors += 1
+            logging.exception('Rate limit store unavailable, letting the request through')
+            return 0
+        return 0 if int(taken) else wait_for(float(tokens), rule, cost)
+
+
+class RateLimiter(object):
+    '''
+    rules is {action: Rule}, an action with no rule isn't limited
+    '''
+
+    def __init__(self, store, rules):
+        self.store = store
+        self.rules = dict((action, rule) for action, rule in rules.items() if rule is not None)
+        self.allowed = 0
+        self.rejected = 0
+
+    def check(self, action, keys):
+        '''
+        Take a token for action from the bucket of each of keys (e.g. 'ip:...', 'session:...')
+        Returns 0 if the request can go ahead, or how many seconds to wait before trying again
+        '''
+        rule = self.rules.get(action)
+        if rule is None:
+            return 0
+        waiting = max([self.store.take(u'{}:{}'.format(action, key), rule) for key in keys] or [0])
+        if waiting:
+            self.rejected += 1
+            return int(math.ceil(waiting))
+        self.allowed += 1
+        return 0
+
+    def stats(self):
+        stats = {'allowed': self.allowed, 'rejected': self.rejected, 'keys': len(self.store),
+                 'rules': dict((action, {'rate': rule.rate, 'burst': rule.burst}) for action, rule in self.rules.items())}
+        if isinstance(self.store, MemoryStore):
+            stats['evictions'] = self.store.evictions
+        return stats
@@ -0,0 +1,36 @@
+'''
+The compact message record used on the listing hot path
+Listings only ever fetch MESSAGE_FIELDS (with a Firestore select()) and map each
+snapshot straight into a Message, a namedtuple with no per-instance __dict__,
+which is what the templates and page cache hold on to
+'''
+import collections
+
+#The only fields a listing needs, anything else stored on a message is never fetched
+MESSAGE_FIELDS = (u'name', u'message', u'created')
+
+
+#update_time is when Firestore last wrote the document (None from the memory backend), it
+#comes with every snapshot so it costs nothing to keep
+class Message(collections.namedtuple('Message', ('id',) + MESSAGE_FIELDS + ('update_time',), defaults=(None,))):
+    __slots__ = ()
+
+    def version(self):
+        '''
+        Something that changes whenever the message does, for keying caches of things made from it
+        Messages from the memory backend are never rewritten in place, so created does there
+        '''
+        return self.update_time if self.update_time is not None else self.created
+
+
+def from_snapshot(snapshot):
+    '''
+    Map a (projected) DocumentSnapshot into a Message
+    '''
+    data = snapshot.to_dict()
+    return Message(snapshot.id, data.get(u'name'), data.get(u'message'), data.get(u'created'),
+                   getattr(snapshot, 'update_time', None))
+
+
+def from_dict(doc_id, data):
+    return Message(doc_id, data.get(u'name'), data.get(u'message'), data.get(u'created'))
@@ -0,0 +1,35 @@
+'''
+Retrying calls that fail now and then (a busy or briefly unavailable backend) with jittered
+exponential backoff: each wait is somewhere in the upper half of base_delay, 2 * base_delay,
+4 * base_delay... so clients that failed together don't all come back together
+'''
+import logging
+import random
+import time
+
+
+def backoff_delay(attempt, base_delay=0.5):
+    '''
+    Seconds to wait before retry number attempt (counting from 1)
+    '''
+    delay = base_delay * (2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_with_backoff(fn, retryable, max_retries=5, base_delay=0.5, description='Call'):
+    '''
+    Return fn(), calling it again after a backoff_delay() whenever it raises one of the exceptions in retryable
+    The last of those is raised once max_retries retries have failed too, anything else straight away
+    description starts the warning logged for each retry
+    '''
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except retryable as error:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            delay = backoff_delay(attempt, base_delay)
+            logging.warning('%s failed (%s), retry %d in %.2fs', description, error, attempt, delay)
+            time.sleep(delay)
@@ -0,0 +1,785 @@
+'''
+Storage backends for the guestbook
+main.py only ever talks to a Storage: FirestoreStorage for real (and the emulator), or
+MemoryStorage, which keeps everything in sorted in-memory indexes so the app can be run,
+load tested and profiled with no emulator, no JVM and no network
+Pick one with STORAGE_BACKEND=firestore (the default) or STORAGE_BACKEND=memory
+'''
+import concurrent.futures
+import copy
+import datetime
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+import zlib
+
+import counters
+import jobs
+import message_index
+import message_watch
+import metrics
+import name_search
+import records
+import text_search
+
+#The Firestore client library (with grpc under it) is most of a cold start's import time, so it's
+#only imported by load_firestore() when the first Firestore client is made. The memory backend
+#never needs it, and works without it installed
+firestore = None
+api_exceptions = None
+deletion = None
+
+#Firestore refuses batches of more than this many writes (deletion.MAX_BATCH_SIZE, without importing it)
+FIRESTORE_MAX_BATCH = 500
+
+#Most batches one page read will go through looking for visible messages, when some are hidden
+#(tombstoned) or don't match a contains search
+MAX_PAGE_SCANS = 10
+
+
+class Storage(object):
+    '''
+    What main.py needs from a backend
+    Messages are plain dicts of name, message and created going in, records.Message coming out
+    (Firestore also stores the search fields from with_search_fields() with each one)
+    Jobs (see jobs.py) are plain dicts both ways
+    '''
+
+    #Most messages one add_messages() call may be given
+    max_batch_size = 500
+
+    #Exceptions worth retrying a write after
+    retryable_errors = ()
+
+    def warm_up(self):
+        '''
+        Get whatever the first real request would otherwise wait for (clients, connections) ready now
+        '''
+        pass
+
+    def new_id(self):
+        '''
+        A fresh, unique message id
+        '''
+        raise NotImplementedError
+
+    def add_message(self, doc_id, data):
+        raise NotImplementedError
+
+    def add_messages(self, items):
+        '''
+        Write a list of (doc_id, data) pairs in one go
+        '''
+        raise NotImplementedError
+
+    def create_message(self, doc_id, data):
+        '''
+        Write the message only if there's no document doc_id yet
+        Returns False (and writes nothing) if there is
+        '''
+        raise NotImplementedError
+
+    def create_messages(self, items):
+        '''
+        create_message() for a list of (doc_id, data) pairs in as few writes as possible
+        Returns the list of doc_ids that already existed and so weren't written
+        '''
+        raise NotImplementedError
+
+    def page(self, sort_type, direction, search_str, start, limit, tombstones=(), search_mode=u'exact'):
+        '''
+        Up to limit messages (all of them, or those search_str finds in search_mode, see name_search.py)
+        in sort_type/direction order after the (value, id) key start, or from the beginning when start is None
+        Prefix searches are ordered by name_lower instead whatever sort_type says (name_search.sort_field())
+        Messages hidden by one of the jobs.Tombstone tombstones are skipped
+        Returns (messages, last_read, scanned_out), scanned_out is True if the backend gave up
+        skipping hidden messages before finding enough, last_read is the last message it
+        looked at, hidden or not
+        '''
+        raise NotImplementedError
+
+    def delete_messages(self, search_str, cutoff=None, progress=None):
+        '''
+        Delete all or search_str's messages, only those created at or before cutoff if given
+        progress(deleted so far) is called every now and then
+        Returns the number deleted
+        '''
+        raise NotImplementedError
+
+    def iter_messages(self, batch_size=500):
+        '''
+        Every message, as lists of at most batch_size records.Message, in document id order
+        Only one batch is held at a time, however many messages there are
+        '''
+        raise NotImplementedError
+
+    def search_messages(self, terms, limit):
+        '''
+        Messages whose text has every one of the text_search terms, in no particular order
+        Returns (messages, complete), complete is False if the backend stopped after limit messages
+        and there may be more
+        '''
+        raise NotImplementedError
+
+    def counts(self, name=None, days=()):
+        '''
+        How many messages there are in all, by name (if given) and created on each of days (datetime.dates, UTC)
+        Returns {'total': n, 'name': n or None, 'days': {date: n}}, without reading the messages
+        '''
+        raise NotImplementedError
+
+    def rebuild_counters(self, progress=None):
+        '''
+        Recount everything behind counts() from the messages themselves, for a backend that keeps counters
+        progress(messages counted) is called every now and then
+        Returns the number of messages counted
+        '''
+        raise NotImplementedError
+
+    def backfill_fields(self, progress=None):
+        '''
+        Put search_fields() (and the shard, if there is one) on every stored message that hasn't got them
+        (or has stale ones)
+        progress(messages checked, messages updated) is called every now and then
+        Returns the number updated
+        '''
+        raise NotImplementedError
+
+    def count_messages(self, search_str, cutoff=None):
+        '''
+        Count all or search_str's messages, only those created at or before cutoff if given
+        Returns None when the backend can't count without reading everything
+        '''
+        raise NotImplementedError
+
+    def watch(self, callback):
+        '''
+        Have callback(kind, value) called as messages come and go, from whatever thread notices:
+        ('added', records.Message) for new messages, ('removed', records.Message) for deleted ones the
+        backend can report one by one, and ('cleared', jobs.Tombstone) when a clear job starts
+        Returns a function that stops it
+        '''
+        raise NotImplementedError
+
+    def save_job(self, job_id, job):
+        raise NotImplementedError
+
+    def update_job(self, job_id, fields):
+        raise NotImplementedError
+
+    def get_job(self, job_id):
+        '''
+        The job dict, or None if there's no such job
+        '''
+        raise NotImplementedError
+
+    def running_jobs(self):
+        '''
+        {job id: job dict} for every job whose status is 'running'
+        '''
+        raise NotImplementedError
+
+
+class FirestoreStorage(Storage):
+    '''
+    Messages and jobs kept in Firestore collections, plus counters.py counters for counts()
+    With shards > 1 every message also gets a shard field (see shard_of()) and the full listing
+    in created order is read shard by shard and merged back together. The (shard, created) index
+    that uses spreads the stream of new, always latest, created values over shards key ranges
+    instead of piling them all onto the end of one
+    '''
+
+    #Each message written or deleted can bring counters.WRITES_PER_MESSAGE counter writes into its batch
+    max_batch_size = FIRESTORE_MAX_BATCH // (1 + counters.WRITES_PER_MESSAGE)
+
+    def __init__(self, db=None, collection=u'messages', jobs_collection=u'jobs', shards=0,
+                 counters_collection=u'counters', counter_shards=5, make_db=None):
+        '''
+        Give it a Firestore client as db, or a make_db() that makes one, which is then only called
+        (and the client library only imported) when the client's first needed
+        '''
+        self._db = db
+        self._make_db = make_db
+        self._db_lock = threading.Lock()
+        self.collection = collection
+        self.jobs_collection = jobs_collection
+        self.counters_collection = counters_collection
+        self.counter_shards = max(1, counter_shards)
+        self.shards = shards if shards > 1 else 0
+        #Runs the per shard queries of a listing side by side
+        self._shard_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.shards) if self.shards else None
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = self._make_db()
+        return self._db
+
+    @property
+    def retryable_errors(self):
+        load_firestore()
+        return deletion.RETRYABLE_ERRORS
+
+    def warm_up(self):
+        #Make the client, and open its channel with a one document read
+        with metrics.span('firestore'):
+            list(self.db.collection(self.collection).limit(1).stream())
+
+    def shard_of(self, doc_id):
+        '''
+        The shard a message belongs to, worked out from its id so it never changes
+        '''
+        return zlib.crc32(doc_id.encode('utf-8')) % self.shards
+
+    def stored_fields(self, doc_id, data):
+        '''
+        What actually gets written for a message, its data plus the search fields (and shard)
+        '''
+        fields = with_search_fields(data)
+        if self.shards:
+            fields[u'shard'] = self.shard_of(doc_id)
+        return fields
+
+    def messages_query(self, search_str):
+        '''
+        All messages, or just search_str's when it isn't empty
+        '''
+        if search_str != '':
+            #One user's data only
+            return self.db.collection(self.collection).where(u'name', u'==', search_str)
+        #All users' data
+        return self.db.collection(self.collection)
+
+    def new_id(self):
+        return self.db.collection(self.collection).document().id
+
+    def _count_changes(self, batch, changes):
+        #Each change goes to a random shard of its counter
+        for counter, change in changes.items():
+            reference = self.db.collection(self.counters_collection).document(
+                counters.shard_id(counter, random.randrange(self.counter_shards)))
+            batch.set(reference, {u'count': firestore.Increment(change)}, merge=True)
+
+    def _write_batch(self, items, create):
+        batch = self.db.batch()
+        for doc_id, data in items:
+            reference = self.db.collection(self.collection).document(doc_id)
+            if create:
+                # create: fails if the document's already there
+                batch.create(reference, self.stored_fields(doc_id, data))
+            else:
+                # set: if it exists, update it. If not, create a new one
+                #(so the counters are only right if it didn't exist)
+                batch.set(reference, self.stored_fields(doc_id, data))
+        self._count_changes(batch, counters.tally(records.from_dict(doc_id, data) for doc_id, data in items))
+        return batch
+
+    def add_message(self, doc_id, data):
+        self.add_messages([(doc_id, data)])
+
+    def add_messages(self, items):
+        batch = self._write_batch(items, create=False)
+        with metrics.span('firestore'):
+            batch.commit()
+        metrics.record_rpc()
+
+    def create_message(self, doc_id, data):
+        batch = self._write_batch([(doc_id, data)], create=True)
+        try:
+            with metrics.span('firestore'):
+                batch.commit()
+        except api_exceptions.Conflict:
+            return False
+        finally:
+            metrics.record_rpc()
+        return True
+
+    def create_messages(self, items):
+        batch = self._write_batch(items, create=True)
+        try:
+            with metrics.span('firestore'):
+                batch.commit()
+            return []
+        except api_exceptions.Conflict:
+            #A batch is all or nothing, so one duplicate sinks the lot, write them one by one instead
+            pass
+        finally:
+            metrics.record_rpc()
+        return [doc_id for doc_id, data in items if not self.create_message(doc_id, data)]
+
+    def page(self, sort_type, direction, search_str, start, limit, tombstones=(), search_mode=u'exact'):
+        mode = name_search.effective_mode(search_str, search_mode)
+        needle = name_search.name_lower(search_str)
+        wanted_match = None
+        if mode == u'prefix':
+            #A range over the lower cased names, which can only come back in that order
+            query = (self.db.collection(self.collection)
+                     .where(u'name_lower', u'>=', needle).where(u'name_lower', u'<', needle + name_search.PREFIX_END))
+            sort_type = u'name_lower'
+        elif mode == u'contains':
+            #The index finds names with one of the search's trigrams, the rest of the check happens below
+            query = self.db.collection(self.collection).where(u'name_trigrams', u'array_contains',
+                                                              name_search.trigrams(needle)[0])
+            wanted_match = lambda record: needle in name_search.name_lower(record.name)
+        else:
+            query = self.messages_query(search_str)
+        #Only fetch what the listing shows
+        query = query.select(records.MESSAGE_FIELDS)
+        #Avoid order by clause cannot contain a field with an equality filter name
+        order_by_sort = mode != u'exact' or search_str == '' or sort_type != u'name'
+        if order_by_sort:
+            query = query.order_by(sort_type, direction=direction)
+        #Document id breaks ties so equal names/messages never get skipped or repeated
+        query = query.order_by(firestore.FieldPath.document_id(), direction=direction)
+        #Only the full listing by date reads the (shard, created) index, everything else has its own
+        sharded = self.shards and mode == u'exact' and search_str == '' and sort_type == u'created'
+        if sort_type == u'created':
+            cutoffs = [tombstone.cutoff for tombstone in tombstones
+                       if tombstone.search_str == '' or (mode == u'exact' and tombstone.search_str == search_str)]
+            if cutoffs:
+                #A clear job covers this whole listing, let Firestore skip what it's deleting
+                query = query.where(u'created', u'>', max(cutoffs))
+
+        def start_after(value, doc_id):
+            cursor_fields = {}
+            if order_by_sort:
+                cursor_fields[sort_type] = value
+            cursor_fields[firestore.FieldPath.document_id()] = self.db.collection(self.collection).document(doc_id)
+            return query.start_after(cursor_fields)
+
+        def stream(page_query, wanted):
+            if not sharded:
+                return page_query.limit(wanted).stream()
+            return self._merged_shards(page_query, wanted, direction)
+
+        messages = []
+        last_read = None
+        #Only look at the clock when someone's collecting the numbers
+        timed = metrics.ENABLED
+        #Normally one pass, more only when tombstoned or non matching messages had to be skipped
+        for _ in range(MAX_PAGE_SCANS):
+            page_query = start_after(*start) if start is not None else query
+            wanted = limit - len(messages)
+            read = 0
+            decode = 0.0
+            started = time.perf_counter() if timed else 0.0
+            for message in stream(page_query, wanted):
+                read += 1
+                if timed:
+                    decode_started = time.perf_counter()
+                record = records.from_snapshot(message)
+                if timed:
+                    decode += time.perf_counter() - decode_started
+                last_read = record
+                if (wanted_match is None or wanted_match(record)) and not jobs.is_hidden(record, tombstones):
+                    messages.append(record)
+            if timed:
+                #Time spent waiting on the stream, and time spent turning snapshots into records
+                metrics.record_phase('firestore', time.perf_counter() - started - decode)
+                metrics.record_phase('decode', decode)
+            if not sharded:
+                #_merged_shards() counts its own
+                metrics.record_rpc(max(1, read))
+            if read < wanted or len(messages) >= limit:
+                return messages, last_read, False
+            start = (name_search.sort_value(last_read, sort_type), last_read.id)
+        #Gave up looking, carry on from the last message read next time
+        return messages, last_read, True
+
+    def _merged_shards(self, query, wanted, direction):
+        '''
+        The first wanted messages of query (ordered by created, then id) across all the shards
+        Each shard gives its own first wanted, in order, and a k way merge picks the overall first wanted
+        '''
+        futures = [self._shard_pool.submit(lambda shard_query: list(shard_query.limit(wanted).stream()),
+                                           query.where(u'shard', u'==', shard))
+                   for shard in range(self.shards)]
+        results = [future.result() for future in futures]
+        for result in results:
+            #An empty result is still billed as one read
+            metrics.record_rpc(max(1, len(result)))
+        merged = heapq.merge(*results, key=lambda snapshot: (snapshot.get(u'created'), snapshot.id),
+                             reverse=direction == 'DESCENDING')
+        return itertools.islice(merged, wanted)
+
+    def iter_messages(self, batch_size=500):
+        query = self.db.collection(self.collection)
+        for snapshots in deletion.iter_snapshot_chunks(query, batch_size, fields=list(records.MESSAGE_FIELDS)):
+            metrics.record_rpc(max(1, len(snapshots)))
+            yield [records.from_snapshot(snapshot) for snapshot in snapshots]
+
+    def search_messages(self, terms, limit):
+        if not terms:
+            return [], True
+        #The index finds the messages with the first term, the rest are checked here
+        query = (self.db.collection(self.collection).where(u'terms', u'array_contains', terms[0])
+                 .select(records.MESSAGE_FIELDS).limit(limit))
+        messages = []
+        read = 0
+        with metrics.span('firestore'):
+            for snapshot in query.stream():
+                read += 1
+                record = records.from_snapshot(snapshot)
+                if text_search.matches(record.message, terms[1:]):
+                    messages.append(record)
+        metrics.record_rpc(max(1, read))
+        return messages, read < limit
+
+    def backfill_fields(self, progress=None):
+        checked = 0
+        updated = 0
+        fields = [u'name', u'message', u'name_lower', u'name_trigrams', u'terms', u'shard']
+        query = self.db.collection(self.collection).select(fields).order_by(firestore.FieldPath.document_id())
+        last = None
+        while True:
+            page_query = query.start_after(last) if last is not None else query
+            snapshots = list(page_query.limit(deletion.MAX_BATCH_SIZE).stream())
+            if not snapshots:
+                break
+            batch = self.db.batch()
+            stale = 0
+            for snapshot in snapshots:
+                data = snapshot.to_dict()
+                wanted = search_fields(data.get(u'name') or u'', data.get(u'message') or u'')
+                if self.shards:
+                    wanted[u'shard'] = self.shard_of(snapshot.id)
+                if any(data.get(field) != value for field, value in wanted.items()):
+                    batch.update(snapshot.reference, wanted)
+                    stale += 1
+            if stale:
+                batch.commit()
+            checked += len(snapshots)
+            updated += stale
+            if progress is not None:
+                progress(checked, updated)
+            if len(snapshots) < deletion.MAX_BATCH_SIZE:
+                break
+            last = snapshots[-1]
+        return updated
+
+    def counts(self, name=None, days=()):
+        wanted = [counters.TOTAL]
+        if name is not None:
+            wanted.append(counters.name_counter(name))
+        wanted.extend(counters.day_counter(day) for day in days)
+        #Every shard of every counter in one batched read
+        shard_counters = {}
+        for counter in wanted:
+            for shard in range(self.counter_shards):
+                shard_counters[counters.shard_id(counter, shard)] = counter
+        references = [self.db.collection(self.counters_collection).document(shard) for shard in shard_counters]
+        totals = dict((counter, 0) for counter in wanted)
+        with metrics.span('firestore'):
+            for snapshot in self.db.get_all(references):
+                if snapshot.exists:
+                    totals[shard_counters[snapshot.id]] += snapshot.get(u'count') or 0
+        metrics.record_rpc(len(references))
+        return {
+            'total': totals[counters.TOTAL],
+            'name': totals[counters.name_counter(name)] if name is not None else None,
+            'days': dict((day, totals[counters.day_counter(day)]) for day in days),
+        }
+
+    def rebuild_counters(self, progress=None):
+        #Count first, then swap the old counters for the new ones as quickly as possible
+        changes = {}
+        counted = 0
+        for snapshots in deletion.iter_snapshot_chunks(self.db.collection(self.collection), fields=[u'name', u'created']):
+            for counter, change in counters.tally(records.from_snapshot(snapshot) for snapshot in snapshots).items():
+                changes[counter] = changes.get(counter, 0) + change
+            counted += len(snapshots)
+            if progress is not None:
+                progress(counted)
+        deletion.delete_query(self.db, self.db.collection(self.counters_collection))
+        items = list(changes.items())
+        for position in range(0, len(items), deletion.MAX_BATCH_SIZE):
+            batch = self.db.batch()
+            for counter, count in items[position:position + deletion.MAX_BATCH_SIZE]:
+                batch.set(self.db.collection(self.counters_collection).document(counters.shard_id(counter, 0)),
+                          {u'count': count})
+            batch.commit()
+        return counted
+
+    def delete_messages(self, search_str, cutoff=None, progress=None):
+        #deletion.delete_query() pages through the document references and commits them
+        #in parallel chunks of up to 500, so any size of guestbook can be cleared
+        #The counters come down in the same batches as the messages they count
+        def count_deletes(snapshots, batch):
+            self._count_changes(batch, counters.tally((records.from_snapshot(snapshot) for snapshot in snapshots), -1))
+
+        keep = None
+        if cutoff is not None:
+            keep = lambda snapshot: snapshot.get(u'created') <= cutoff
+        return deletion.delete_query(self.db, self.messages_query(search_str), chunk_size=self.max_batch_size,
+                                     progress=progress, fields=[u'name', u'created'], keep=keep,
+                                     on_delete=count_deletes)
+
+    def count_messages(self, search_str, cutoff=None):
+        #A count aggregation, so no documents are downloaded
+        query = self.messages_query(search_str)
+        if cutoff is not None:
+            query = query.where(u'created', u'<=', cutoff)
+        if not hasattr(query, 'count'):
+            #Client library too old to do aggregations
+            return None
+        if self.shards and search_str == '' and cutoff is not None:
+            #Sharded, created is only indexed along with the shard
+            return sum(self._count(query.where(u'shard', u'==', shard)) for shard in range(self.shards))
+        return self._count(query)
+
+    def _count(self, query):
+        with metrics.span('firestore'):
+            result = query.count().get()
+        count = int(result[0][0].value)
+        #Aggregations are billed a read per 1000 index entries counted
+        metrics.record_rpc(max(1, int(math.ceil(count / 1000.0))))
+        return count
+
+    def watch(self, callback):
+        #One pair of listeners per call, so callers should share one (live_feed.LiveFeed does)
+        return message_watch.MessageWatch(self.db, callback, self.collection, self.jobs_collection,
+                                          shards=self.shards).start().stop
+
+    def save_job(self, job_id, job):
+        with metrics.span('firestore'):
+            self.db.collection(self.jobs_collection).document(job_id).set(job)
+        metrics.record_rpc()
+
+    def update_job(self, job_id, fields):
+        self.db.collection(self.jobs_collection).document(job_id).update(fields)
+
+    def get_job(self, job_id):
+        with metrics.span('firestore'):
+            snapshot = self.db.collection(self.jobs_collection).document(job_id).get()
+        metrics.record_rpc(1)
+        if not snapshot.exists:
+            return None
+        return snapshot.to_dict()
+
+    def running_jobs(self):
+        running = {}
+        with metrics.span('firestore'):
+            for snapshot in self.db.collection(self.jobs_collection).where(u'status', u'==', u'running').stream():
+                running[snapshot.id] = snapshot.to_dict()
+        #An empty result is still billed as one read
+        metrics.record_rpc(max(1, len(running)))
+        return running
+
+
+class MemoryStorage(Storage):
+    '''
+    Messages and jobs kept in this process only, in a message_index.MessageIndex
+    Everything is lost when the process stops and nothing is shared between instances
+    '''
+
+    def __init__(self):
+        self._index = message_index.MessageIndex()
+        self._jobs = {}
+        self._lock = threading.RLock()
+        self._watchers = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def _notify(self, kind, values):
+        for callback in list(self._watchers):
+            for value in values:
+                callback(kind, value)
+
+    def add_message(self, doc_id, data):
+        message = records.from_dict(doc_id, data)
+        with self._lock:
+            self._index.add(message)
+        self._notify('added', [message])
+
+    def add_messages(self, items):
+        messages = [records.from_dict(doc_id, data) for doc_id, data in items]
+        with self._lock:
+            if len(messages) < 64:
+                for message in messages:
+                    self._index.add(message)
+            else:
+                self._index.add_many(messages)
+        self._notify('added', messages)
+
+    def create_message(self, doc_id, data):
+        message = records.from_dict(doc_id, data)
+        with self._lock:
+            if self._index.get(doc_id) is not None:
+                return False
+            self._index.add(message)
+        self._notify('added', [message])
+        return True
+
+    def create_messages(self, items):
+        with self._lock:
+            existing = [doc_id for doc_id, data in items if self._index.get(doc_id) is not None]
+            skip = set(existing)
+            self.add_messages([(doc_id, data) for doc_id, data in items if doc_id not in skip])
+        return existing
+
+    def page(self, sort_type, direction, search_str, start, limit, tombstones=(), search_mode=u'exact'):
+        hidden = (lambda message: jobs.is_hidden(message, tombstones)) if tombstones else None
+        with metrics.span('memory'), self._lock:
+            messages = self._index.page(sort_type, direction, search_str, start, limit, hidden, search_mode)
+        return messages, (messages[-1] if messages else None), False
+
+    def iter_messages(self, batch_size=500):
+        with self._lock:
+            messages = sorted(self._index.matching(''), key=lambda message: message.id)
+        for position in range(0, len(messages), batch_size):
+            yield messages[position:position + batch_size]
+
+    def search_messages(self, terms, limit):
+        #Everything's in memory anyway, so there's no point stopping early
+        with metrics.span('memory'), self._lock:
+            return self._index.search(terms), True
+
+    def counts(self, name=None, days=()):
+        #The index can count these straight off
+        with self._lock:
+            return {
+                'total': len(self._index),
+                'name': self._index.count(name) if name is not None else None,
+                'days': dict((day, self._index.count_created(*day_range(day))) for day in days),
+            }
+
+    def rebuild_counters(self, progress=None):
+        #No counters to rebuild
+        return len(self._index)
+
+    def backfill_fields(self, progress=None):
+        #The index works the search keys out from the messages itself
+        return 0
+
+    def _matching(self, search_str, cutoff):
+        return [message for message in self._index.matching(search_str) if cutoff is None or message.created <= cutoff]
+
+    def delete_messages(self, search_str, cutoff=None, progress=None):
+        deleted = 0
+        with self._lock:
+            for message in self._matching(search_str, cutoff):
+                self._index.remove(message.id)
+                deleted += 1
+                if progress is not None and deleted % 500 == 0:
+                    progress(deleted)
+        if progress is not None:
+            progress(deleted)
+        return deleted
+
+    def count_messages(self, search_str, cutoff=None):
+        with self._lock:
+            return len(self._matching(search_str, cutoff))
+
+    def watch(self, callback):
+        self._watchers.append(callback)
+        return lambda: self._watchers.remove(callback)
+
+    def save_job(self, job_id, job):
+        with self._lock:
+            self._jobs[job_id] = copy.deepcopy(job)
+        if job.get(u'kind') == u'clear' and job.get(u'status') == u'running':
+            self._notify('cleared', [jobs.Tombstone(job[u'search_str'], job[u'cutoff'])])
+
+    def update_job(self, job_id, fields):
+        with self._lock:
+            self._jobs[job_id].update(copy.deepcopy(fields))
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def running_jobs(self):
+        with self._lock:
+            return dict((job_id, copy.deepcopy(job)) for job_id, job in self._jobs.items() if job['status'] == u'running')
+
+
+def day_range(day):
+    '''
+    The start of day (a datetime.date, UTC) and the start of the day after
+    '''
+    start = datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc)
+    return start, start + datetime.timedelta(days=1)
+
+
+def search_fields(name, message):
+    '''
+    The fields stored with a message for the name_search.py and text_search.py searches
+    '''
+    fields = name_search.search_fields(name)
+    fields.update(text_search.search_fields(message))
+    return fields
+
+
+def with_search_fields(data):
+    '''
+    A copy of a message's data with its search_fields() added
+    '''
+    fields = dict(data)
+    fields.update(search_fields(data[u'name'], data[u'message']))
+    return fields
+
+
+def load_firestore():
+    '''
+    Import the Firestore client library, and deletion.py which needs it, the first time they're wanted
+    '''
+    global api_exceptions, deletion, firestore
+    if firestore is None:
+        from google.api_core import exceptions as api_exceptions_module
+        from google.cloud import firestore as firestore_module
+        import deletion as deletion_module
+        #firestore last, it's what says the others are there
+        api_exceptions, deletion = api_exceptions_module, deletion_module
+        firestore = firestore_module
+    return firestore
+
+
+def make_firestore_client():
+    '''
+    A Firestore client for production on GAE, or for the local emulator everywhere else
+    '''
+    load_firestore()
+    if os.getenv('GAE_ENV', '').startswith('standard'):
+        # production
+        return firestore.Client()
+
+    # localhost
+    import mock
+    import google.auth.credentials
+
+    os.environ["FIRESTORE_DATASET"] = "test"
+    os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8001"
+    os.environ["FIRESTORE_EMULATOR_HOST_PATH"] = "localhost:8001/firestore"
+    os.environ["FIRESTORE_HOST"] = "http://localhost:8001"
+    os.environ["FIRESTORE_PROJECT_ID"] = "test"
+
+    credentials = mock.Mock(spec=google.auth.credentials.Credentials)
+    return firestore.Client(project="test2", credentials=credentials)
+
+
+def from_env():
+    '''
+    The backend STORAGE_BACKEND asks for
+    '''
+    backend = os.getenv('STORAGE_BACKEND', 'firestore')
+    if backend == 'memory':
+        logging.warning('Using the in-memory storage backend, nothing will be saved')
+        return MemoryStorage()
+    if backend != 'firestore':
+        raise ValueError('Unknown STORAGE_BACKEND {!r}, use firestore or memory'.format(backend))
+    #The client's made on first use, so importing main.py stays quick
+    return FirestoreStorage(make_db=make_firestore_client, shards=int(os.getenv('CREATED_SHARDS', '0')),
+                            counter_shards=int(os.getenv('COUNTER_SHARDS', '5')))
@@ -0,0 +1,38 @@
+'''
+Turning a posted form into a message, and working out which document it belongs in
+A message's document id is an idempotency key made from its normalised name and text
+plus the time window it was posted in, so a resubmission (double click, refresh, a
+retry that landed on another instance) always goes for the same document and the
+create-if-absent write turns it away, no session and no extra read needed
+'''
+import hashlib
+import os
+import time
+
+#Identical posts within the same window of this many seconds count as one
+IDEMPOTENCY_WINDOW = int(os.getenv('IDEMPOTENCY_WINDOW', '600'))
+
+
+def normalise_name(name):
+    return u'{}'.format(name.strip().title())
+
+
+def normalise_message(message):
+    return u'{}'.format(message.strip().capitalize())
+
+
+def idempotency_key(name, message, now=None, window=None):
+    '''
+    The document id for name posting message at time now (a unix timestamp, default the current time)
+    Case and runs of whitespace don't matter, so the same post retyped slightly differently still matches
+    A hex sha256, which also spreads new documents evenly over Firestore's key range
+    '''
+    window = window or IDEMPOTENCY_WINDOW
+    if now is None:
+        now = time.time()
+    key = u'\n'.join([
+        u' '.join(name.split()).casefold(),
+        u' '.join(message.split()).casefold(),
+        str(int(now // window)),
+    ])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
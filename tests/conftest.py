@@ -0,0 +1,58 @@
+'''
+Shared fixtures, the tests run main.py on the in-memory storage backend through Flask's test client
+
+    python -m pytest -p no:warnings
+'''
+import datetime
+import os
+import sys
+
+#Before main.py is imported, it reads these when it starts
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ.setdefault('POST_RATE_LIMIT', '0')
+os.environ.setdefault('CLEAR_RATE_LIMIT', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import cache
+import jobs
+import main
+import storage as storage_module
+
+#Messages made by add_messages() are a minute apart from here
+START = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    '''
+    An empty MemoryStorage in place of main.py's, with every cache in front of it emptied
+    '''
+    fresh = storage_module.MemoryStorage()
+    monkeypatch.setattr(main, 'storage', fresh)
+    monkeypatch.setattr(main.live_feed, 'storage', fresh)
+    #Rows are cached by message id and time, which the tests reuse for different messages
+    monkeypatch.setattr(main, 'fragment_cache', cache.FragmentCache())
+    for lru in (main.page_cache, main.search_cache, main.counts_cache, jobs._running_cache):
+        lru.invalidate()
+    jobs._local_tombstones.clear()
+    return fresh
+
+
+@pytest.fixture
+def client(storage):
+    return main.app.test_client()
+
+
+def add_messages(storage, names, start=START):
+    '''
+    One message per name in names, a minute apart, returns their ids in created order
+    '''
+    doc_ids = []
+    for position, name in enumerate(names):
+        doc_id = 'msg{:03d}'.format(position)
+        storage.add_message(doc_id, {u'name': name, u'message': u'Message {}'.format(position),
+                                     u'created': start + datetime.timedelta(minutes=position)})
+        doc_ids.append(doc_id)
+    return doc_ids
@@ -0,0 +1,166 @@
+'''
+A small in-memory stand in for the parts of a google.cloud.firestore Client the storage code uses,
+so the Firestore-only paths can be tested without the emulator
+Documents are plain dicts in client.collections[collection][doc_id]
+'''
+import datetime
+import operator
+
+#What firestore.FieldPath.document_id() stands for in queries and cursors
+DOCUMENT_ID = '__name__'
+
+OPERATORS = {
+    '==': operator.eq, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'array_contains': lambda values, value: value in values,
+}
+
+
+class FakeReference(object):
+
+    def __init__(self, client, collection, doc_id):
+        self.client = client
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self):
+        return FakeSnapshot(self, self.client.collections.get(self.collection, {}).get(self.id))
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        self._data = data or {}
+
+    def get(self, field):
+        return self._data.get(field)
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeQuery(object):
+    '''
+    where(), order_by(), start_after(), limit() and stream() over one collection
+    Every order_by() has to go the same way, which is all the storage code asks for
+    '''
+
+    def __init__(self, client, collection, filters=(), orders=(), cursor=None, count=None):
+        self.client = client
+        self.collection = collection
+        self.filters = tuple(filters)
+        self.orders = tuple(orders)
+        self.cursor = cursor
+        self.count = count
+
+    def _copy(self, **changes):
+        fields = dict(filters=self.filters, orders=self.orders, cursor=self.cursor, count=self.count)
+        fields.update(changes)
+        return FakeQuery(self.client, self.collection, **fields)
+
+    def document(self, doc_id):
+        return FakeReference(self.client, self.collection, doc_id)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self.filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self.orders + ((field, direction),))
+
+    def select(self, fields):
+        return self
+
+    def start_after(self, cursor):
+        return self._copy(cursor=cursor)
+
+    def limit(self, count):
+        return self._copy(count=count)
+
+    def _key(self, doc_id, data):
+        return tuple(doc_id if field == DOCUMENT_ID else data.get(field) for field, direction in self.orders)
+
+    def _cursor_key(self):
+        if isinstance(self.cursor, FakeSnapshot):
+            return self._key(self.cursor.id, self.cursor.to_dict())
+        return tuple(self.cursor[field].id if field == DOCUMENT_ID else self.cursor[field]
+                     for field, direction in self.orders)
+
+    def stream(self):
+        self.client.reads += 1
+        documents = self.client.collections.get(self.collection, {})
+        rows = [(self._key(doc_id, data), doc_id) for doc_id, data in documents.items()
+                if all(field in data and OPERATORS[op](data[field], value) for field, op, value in self.filters)]
+        descending = bool(self.orders) and self.orders[0][1] == 'DESCENDING'
+        rows.sort(reverse=descending)
+        if self.cursor is not None:
+            after = self._cursor_key()
+            rows = [row for row in rows if (row[0] < after if descending else row[0] > after)]
+        if self.count is not None:
+            rows = rows[:self.count]
+        return iter([self.document(doc_id).get() for key, doc_id in rows])
+
+
+class FakeBatch(object):
+    '''
+    Writes applied together on commit(), or not at all if a create or an exists=True delete can't go through
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def create(self, reference, data):
+        self.writes.append(('create', reference, data))
+
+    def set(self, reference, data, merge=False):
+        self.writes.append(('merge' if merge else 'set', reference, data))
+
+    def delete(self, reference, option=None):
+        self.writes.append(('delete', reference, option))
+
+    def commit(self):
+        self.client.commits += 1
+        if self.client.errors:
+            raise self.client.errors.pop(0)
+        from google.api_core import exceptions
+        for kind, reference, value in self.writes:
+            there = reference.id in self.client.collections.get(reference.collection, {})
+            if kind == 'create' and there:
+                raise exceptions.Conflict('Document already exists: {}'.format(reference.id))
+            if kind == 'delete' and value == {'exists': True} and not there:
+                raise exceptions.NotFound('No document to update: {}'.format(reference.id))
+        for kind, reference, value in self.writes:
+            documents = self.client.collections.setdefault(reference.collection, {})
+            if kind == 'delete':
+                documents.pop(reference.id, None)
+            elif kind == 'merge':
+                documents[reference.id] = dict(documents.get(reference.id, {}), **value)
+            else:
+                documents[reference.id] = dict(value)
+
+
+class FakeClient(object):
+    '''
+    errors are raised by the next commits, one each, before they write anything
+    '''
+
+    def __init__(self):
+        self.collections = {}
+        self.errors = []
+        self.commits = 0
+        self.reads = 0
+
+    def collection(self, name):
+        return FakeQuery(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write_option(self, exists=None):
+        return {'exists': exists}
+
+    def add(self, collection, doc_id, data):
+        self.collections.setdefault(collection, {})[doc_id] = dict(data)
@@ -0,0 +1,43 @@
+'''
+Message counts: the counter changes a write or delete makes (counters.py), and /stats
+'''
+import datetime
+
+import counters
+import records
+from conftest import START, add_messages
+
+
+def test_tally_counts_total_name_and_day():
+    late = datetime.datetime(2026, 1, 1, 23, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=-2)))
+    messages = [records.Message('a', u'Ann', u'Hi', START), records.Message('b', u'Ann', u'Hi', late),
+                records.Message('c', u'Bob', u'Hi', START)]
+    assert counters.tally(messages) == {
+        counters.TOTAL: 3,
+        counters.name_counter(u'Ann'): 2,
+        counters.name_counter(u'Bob'): 1,
+        #Days are UTC, so the late one counts for the next day
+        counters.day_counter(datetime.date(2026, 1, 1)): 2,
+        counters.day_counter(datetime.date(2026, 1, 2)): 1,
+    }
+    assert counters.tally(messages[:1], -1)[counters.TOTAL] == -1
+
+
+def test_counter_ids_are_safe_document_ids():
+    assert '/' not in counters.name_counter(u'A/B') and counters.shard_id(u'total', 3) == u'total-3'
+
+
+def test_stats(client, storage):
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    add_messages(storage, [u'Ann', u'Bob', u'Ann'], start=today)
+    storage.add_message('old', {u'name': u'Ann', u'message': u'Hi', u'created': today - datetime.timedelta(days=1)})
+    stats = client.get('/stats', query_string={'name': u'Ann', 'days': '2'}).get_json()
+    assert stats['total'] == 4 and stats['name'] == u'Ann' and stats['name_count'] == 3
+    assert [day['count'] for day in stats['days']] == [1, 3]
+    assert client.get('/stats', query_string={'days': 'lots'}).get_json()['name_count'] is None
+
+
+def test_stats_follow_new_posts(client, storage):
+    assert client.get('/stats').get_json()['total'] == 0
+    client.post('/new_entry.html', data={'name': u'Ann', 'message': u'Hi', 'search_str': ''})
+    assert client.get('/stats').get_json()['total'] == 1
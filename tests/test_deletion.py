@@ -0,0 +1,62 @@
+'''
+Bulk deletion (deletion.py) against a fake Firestore client, skipped without the Firestore client library
+'''
+import pytest
+
+pytest.importorskip('google.cloud.firestore')
+
+from google.api_core import exceptions
+
+import deletion
+from fake_firestore import FakeClient
+
+
+def client_with(count):
+    client = FakeClient()
+    for number in range(count):
+        client.add(u'messages', 'm{}'.format(number), {u'name': u'Ann'})
+    return client
+
+
+def snapshots_of(client):
+    return list(client.collection(u'messages').stream())
+
+
+def count_deletes(snapshots, batch):
+    #Stands in for the counter writes that have to go with the deletes
+    counter = snapshots[0].reference.client.collection(u'counters').document(snapshots[0].id)
+    batch.set(counter, {u'deleted': len(snapshots)})
+
+
+def test_commit_deletes_retries_transient_errors():
+    client = client_with(3)
+    client.errors = [exceptions.ServiceUnavailable('busy'), exceptions.Aborted('contention')]
+    assert deletion.commit_deletes(client, snapshots_of(client), base_delay=0.001) == 3
+    assert client.commits == 3 and client.collections[u'messages'] == {}
+
+
+def test_commit_deletes_gives_up_after_max_retries():
+    client = client_with(2)
+    client.errors = [exceptions.ServiceUnavailable('busy')] * 3
+    with pytest.raises(exceptions.ServiceUnavailable):
+        deletion.commit_deletes(client, snapshots_of(client), max_retries=2, base_delay=0.001)
+    assert len(client.collections[u'messages']) == 2
+
+
+def test_commit_deletes_falls_back_to_one_document_at_a_time():
+    client = client_with(4)
+    snapshots = snapshots_of(client)
+    #Another job got to one of them first
+    del client.collections[u'messages']['m2']
+    assert deletion.commit_deletes(client, snapshots, base_delay=0.001, extra_writes=count_deletes) == 3
+    assert client.collections[u'messages'] == {}
+    #The extra writes only went with the deletes that happened
+    assert sorted(client.collections[u'counters']) == ['m0', 'm1', 'm3']
+
+
+def test_delete_query_deletes_in_chunks():
+    client = client_with(25)
+    progress = []
+    query = client.collection(u'messages').where(u'name', u'==', u'Ann')
+    assert deletion.delete_query(client, query, chunk_size=10, max_workers=2, progress=progress.append) == 25
+    assert client.collections[u'messages'] == {} and progress[-1] == 25 and len(progress) == 3
@@ -0,0 +1,35 @@
+'''
+The per-message HTML fragment cache (cache.FragmentCache) behind the listing rows
+'''
+import cache
+import main
+from conftest import add_messages
+
+
+def test_fragment_cache_stays_under_its_size():
+    fragments = cache.FragmentCache(max_bytes=350)
+    for key in range(5):
+        fragments.set(key, 'x' * 50)
+    assert fragments.bytes <= 350
+    assert len(fragments) == 2
+    assert fragments.get(0) is None and fragments.get(4) == 'x' * 50
+    #Too big to ever fit
+    fragments.set('big', 'x' * 1000)
+    assert fragments.get('big') is None
+
+
+def test_fragment_cache_renders_once():
+    fragments = cache.FragmentCache()
+    renders = []
+    for _ in range(3):
+        assert fragments.get_or_render('row', lambda: renders.append(1) or '<p>row</p>') == '<p>row</p>'
+    assert len(renders) == 1
+    assert fragments.stats()['hits'] == 2
+
+
+def test_listing_rows_are_rendered_once(client, storage):
+    add_messages(storage, [u'Ann', u'Bob'])
+    client.get('/')
+    #Another listing holding the same rows, which isn't in the page cache
+    client.get('/', query_string={'sort_direction': 'DESCENDING'})
+    assert main.fragment_cache.stats()['misses'] == 2 and main.fragment_cache.stats()['hits'] == 2
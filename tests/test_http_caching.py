@@ -0,0 +1,43 @@
+'''
+Conditional GETs with ETags, and compression, for the listing page and /api/messages (http_caching.py)
+'''
+import gzip
+
+import pytest
+
+from conftest import add_messages
+
+
+@pytest.mark.parametrize('path', ['/', '/api/messages'])
+def test_unchanged_listing_gets_a_304(client, storage, path):
+    add_messages(storage, [u'Ann', u'Bob'])
+    first = client.get(path)
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and 'no-cache' in first.headers['Cache-Control']
+    again = client.get(path, headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.get_data() == b''
+    #A new message makes it a different page
+    client.post('/new_entry.html', data={'name': u'Cat', 'message': u'Hi', 'search_str': ''})
+    changed = client.get(path, headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+
+def test_listing_etag_depends_on_the_query(client, storage):
+    add_messages(storage, [u'Ann', u'Bob'])
+    by_date = client.get('/api/messages').headers['ETag']
+    assert client.get('/api/messages', query_string={'sort_by': 'name'}).headers['ETag'] != by_date
+
+
+@pytest.mark.parametrize('path', ['/', '/api/messages'])
+def test_listing_is_gzipped_for_clients_that_take_it(client, storage, path):
+    add_messages(storage, [u'Ann'] * 10)
+    plain = client.get(path)
+    assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.headers['Vary']
+    zipped = client.get(path, headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(zipped.get_data()) == plain.get_data()
+
+
+def test_small_responses_are_left_alone(client, storage):
+    response = client.get('/stats', query_string={'days': '0'}, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200 and 'Content-Encoding' not in response.headers
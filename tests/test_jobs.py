@@ -0,0 +1,45 @@
+'''
+Background clear jobs (jobs.py): their status, and hiding what they're deleting while they run
+'''
+import datetime
+import time
+
+import jobs
+import main
+from conftest import START, add_messages
+
+
+def ids(messages):
+    return [message.id for message in messages]
+
+
+def test_clear_job_runs_in_the_background(client, storage):
+    add_messages(storage, [u'Ann', u'Bob', u'Ann'])
+    assert client.post('/', data={'search_str': u'Ann', 'delete_data': 'on'}).status_code == 200
+    job_id, = storage._jobs
+    for _ in range(500):
+        status = client.get('/jobs/' + job_id).get_json()
+        if status['status'] != u'running':
+            break
+        time.sleep(0.01)
+    assert status['status'] == u'done' and status['deleted'] == 2 and status['remaining'] == 0
+    assert [message.name for batch in storage.iter_messages() for message in batch] == [u'Bob']
+    assert client.get('/jobs/nope').status_code == 404
+
+
+def test_running_clear_job_hides_its_messages(storage):
+    add_messages(storage, [u'Ann', u'Bob', u'Ann', u'Bob', u'Ann'])
+    storage.save_job('job1', {u'kind': u'clear', u'status': u'running', u'search_str': u'Ann',
+                              u'cutoff': START + datetime.timedelta(minutes=2), u'heartbeat': jobs.utc_now()})
+    messages, _, _ = main.get_messages_page(storage, u'created', 'ASCENDING', '')
+    #Ann's last message came after the cutoff
+    assert ids(messages) == ['msg001', 'msg003', 'msg004']
+
+
+def test_stale_clear_job_hides_nothing(storage):
+    add_messages(storage, [u'Ann', u'Bob'])
+    storage.save_job('job1', {u'kind': u'clear', u'status': u'running', u'search_str': u'',
+                              u'cutoff': START + datetime.timedelta(minutes=5),
+                              u'heartbeat': jobs.utc_now() - 2 * jobs.STALE_AFTER})
+    messages, _, _ = main.get_messages_page(storage, u'created', 'ASCENDING', '')
+    assert ids(messages) == ['msg000', 'msg001']
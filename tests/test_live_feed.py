@@ -0,0 +1,62 @@
+'''
+The live feed behind /events (live_feed.py)
+'''
+import os
+import runpy
+
+import live_feed
+import main
+import storage as storage_module
+from conftest import add_messages
+
+
+def test_viewers_only_get_events_their_search_shows():
+    storage = storage_module.MemoryStorage()
+    feed = live_feed.LiveFeed(storage, max_subscribers=2)
+    everyone = feed.subscribe(u'')
+    ann = feed.subscribe(u'ann', u'prefix')
+    assert feed.subscribe(u'') is None
+    add_messages(storage, [u'Annabel', u'Bob'])
+    assert everyone.events.qsize() == 2
+    assert u'"name": "Annabel"' in ann.events.get_nowait() and ann.events.empty()
+    feed.stop()
+    assert not feed.stats()['watching']
+
+
+def test_slow_viewer_is_told_to_reload():
+    storage = storage_module.MemoryStorage()
+    feed = live_feed.LiveFeed(storage, queue_size=2)
+    subscription = feed.subscribe(u'')
+    add_messages(storage, [u'Ann', u'Bob', u'Cat'])
+    events = list(feed.stream(subscription, heartbeat=0.01))
+    assert events[-1].startswith(u'event: reload') and feed.stats()['dropped'] == 1
+    assert feed.stats()['subscribers'] == 0
+
+
+def test_events_stream_headers(client, storage):
+    response = client.get('/events', query_string={'search_str': u'Ann'})
+    try:
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream' and response.headers['Cache-Control'] == 'no-cache'
+        assert next(response.response).startswith(b'retry:')
+    finally:
+        response.close()
+
+
+def test_events_are_refused_when_full_or_switched_off(client, storage, monkeypatch):
+    monkeypatch.setattr(main.live_feed, 'max_subscribers', 0)
+    full = client.get('/events')
+    assert full.status_code == 503 and full.headers['Retry-After']
+    monkeypatch.setattr(main, 'MAX_EVENT_STREAMS', 0)
+    assert client.get('/events').status_code == 204
+    #And the page doesn't try
+    assert 'window.EventSource && false' in client.get('/', query_string={'search_str': u'x'}).get_data(as_text=True)
+
+
+def test_no_streams_by_default_on_app_engine_standard(monkeypatch):
+    #Its front end buffers responses, so a stream would only tie up a thread
+    config = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py')
+    monkeypatch.setenv('GUNICORN_WORKER_CLASS', 'gthread')
+    assert runpy.run_path(config)['event_streams_limit']() > 0
+    monkeypatch.setenv('GAE_ENV', 'standard')
+    assert runpy.run_path(config)['event_streams_limit']() == 0
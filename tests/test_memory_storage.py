@@ -0,0 +1,88 @@
+'''
+The in-memory storage backend (storage.MemoryStorage) and the message_index.MessageIndex it keeps its messages in
+'''
+import datetime
+
+import pytest
+
+import message_index
+import records
+import storage as storage_module
+from conftest import START, add_messages
+
+NAMES = [u'Ann', u'Joanna', u'Bob', u'Annabel', u'Dan', u'Ann', u'Hannah']
+
+
+def test_from_env_picks_the_backend(monkeypatch):
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    assert isinstance(storage_module.from_env(), storage_module.MemoryStorage)
+    monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+    with pytest.raises(ValueError):
+        storage_module.from_env()
+
+
+def test_delete_and_count_up_to_a_cutoff():
+    storage = storage_module.MemoryStorage()
+    add_messages(storage, [u'Ann', u'Bob', u'Ann', u'Ann'])
+    cutoff = START + datetime.timedelta(minutes=2)
+    assert storage.count_messages(u'Ann', cutoff) == 2
+    progress = []
+    assert storage.delete_messages(u'Ann', cutoff, progress.append) == 2
+    assert progress == [2]
+    assert storage.counts(u'Ann') == {'total': 2, 'name': 1, 'days': {}}
+    assert storage.delete_messages(u'') == 2 and len(storage) == 0
+
+
+def test_watchers_hear_about_new_messages():
+    storage = storage_module.MemoryStorage()
+    heard = []
+    stop = storage.watch(lambda kind, value: heard.append((kind, value.name)))
+    add_messages(storage, [u'Ann'])
+    assert not storage.create_message('msg000', {u'name': u'Bob', u'message': u'Hi', u'created': START})
+    stop()
+    add_messages(storage, [u'Cat'])
+    assert heard == [('added', u'Ann')]
+
+
+def index_of(names):
+    index = message_index.MessageIndex()
+    for position, name in enumerate(names):
+        index.add(records.Message('m{}'.format(position), name, u'Hello world {}'.format(position),
+                                  START + datetime.timedelta(minutes=position)))
+    return index
+
+
+def test_message_index_add_many_matches_adding_one_by_one():
+    one_by_one = index_of(NAMES)
+    at_once = message_index.MessageIndex()
+    at_once.add_many(one_by_one.records.values())
+    for sort_type in (u'created', u'name', u'message'):
+        for direction in ('ASCENDING', 'DESCENDING'):
+            for search_str, mode in ((u'', u'exact'), (u'Ann', u'exact'), (u'an', u'prefix'), (u'ann', u'contains')):
+                assert (at_once.page(sort_type, direction, search_str, None, 100, search_mode=mode) ==
+                        one_by_one.page(sort_type, direction, search_str, None, 100, search_mode=mode))
+
+
+def test_message_index_pages_after_a_key():
+    index = index_of(NAMES)
+    first = index.page(u'name', 'ASCENDING', u'', None, 3)
+    assert [record.name for record in first] == [u'Ann', u'Ann', u'Annabel']
+    after = index.page(u'name', 'ASCENDING', u'', (first[-1].name, first[-1].id), 3)
+    assert [record.name for record in after] == [u'Bob', u'Dan', u'Hannah']
+
+
+def test_message_index_remove_and_replace():
+    index = index_of(NAMES)
+    assert index.remove('m1').name == u'Joanna'
+    assert index.remove('m1') is None
+    assert index.count(u'Ann') == 2
+    index.add(records.Message('m0', u'Zed', u'Replaced', START))
+    assert index.count(u'Ann') == 1 and index.count(u'Zed') == 1
+    assert [record.id for record in index.page(u'created', 'ASCENDING', u'oann', None, 10, search_mode=u'contains')] == []
+    assert [record.id for record in index.search([u'replaced'])] == ['m0']
+
+
+def test_message_index_leaves_out_hidden_messages():
+    index = index_of(NAMES)
+    page = index.page(u'created', 'ASCENDING', u'', None, 3, hidden=lambda record: record.name == u'Ann')
+    assert [record.name for record in page] == [u'Joanna', u'Bob', u'Annabel']
@@ -0,0 +1,106 @@
+'''
+The on_snapshot message view (message_view.py), fed by a fake Firestore listener
+'''
+import datetime
+import threading
+import time
+import types
+
+import message_view
+from conftest import START
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, doc_id, name):
+        self.id = doc_id
+        self.update_time = None
+        self._data = {u'name': name, u'message': u'Hi', u'created': START + datetime.timedelta(minutes=len(doc_id))}
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeWatch(object):
+    is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+
+
+class FakeDb(object):
+    '''
+    Just enough of a Firestore client for MessageView, it keeps the listener's callback
+    '''
+
+    def __init__(self):
+        self.callbacks = []
+
+    def collection(self, name):
+        return self
+
+    def on_snapshot(self, callback):
+        self.callbacks.append(callback)
+        return FakeWatch()
+
+
+def change(kind, snapshot):
+    return types.SimpleNamespace(type=types.SimpleNamespace(name=kind), document=snapshot)
+
+
+def names(view):
+    return [record.name for record in view.page(u'name', 'ASCENDING', u'', None, 1000)]
+
+
+def started_view(docs):
+    changed = []
+    db = FakeDb()
+    view = message_view.MessageView(db, on_change=changed.append)
+    assert not view.usable()
+    db.callbacks[0](docs, [change('ADDED', snapshot) for snapshot in docs], None)
+    return view, db.callbacks[0], changed
+
+
+def test_first_snapshot_is_indexed_in_one_go():
+    docs = [FakeSnapshot('m{}'.format(number), u'Name {:03d}'.format(number)) for number in range(200)]
+    view, _, changed = started_view(docs)
+    assert view.usable() and len(view) == 200
+    assert names(view) == sorted(snapshot.to_dict()[u'name'] for snapshot in docs)
+    #Nothing was served from the view before, so there's nothing to invalidate
+    assert changed == []
+
+
+def test_later_changes_are_applied_and_reported():
+    ann, bob = FakeSnapshot('a', u'Ann'), FakeSnapshot('b', u'Bob')
+    view, callback, changed = started_view([ann, bob])
+    cat = FakeSnapshot('c', u'Cat')
+    callback([ann, cat], [change('REMOVED', bob), change('ADDED', cat)], None)
+    assert names(view) == [u'Ann', u'Cat'] and sorted(changed) == [u'Bob', u'Cat']
+    #A big batch is rebuilt from the snapshot, with the same result
+    many = [FakeSnapshot('n{}'.format(number), u'Dan') for number in range(message_view.REBUILD_CHANGES)]
+    del changed[:]
+    callback([cat] + many, [change('REMOVED', ann)] + [change('ADDED', snapshot) for snapshot in many], None)
+    assert names(view) == [u'Cat'] + [u'Dan'] * len(many)
+    assert sorted(set(changed)) == [u'Ann', u'Dan'] and view.snapshots == 3
+
+
+def test_usable_does_not_wait_for_the_listener():
+    view, _, _ = started_view([FakeSnapshot('a', u'Ann')])
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with view._lock:
+            held.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    held.wait(5)
+    try:
+        started = time.monotonic()
+        assert view.usable()
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        holder.join(5)
@@ -0,0 +1,52 @@
+'''
+Case insensitive exact, prefix and contains name searches (name_search.py)
+'''
+import re
+
+import pytest
+
+import name_search
+from conftest import add_messages
+
+NAMES = [u'Ann', u'Joanna', u'Bob', u'Annabel', u'Dan', u'Ann', u'Hannah']
+
+
+def listed_names(response):
+    return re.findall(r'<p id="msg-[^"]*" data-name="([^"]*)"', response.get_data(as_text=True))
+
+
+@pytest.mark.parametrize('search_str,search_mode,expected', [
+    (u'Ann', u'exact', [u'Ann', u'Ann']),
+    (u'ann', u'prefix', [u'Ann', u'Ann', u'Annabel']),
+    (u'ANN', u'contains', [u'Ann', u'Joanna', u'Annabel', u'Ann', u'Hannah']),
+    (u'', u'contains', NAMES),
+])
+def test_search_modes(client, storage, search_str, search_mode, expected):
+    add_messages(storage, NAMES)
+    response = client.get('/', query_string={'search_str': search_str, 'search_mode': search_mode})
+    #Prefix searches come back in name order, the rest by date
+    assert listed_names(response) == (sorted(expected) if search_mode == u'prefix' else expected)
+
+
+def test_short_contains_search_says_it_ran_as_prefix(client, storage):
+    add_messages(storage, NAMES)
+    query = {'search_str': u'an', 'search_mode': u'contains'}
+    page = client.get('/', query_string=query).get_data(as_text=True)
+    assert 'Contains searches need at least 3 letters' in page
+    assert '<option value="prefix" selected>' in page
+    assert client.get('/api/messages', query_string=query).get_json()['search_mode'] == u'prefix'
+    full = {'search_str': u'ann', 'search_mode': u'contains'}
+    assert 'need at least 3 letters' not in client.get('/', query_string=full).get_data(as_text=True)
+    assert client.get('/api/messages', query_string=full).get_json()['search_mode'] == u'contains'
+
+
+def test_trigrams():
+    assert name_search.trigrams(u'hannah') == [u'han', u'ann', u'nna', u'nah']
+    assert name_search.trigrams(u'an') == []
+
+
+def test_matches():
+    assert name_search.matches(u'Hannah', u'', u'exact')
+    assert name_search.matches(u'Hannah', u'NNA', u'contains')
+    assert not name_search.matches(u'Hannah', u'ann', u'prefix')
+    assert not name_search.matches(u'Hannah', u'Han', u'exact')
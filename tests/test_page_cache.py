@@ -0,0 +1,68 @@
+'''
+The LRU cache in cache.py, and how main.py keeps its page cache in step with writes
+'''
+import cache
+import main
+from conftest import START, add_messages
+
+
+def test_lru_evicts_least_recently_used():
+    lru = cache.LRUCache(max_entries=2, ttl=60)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == (1, 3)
+    assert lru.stats()['evictions'] == 1
+
+
+def test_lru_entries_expire():
+    lru = cache.LRUCache(max_entries=2, ttl=-1)
+    lru.set('a', 1)
+    assert lru.get('a', 'gone') == 'gone'
+    assert len(lru) == 0
+
+
+def test_lru_value_read_before_an_invalidate_is_not_cached():
+    lru = cache.LRUCache()
+    generation = lru.generation
+    #A write lands while the value is being read
+    lru.invalidate()
+    lru.set('page', 'stale', generation)
+    assert lru.get('page') is None
+    lru.set('page', 'fresh', lru.generation)
+    assert lru.get('page') == 'fresh'
+
+
+def test_lru_invalidate_by_key():
+    lru = cache.LRUCache()
+    for key in ('ann', 'bob', 'anna'):
+        lru.set(key, key)
+    assert lru.invalidate(lambda key: key.startswith('ann')) == 2
+    assert lru.get('bob') == 'bob'
+
+
+def test_write_during_a_listing_read_is_not_hidden_by_the_cache(client, storage, monkeypatch):
+    add_messages(storage, [u'Ann'])
+    real_read = main.get_messages_page
+
+    def read_then_write(*args, **kwargs):
+        page = real_read(*args, **kwargs)
+        #Someone posts after the page was read, but before it's been cached
+        storage.add_message('late', {u'name': u'Bob', u'message': u'Late', u'created': START})
+        main.invalidate_page_cache(u'Bob')
+        return page
+
+    monkeypatch.setattr(main, 'get_messages_page', read_then_write)
+    assert client.get('/').get_data(as_text=True).count('id="msg-') == 1
+    monkeypatch.setattr(main, 'get_messages_page', real_read)
+    assert client.get('/').get_data(as_text=True).count('id="msg-') == 2
+
+
+def test_cached_page_is_dropped_when_its_messages_change(client, storage):
+    add_messages(storage, [u'Ann'])
+    client.get('/', query_string={'search_str': u'Ann'})
+    assert len(main.page_cache) == 1
+    client.post('/new_entry.html', data={'name': u'ann', 'message': u'Again', 'search_str': u'Ann'})
+    assert u'Ann wrote: Again' in client.get('/', query_string={'search_str': u'Ann'}).get_data(as_text=True)
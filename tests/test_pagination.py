@@ -0,0 +1,107 @@
+'''
+Keyset pagination: page tokens and paging both ways
+'''
+import base64
+import json
+
+import pytest
+
+import main
+import name_search
+import records
+from conftest import START, add_messages
+
+
+def make_token(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def ids(messages):
+    return [message.id for message in messages]
+
+
+@pytest.mark.parametrize('page', ['next', 'prev'])
+@pytest.mark.parametrize('sort_type', [u'created', u'name', u'message', u'name_lower'])
+def test_page_token_round_trips(sort_type, page):
+    message = records.Message('msg001', u'Bob Smith', u'Hi', START)
+    cursor = main.decode_page_token(main.encode_page_token(message, sort_type, page), sort_type)
+    assert cursor == {'value': name_search.sort_value(message, sort_type), 'id': 'msg001', 'page': page}
+
+
+def test_page_token_for_another_sort_is_ignored():
+    message = records.Message('msg001', u'Bob', u'Hi', START)
+    assert main.decode_page_token(main.encode_page_token(message, u'name', 'next'), u'created') is None
+
+
+#Cursor values that can't be compared with the field they're for (a naive time can't be compared with aware ones)
+BAD_CURSORS = ([('created', value) for value in (5, u'abc', [1], None, {u'dt': u'2020-01-01T00:00:00'}, {u'dt': 5}, {})] +
+               [(sort_by, value) for sort_by in ('name', 'message')
+                for value in (5, [1], None, {u'dt': u'2020-01-01T00:00:00+00:00'})])
+
+
+@pytest.mark.parametrize('sort_by,value', BAD_CURSORS)
+def test_malformed_page_tokens_are_ignored(client, storage, sort_by, value):
+    add_messages(storage, [u'Ann', u'Bob', u'Cat'])
+    token = make_token({u'f': sort_by, u'v': value, u'id': u'x', u'p': u'next'})
+    assert main.decode_page_token(token, sort_by) is None
+    for path in ('/', '/api/messages'):
+        response = client.get(path, query_string={'sort_by': sort_by, 'page_token': token})
+        assert response.status_code == 200
+
+
+@pytest.mark.parametrize('token', ['', 'not base64!', make_token([1, 2]), make_token({u'f': u'created'})])
+def test_garbage_page_tokens_are_ignored(token):
+    assert main.decode_page_token(token, u'created') is None
+
+
+@pytest.mark.parametrize('sort_type', [u'created', u'name', u'message'])
+@pytest.mark.parametrize('sort_direction', ['ASCENDING', 'DESCENDING'])
+def test_paging_forwards_then_backwards(storage, sort_type, sort_direction):
+    add_messages(storage, [u'Gus', u'Ann', u'Fay', u'Bob', u'Eve', u'Cat', u'Dan'])
+    pages = []
+    token = None
+    while True:
+        messages, prev_token, next_token = main.get_messages_page(storage, sort_type, sort_direction, '', token, 3)
+        pages.append(ids(messages))
+        if next_token is None:
+            break
+        token = next_token
+    assert [len(page) for page in pages] == [3, 3, 1]
+    every = [doc_id for page in pages for doc_id in page]
+    expected = sorted(storage._index.records.values(), key=lambda message: (getattr(message, sort_type), message.id),
+                      reverse=sort_direction == 'DESCENDING')
+    assert every == ids(expected)
+
+    #And back again from the last page
+    backwards = [pages[-1]]
+    token = prev_token
+    while token is not None:
+        messages, token, _ = main.get_messages_page(storage, sort_type, sort_direction, '', token, 3)
+        backwards.insert(0, ids(messages))
+    assert backwards == pages
+
+
+@pytest.mark.parametrize('search_str,search_mode,expected', [
+    (u'Ann', u'exact', ['msg008', 'msg006', 'msg004', 'msg002', 'msg000']),
+    (u'b', u'prefix', ['msg009', 'msg007', 'msg005', 'msg003', 'msg001']),
+])
+def test_paging_a_search(storage, search_str, search_mode, expected):
+    add_messages(storage, [u'Ann', u'Bob'] * 5)
+    first, prev_token, next_token = main.get_messages_page(storage, u'created', 'DESCENDING', search_str, None, 3,
+                                                          search_mode)
+    assert prev_token is None
+    second, prev_token, next_token = main.get_messages_page(storage, u'created', 'DESCENDING', search_str, next_token,
+                                                           3, search_mode)
+    assert ids(first) + ids(second) == expected and next_token is None
+    back, _, _ = main.get_messages_page(storage, u'created', 'DESCENDING', search_str, prev_token, 3, search_mode)
+    assert back == first
+
+
+def test_listing_pages_through_the_api(client, storage):
+    add_messages(storage, [u'Ann'] * 25)
+    first = client.get('/api/messages').get_json()
+    assert len(first['messages']) == main.PAGE_SIZE and first['prev_token'] is None
+    second = client.get('/api/messages', query_string={'page_token': first['next_token']}).get_json()
+    assert len(second['messages']) == 5 and second['next_token'] is None
+    back = client.get('/api/messages', query_string={'page_token': second['prev_token']}).get_json()
+    assert back['messages'] == first['messages']
@@ -0,0 +1,68 @@
+'''
+Token bucket rate limits on posting and clearing (rate_limit.py)
+'''
+import threading
+
+import pytest
+
+import main
+import rate_limit
+from conftest import add_messages
+
+
+def test_token_bucket_refills():
+    store = rate_limit.MemoryStore()
+    rule = rate_limit.Rule(rate=1000.0, burst=2)
+    assert store.take('key', rule) == 0
+    assert store.take('key', rule) == 0
+    assert store.take('key', rule) > 0
+    threading.Event().wait(0.01)
+    assert store.take('key', rule) == 0
+
+
+def test_token_buckets_are_bounded():
+    store = rate_limit.MemoryStore(max_keys=2)
+    rule = rate_limit.parse_rule('1/60')
+    for key in ('a', 'b', 'c'):
+        store.take(key, rule)
+    assert len(store) == 2 and store.evictions == 1
+    #'a' was dropped, so it comes back with a full bucket
+    assert store.take('a', rule) == 0
+
+
+def test_parse_rule():
+    assert rate_limit.parse_rule('10/60') == rate_limit.Rule(10 / 60.0, 10)
+    assert rate_limit.parse_rule('5') == rate_limit.Rule(5.0, 5)
+    assert rate_limit.parse_rule('0') is None
+
+
+@pytest.mark.parametrize('text', ['-1/60', '10/0', 'ten'])
+def test_parse_rule_refuses_nonsense(text):
+    with pytest.raises(ValueError):
+        rate_limit.parse_rule(text)
+
+
+def test_posts_over_the_limit_get_a_429(client, storage, monkeypatch):
+    limiter = rate_limit.RateLimiter(rate_limit.MemoryStore(), {'post': rate_limit.parse_rule('2/60')})
+    monkeypatch.setattr(main, 'rate_limiter', limiter)
+    statuses = [client.post('/new_entry.html', data={'name': u'Ann', 'message': u'Hi {}'.format(number), 'search_str': ''},
+                            environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+                for number in range(3)]
+    assert statuses == [302, 302, 429]
+    assert len(storage) == 2
+    turned_away = client.post('/new_entry.html', data={'name': u'Ann', 'message': u'Again', 'search_str': ''},
+                              environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert int(turned_away.headers['Retry-After']) > 0
+    #Another address with a fresh session has its own buckets
+    other = main.app.test_client().post('/new_entry.html', data={'name': u'Bob', 'message': u'Hi', 'search_str': ''},
+                                        environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other.status_code == 302
+
+
+def test_clearing_over_the_limit_gets_a_429(client, storage, monkeypatch):
+    limiter = rate_limit.RateLimiter(rate_limit.MemoryStore(), {'clear': rate_limit.parse_rule('1/600')})
+    monkeypatch.setattr(main, 'rate_limiter', limiter)
+    add_messages(storage, [u'Ann'])
+    assert client.post('/', data={'search_str': u'Nobody', 'delete_data': 'on'}).status_code == 200
+    assert client.post('/', data={'search_str': u'Nobody', 'delete_data': 'on'}).status_code == 429
+    assert len(storage) == 1
@@ -0,0 +1,68 @@
+'''
+The sharded write path (CREATED_SHARDS): the full listing by date is read shard by shard and merged
+back together, tested against a fake Firestore client
+'''
+import datetime
+
+import pytest
+
+import storage as storage_module
+from conftest import START
+from fake_firestore import DOCUMENT_ID, FakeClient
+
+
+def sharded_storage(count, shards=3):
+    client = FakeClient()
+    storage = storage_module.FirestoreStorage(db=client, shards=shards)
+    for number in range(count):
+        doc_id = 'msg{:03d}'.format(number)
+        #Every other pair of messages shares a time, so ties are broken by id
+        created = START + datetime.timedelta(minutes=number // 2)
+        client.add(u'messages', doc_id, storage.stored_fields(doc_id, {u'name': u'Ann', u'message': u'Hi',
+                                                                        u'created': created}))
+    return client, storage
+
+
+def listing(client, direction):
+    return client.collection(u'messages').order_by(u'created', direction=direction).order_by(DOCUMENT_ID,
+                                                                                              direction=direction)
+
+
+def test_messages_are_spread_over_the_shards():
+    client, storage = sharded_storage(30)
+    shards = [data[u'shard'] for data in client.collections[u'messages'].values()]
+    assert set(shards) == {0, 1, 2}
+    assert storage.shard_of('msg007') == storage.shard_of('msg007')
+
+
+@pytest.mark.parametrize('direction', ['ASCENDING', 'DESCENDING'])
+def test_merged_shards_come_back_in_order(direction):
+    client, storage = sharded_storage(20)
+    everything = sorted(client.collections[u'messages'].items(), key=lambda item: (item[1][u'created'], item[0]),
+                        reverse=direction == 'DESCENDING')
+    expected = [doc_id for doc_id, data in everything]
+    first = list(storage._merged_shards(listing(client, direction), 7, direction))
+    assert [snapshot.id for snapshot in first] == expected[:7]
+    #Carrying on after the last one, as a cursor does
+    last = first[-1]
+    after = listing(client, direction).start_after({u'created': last.get(u'created'),
+                                                    DOCUMENT_ID: client.collection(u'messages').document(last.id)})
+    rest = list(storage._merged_shards(after, 100, direction))
+    assert [snapshot.id for snapshot in rest] == expected[7:]
+
+
+def test_sharded_pages_follow_on_from_each_other():
+    pytest.importorskip('google.cloud.firestore')
+    storage_module.load_firestore()
+    client, storage = sharded_storage(20)
+    seen = []
+    start = None
+    while True:
+        messages, last_read, more = storage.page(u'created', 'DESCENDING', '', start, 6)
+        assert not more
+        seen.extend(message.id for message in messages)
+        if len(messages) < 6:
+            break
+        start = (last_read.created, last_read.id)
+    documents = client.collections[u'messages']
+    assert seen == sorted(documents, key=lambda doc_id: (documents[doc_id][u'created'], doc_id), reverse=True)
@@ -0,0 +1,54 @@
+'''
+Coalescing identical concurrent calls with cache.SingleFlight
+'''
+import threading
+
+import pytest
+
+import cache
+
+
+def test_single_flight_shares_one_call():
+    flights = cache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'page'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do('key', slow)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flights.do('key', slow))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    #Wait for the followers to join the flight before letting it land
+    while flights.stats()['collapsed'] < 3:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == ['page'] * 4
+    assert len(calls) == 1
+    assert flights.stats() == {'in_flight': 0, 'leaders': 1, 'collapsed': 3}
+    #Once it's landed the next call starts afresh
+    release.set()
+    flights.do('key', slow)
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_errors():
+    flights = cache.SingleFlight()
+
+    def broken():
+        raise ValueError('no')
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            flights.do('key', broken)
+    assert flights.stats()['in_flight'] == 0
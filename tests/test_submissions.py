@@ -0,0 +1,51 @@
+'''
+Idempotent message creation: a post's document id comes from its content (submissions.py), so resubmissions are turned away
+'''
+import threading
+
+import main
+import submissions
+import write_behind
+from conftest import START
+
+POST = {'name': u' ann ', 'message': u'hello there', 'search_str': ''}
+
+
+def test_idempotency_key_ignores_case_and_spacing():
+    key = submissions.idempotency_key(u'Ann', u'Hello there', now=1000, window=600)
+    assert submissions.idempotency_key(u' ANN', u'hello   THERE ', now=1100, window=600) == key
+    assert submissions.idempotency_key(u'Ann', u'Hello there', now=1300, window=600) != key
+    assert submissions.idempotency_key(u'Ann', u'Hello', now=1000, window=600) != key
+
+
+def test_create_turns_away_a_duplicate(storage):
+    data = {u'name': u'Ann', u'message': u'Hi', u'created': START}
+    assert storage.create_message('m0', data)
+    assert not storage.create_message('m0', dict(data, message=u'Changed'))
+    assert storage.create_messages([('m0', data), ('m1', data)]) == ['m0']
+    assert len(storage) == 2 and storage._index.get('m0').message == u'Hi'
+
+
+def test_double_submit_is_stored_once(client, storage):
+    for _ in range(2):
+        assert client.post('/new_entry.html', data=POST).status_code == 302
+    assert len(storage) == 1
+
+
+def test_double_submit_behind_the_write_queue_is_shown_once(client, storage, monkeypatch):
+    release = threading.Event()
+
+    def slow_write(items):
+        release.wait(5)
+        return storage.create_messages(items)
+
+    queue = write_behind.WriteBehindQueue(slow_write, max_delay=0)
+    monkeypatch.setattr(main, 'write_queue', queue)
+    for _ in range(2):
+        client.post('/new_entry.html', data=POST)
+    try:
+        assert client.get('/').get_data(as_text=True).count(u'Ann wrote: Hello there') == 1
+    finally:
+        release.set()
+    assert queue.flush(5)
+    assert len(storage) == 1
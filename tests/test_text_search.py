@@ -0,0 +1,32 @@
+'''
+Searching message text (text_search.py), directly and through /search
+'''
+import records
+import text_search
+from conftest import START
+
+
+def test_terms_leave_out_stop_words_and_repeats():
+    assert text_search.tokenise(u'The cat, the CAT and a dog!') == [u'cat', u'cat', u'dog']
+    assert text_search.message_terms(u'The cat, the CAT and a dog!') == [u'cat', u'dog']
+    #Longest first, it's the one the index is asked for
+    assert text_search.query_terms(u'fox quickly the') == [u'quickly', u'fox']
+
+
+def test_matches_need_every_term():
+    assert text_search.matches(u'The quick brown fox', [u'fox', u'quick'])
+    assert not text_search.matches(u'The quick brown fox', [u'fox', u'dog'])
+
+
+def test_rank_puts_better_matches_first():
+    messages = [records.Message('a', u'Ann', u'fox and more words than the other', START),
+                records.Message('b', u'Bob', u'fox fox', START),
+                records.Message('c', u'Cat', u'a dog', START)]
+    assert [message.id for message in text_search.rank(messages, [u'fox'])] == ['b', 'a', 'c']
+
+
+def test_message_text_search(client, storage):
+    storage.add_message('a', {u'name': u'Ann', u'message': u'The quick brown fox', u'created': START})
+    storage.add_message('b', {u'name': u'Bob', u'message': u'A quick word', u'created': START})
+    page = client.get('/search', query_string={'q': u'QUICK fox'}).get_data(as_text=True)
+    assert u'The quick brown fox' in page and u'A quick word' not in page
@@ -0,0 +1,118 @@
+'''
+JSON lines export and import (transfer.py), and the retry helper its batches go through
+'''
+import datetime
+import io
+import json
+
+import pytest
+
+import retries
+import storage as storage_module
+import submissions
+import transfer
+from conftest import add_messages
+
+
+def export_lines(storage):
+    output = io.StringIO()
+    transfer.export_messages(storage, output, batch_size=3)
+    return output.getvalue().splitlines()
+
+
+def test_export_then_import_gives_the_same_messages(storage, tmp_path):
+    add_messages(storage, [u'Ann', u'Bob', u'Cat', u'Dan', u'Eve', u'Fay', u'Gus'])
+    lines = export_lines(storage)
+    assert len(lines) == 7
+    copy = storage_module.MemoryStorage()
+    transfer.import_messages(copy, lines, str(tmp_path / 'in.checkpoint'), batch_size=2, workers=2)
+    assert export_lines(copy) == lines
+    #Again, and nothing changes
+    transfer.import_messages(copy, lines, None, batch_size=2, workers=2)
+    assert len(copy) == 7
+
+
+def test_bad_rows_are_skipped(tmp_path):
+    lines = ['{"name": "ann", "message": "Hi"}', 'not json', '{"name": 5, "message": "Hi"}',
+             '{"name": "bob", "message": "Hi", "created": "yesterday"}', '', '{"name": "cat", "message": "Hi"}']
+    copy = storage_module.MemoryStorage()
+    transfer.import_messages(copy, lines, None, batch_size=10, workers=1)
+    assert sorted(message.name for batch in copy.iter_messages() for message in batch) == [u'Ann', u'Cat']
+
+
+def test_rows_without_an_id_get_their_idempotency_key():
+    doc_id, data = transfer.parse_row('{"name": " ann ", "message": "hi", "created": "2026-01-01T12:00:00"}')
+    #Naive times are UTC
+    assert data == {u'name': u'Ann', u'message': u'Hi',
+                    u'created': datetime.datetime(2026, 1, 1, 12, tzinfo=datetime.timezone.utc)}
+    assert doc_id == submissions.idempotency_key(u'Ann', u'Hi', data[u'created'].timestamp())
+    #So importing the same file twice doesn't add anything
+    copy = storage_module.MemoryStorage()
+    lines = ['{"name": "ann", "message": "hi", "created": "2026-01-01T12:00:00"}']
+    for _ in range(2):
+        transfer.import_messages(copy, lines, None, batch_size=10, workers=1)
+    assert len(copy) == 1
+
+
+class FailingStorage(storage_module.MemoryStorage):
+    '''
+    Refuses the batch holding a message from fail_on (once)
+    '''
+
+    def __init__(self, fail_on):
+        super().__init__()
+        self.fail_on = fail_on
+
+    def create_messages(self, items):
+        if any(data[u'name'] == self.fail_on for doc_id, data in items):
+            self.fail_on = None
+            raise RuntimeError('import interrupted')
+        return super().create_messages(items)
+
+
+def test_interrupted_import_resumes_from_its_checkpoint(storage, tmp_path):
+    add_messages(storage, [u'Ann', u'Bob', u'Cat', u'Dan', u'Eve', u'Fay', u'Gus'])
+    lines = export_lines(storage)
+    checkpoint = str(tmp_path / 'in.checkpoint')
+    copy = FailingStorage(fail_on=u'Eve')
+    with pytest.raises(RuntimeError):
+        transfer.import_messages(copy, lines, checkpoint, batch_size=2, workers=1)
+    #Never past the batch that failed (Eve is on line 5), whatever order the batches finished in
+    assert 0 < transfer.read_checkpoint(checkpoint) <= 4
+    assert len(copy) < 7
+    transfer.import_messages(copy, lines, checkpoint, batch_size=2, workers=1)
+    assert len(copy) == 7
+    assert transfer.read_checkpoint(checkpoint) == 0
+
+
+def test_retry_with_backoff_retries_only_what_it_is_told_to():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise IOError('busy')
+        return 'done'
+
+    assert retries.retry_with_backoff(flaky, (IOError,), max_retries=5, base_delay=0.001) == 'done'
+    assert len(attempts) == 3
+
+    attempts[:] = []
+    with pytest.raises(IOError):
+        retries.retry_with_backoff(flaky, (IOError,), max_retries=1, base_delay=0.001)
+    assert len(attempts) == 2
+
+    def broken():
+        attempts.append(1)
+        raise ValueError('no')
+
+    attempts[:] = []
+    with pytest.raises(ValueError):
+        retries.retry_with_backoff(broken, (IOError,), base_delay=0.001)
+    assert len(attempts) == 1
+
+
+def test_backoff_delay_doubles_with_jitter():
+    for attempt in range(1, 6):
+        delay = retries.backoff_delay(attempt, 1.0)
+        assert 2 ** (attempt - 2) <= delay <= 2 ** (attempt - 1)
@@ -0,0 +1,100 @@
+'''
+The write-behind queue (write_behind.py), and showing a session its own posts before they're committed
+'''
+import datetime
+import threading
+
+import main
+import records
+import write_behind
+from conftest import START, add_messages
+
+
+def pending_message(doc_id, name, minutes):
+    return (doc_id, {u'name': name, u'message': u'Pending', u'created': START + datetime.timedelta(minutes=minutes)})
+
+
+def test_pending_messages_join_the_page_they_sort_into(storage):
+    add_messages(storage, [u'Ann', u'Bob', u'Cat', u'Dan'])
+    messages, _, _ = main.get_messages_page(storage, u'created', 'ASCENDING', '', None, 2)
+    pending = [pending_message('inside', u'Eve', 0.5), pending_message('later', u'Eve', 10)]
+    merged = main.merge_pending_messages(messages, pending, u'created', 'ASCENDING', '', True, False)
+    #The later one belongs on a later page
+    assert [message.id for message in merged] == ['msg000', 'inside', 'msg001']
+
+
+def test_pending_messages_go_at_the_ends_of_the_first_and_last_pages(storage):
+    messages = [records.from_dict(*pending_message('middle', u'Ann', 5))]
+    pending = [pending_message('first', u'Ann', 0), pending_message('last', u'Ann', 10)]
+    merged = main.merge_pending_messages(messages, pending, u'created', 'DESCENDING', '', True, True)
+    assert [message.id for message in merged] == ['last', 'middle', 'first']
+
+
+def test_pending_messages_outside_the_search_are_left_out():
+    pending = [pending_message('ann', u'Ann', 0), pending_message('bob', u'Bob', 0)]
+    merged = main.merge_pending_messages([], pending, u'created', 'ASCENDING', u'Ann', True, True)
+    assert [message.id for message in merged] == ['ann']
+    merged = main.merge_pending_messages([], pending, u'created', 'ASCENDING', u'b', True, True, u'prefix')
+    assert [message.id for message in merged] == ['bob']
+
+
+def test_session_sees_its_own_post_before_it_is_committed(client, storage, monkeypatch):
+    release = threading.Event()
+
+    def slow_write(items):
+        release.wait(5)
+        return storage.create_messages(items)
+
+    queue = write_behind.WriteBehindQueue(slow_write, max_delay=0)
+    monkeypatch.setattr(main, 'write_queue', queue)
+    client.post('/new_entry.html', data={'name': u'ann', 'message': u'Hello', 'search_str': ''})
+    assert len(storage) == 0
+    assert u'Ann wrote: Hello' in client.get('/').get_data(as_text=True)
+    #Other sessions only see it once it's written
+    assert u'Ann wrote: Hello' not in main.app.test_client().get('/').get_data(as_text=True)
+    release.set()
+    assert queue.flush(5)
+    assert len(storage) == 1 and queue.stats()['committed'] == 1
+
+
+def test_write_behind_batches_and_skips_duplicates(storage):
+    batches = []
+
+    def write(items):
+        batches.append(len(items))
+        return storage.create_messages(items)
+
+    queue = write_behind.WriteBehindQueue(write, max_batch=10, max_delay=0.05)
+    for position in range(5):
+        assert queue.submit(*pending_message('m{}'.format(position), u'Ann', position))
+    assert queue.submit(*pending_message('m0', u'Ann', 0))
+    assert queue.flush(5)
+    assert sum(batches) == 5 and len(storage) == 5
+    #Already written, so the store turns it away
+    queue.submit(*pending_message('m0', u'Ann', 0))
+    assert queue.flush(5)
+    assert queue.stats()['duplicates'] == 2 and len(storage) == 5
+
+
+def test_write_behind_retries_then_gives_up():
+    attempts = []
+
+    def flaky(items):
+        attempts.append(1)
+        raise IOError('unavailable')
+
+    queue = write_behind.WriteBehindQueue(flaky, max_delay=0, max_retries=2, retryable_errors=(IOError,), base_delay=0.001)
+    queue.submit(*pending_message('m0', u'Ann', 0))
+    assert queue.flush(5)
+    assert len(attempts) == 3
+    assert queue.stats()['failed'] == 1 and queue.pending(['m0']) == []
+
+
+def test_write_behind_rejects_when_full():
+    release = threading.Event()
+    queue = write_behind.WriteBehindQueue(lambda items: release.wait(5), max_batch=1, max_delay=0, max_depth=1,
+                                          put_timeout=0.01)
+    #One being written, one waiting, and no room for a third
+    results = [queue.submit(*pending_message('m{}'.format(position), u'Ann', position)) for position in range(3)]
+    release.set()
+    assert results[-1] is False and queue.stats()['rejected'] >= 1
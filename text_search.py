@@ -0,0 +1,87 @@
+'''
+Full text search over message bodies
+Each message's text is split into lower cased word terms. Firestore keeps them in a terms
+array on the message (so its array index is the inverted index, term -> messages), the
+in-memory MessageIndex keeps a term -> ids map of its own
+A search ANDs its terms together: the index is asked for the messages with one of them,
+the rest are checked as the candidates come in, then the matches are ranked by score()
+'''
+import math
+import re
+
+#Words too common to be worth indexing or searching for
+STOP_WORDS = frozenset([
+    u'a', u'an', u'and', u'are', u'as', u'at', u'be', u'but', u'by', u'for', u'if', u'in', u'is', u'it',
+    u'of', u'on', u'or', u'so', u'that', u'the', u'this', u'to', u'was', u'we', u'with', u'you',
+])
+
+#Most terms stored per message, and most terms a search will use
+MAX_MESSAGE_TERMS = 200
+MAX_QUERY_TERMS = 8
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenise(text):
+    '''
+    Every indexable word in text, lower cased, in order and with repeats
+    '''
+    return [word for word in _word.findall((text or u'').lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+
+def _distinct(words, limit):
+    seen = []
+    for word in words:
+        if word not in seen:
+            seen.append(word)
+            if len(seen) >= limit:
+                break
+    return seen
+
+
+def message_terms(text):
+    return _distinct(tokenise(text), MAX_MESSAGE_TERMS)
+
+
+def query_terms(query):
+    '''
+    The terms of a search, longest first (the longest is usually the rarest, so it's the one the index is asked for)
+    '''
+    return sorted(_distinct(tokenise(query), MAX_QUERY_TERMS), key=len, reverse=True)
+
+
+def search_fields(text):
+    '''
+    The extra field stored on a message so it can be found by a text search
+    '''
+    return {u'terms': message_terms(text)}
+
+
+def matches(text, terms):
+    words = set(tokenise(text))
+    return all(term in words for term in terms)
+
+
+def score(text, terms):
+    '''
+    How well a message's text matches the search terms, higher is better
+    Repeats of a term count for less and less, and long messages are marked down a bit
+    '''
+    words = tokenise(text)
+    if not words:
+        return 0.0
+    total = 0.0
+    for term in terms:
+        count = words.count(term)
+        if count:
+            total += 1.0 + math.log(count)
+    return total / math.sqrt(len(words))
+
+
+def rank(messages, terms):
+    '''
+    records.Message matches best first, newest first between equals
+    '''
+    ranked = sorted(messages, key=lambda message: message.created, reverse=True)
+    ranked.sort(key=lambda message: score(message.message, terms), reverse=True)
+    return ranked
@@ -0,0 +1,230 @@
+'''
+Export the messages to JSON lines, or import them back, for backups, migrations and seeding
+
+    python transfer.py export messages.jsonl
+    python transfer.py import messages.jsonl
+
+Each line is {"id": ..., "name": ..., "message": ..., "created": ISO 8601 time}. Export pages
+through the collection with cursors, so it runs in constant memory whatever its size ('-' writes
+to stdout). Import reads the file as it goes and commits batches from a pool of threads.
+Names and messages are normalised the same way new_entry() does it, and the counters are
+kept up to date
+Imports are safe to repeat: each row keeps its id (rows without one get the id new_entry()
+would give them), and messages that already exist are left alone. An interrupted import picks
+up from its checkpoint file (the input's name plus .checkpoint) when it's run again
+
+Uses the same STORAGE_BACKEND and Firestore settings as the app
+'''
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+import jobs
+import retries
+import storage as storage_module
+import submissions
+
+#Seconds between progress reports
+REPORT_INTERVAL = 2.0
+
+
+class Progress(object):
+    '''
+    Counts rows and logs how fast they're going every REPORT_INTERVAL seconds
+    '''
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.rows = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.monotonic()
+        if now - self._reported >= REPORT_INTERVAL:
+            self._reported = now
+            logging.info('%d rows %s, %.0f rows/s', self.rows, self.verb, self.rate())
+
+    def rate(self):
+        return self.rows / max(time.monotonic() - self.started, 1e-6)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+
+def export_messages(storage, output, batch_size):
+    progress = Progress('exported')
+    for messages in storage.iter_messages(batch_size):
+        for message in messages:
+            output.write(json.dumps({'id': message.id, 'name': message.name, 'message': message.message,
+                                     'created': message.created.isoformat()}) + '\n')
+        progress.add(len(messages))
+    logging.info('Done, %d rows exported in %.1fs (%.0f rows/s)', progress.rows, progress.elapsed(), progress.rate())
+
+
+def parse_created(value):
+    if value is None:
+        return jobs.created_now()
+    if not isinstance(value, str):
+        raise ValueError('created has to be an ISO 8601 time')
+    created = datetime.datetime.fromisoformat(value)
+    if created.tzinfo is None:
+        #Naive times are taken as UTC, the way Firestore takes them
+        created = created.replace(tzinfo=datetime.timezone.utc)
+    return created
+
+
+def parse_row(line):
+    '''
+    (doc id, message data) from one line of an export, raises ValueError for a bad row
+    '''
+    row = json.loads(line)
+    if not isinstance(row, dict) or not isinstance(row.get('name'), str) or not isinstance(row.get('message'), str):
+        raise ValueError('needs a name and a message')
+    name = submissions.normalise_name(row['name'])
+    message = submissions.normalise_message(row['message'])
+    created = parse_created(row.get('created'))
+    if not isinstance(row.get('id') or u'', str):
+        raise ValueError('id has to be a string')
+    doc_id = row.get('id') or submissions.idempotency_key(name, message, created.timestamp())
+    return doc_id, {u'name': name, u'message': message, u'created': created}
+
+
+def read_batches(lines, first_line, batch_size, on_bad_row):
+    '''
+    Yield (line number after the batch, [(doc id, data)]) for the lines after first_line
+    '''
+    batch = []
+    number = 0
+    for number, line in enumerate(lines, 1):
+        if number <= first_line or not line.strip():
+            continue
+        try:
+            batch.append(parse_row(line))
+        except ValueError as error:
+            on_bad_row(number, error)
+        if len(batch) >= batch_size:
+            yield number, batch
+            batch = []
+    if batch:
+        yield number, batch
+
+
+def write_batch(storage, batch, max_retries=5, base_delay=0.5):
+    '''
+    create_messages() with backoff on transient errors, returns the number of rows that were already there
+    Retrying is safe, anything a failed attempt did write just counts as already there
+    '''
+    return retries.retry_with_backoff(lambda: len(storage.create_messages(batch)), storage.retryable_errors,
+                                      max_retries, base_delay, 'Import batch')
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint:
+        return json.load(checkpoint)['line']
+
+
+def write_checkpoint(path, line):
+    #Written to the side then moved over, so a crash never leaves half a checkpoint
+    with open(path + '.tmp', 'w') as checkpoint:
+        json.dump({'line': line}, checkpoint)
+    os.replace(path + '.tmp', path)
+
+
+def import_messages(storage, lines, checkpoint_path, batch_size, workers):
+    start_line = read_checkpoint(checkpoint_path)
+    if start_line:
+        logging.info('Resuming after line %d', start_line)
+    progress = Progress('imported')
+    counts = {'existing': 0, 'bad': 0}
+
+    def bad_row(number, error):
+        counts['bad'] += 1
+        logging.warning('Skipping line %d: %s', number, error)
+
+    #Batches can finish out of order, the checkpoint only moves past a batch once every batch before it is done
+    in_flight = {}
+    finished = {}
+    order = []
+    checkpoint_line = start_line
+
+    def collect(done):
+        nonlocal checkpoint_line
+        for future in done:
+            number, size = in_flight.pop(future)
+            counts['existing'] += future.result()
+            finished[number] = size
+        moved = False
+        while order and order[0] in finished:
+            number = order.pop(0)
+            progress.add(finished.pop(number))
+            checkpoint_line = number
+            moved = True
+        if moved and checkpoint_path:
+            write_checkpoint(checkpoint_path, checkpoint_line)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for number, batch in read_batches(lines, start_line, batch_size, bad_row):
+            #At most 2 batches a worker read ahead, which is what keeps memory flat
+            while len(in_flight) >= 2 * workers:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            in_flight[pool.submit(write_batch, storage, batch)] = (number, len(batch))
+            order.append(number)
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done)
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logging.info('Done, %d rows imported in %.1fs (%.0f rows/s), %d already there, %d bad rows skipped',
+                 progress.rows, progress.elapsed(), progress.rate(), counts['existing'], counts['bad'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import the guestbook messages as JSON lines')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    export_parser = commands.add_parser('export', help='write every message to a file')
+    export_parser.add_argument('file', help="file to write, '-' for stdout")
+    export_parser.add_argument('--batch', type=int, default=500, help='messages read per query')
+    import_parser = commands.add_parser('import', help='add the messages in a file')
+    import_parser.add_argument('file', help="file to read, '-' for stdin")
+    import_parser.add_argument('--workers', type=int, default=8, help='batches written at once')
+    import_parser.add_argument('--batch', type=int, default=0, help='messages per batch (default the most the backend takes)')
+    import_parser.add_argument('--checkpoint', help='checkpoint file (default FILE.checkpoint, none for stdin)')
+    import_parser.add_argument('--restart', action='store_true', help='ignore any checkpoint and start from the top')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    storage = storage_module.from_env()
+
+    if args.command == 'export':
+        if args.file == '-':
+            export_messages(storage, sys.stdout, args.batch)
+        else:
+            with open(args.file, 'w', encoding='utf-8') as output:
+                export_messages(storage, output, args.batch)
+        return
+
+    batch_size = min(args.batch or storage.max_batch_size, storage.max_batch_size)
+    checkpoint_path = args.checkpoint or (args.file + '.checkpoint' if args.file != '-' else None)
+    if args.restart and checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if args.file == '-':
+        import_messages(storage, sys.stdin, checkpoint_path, batch_size, args.workers)
+    else:
+        with open(args.file, encoding='utf-8') as lines:
+            import_messages(storage, lines, checkpoint_path, batch_size, args.workers)
+
+
+if __name__ == '__main__':
+    main()
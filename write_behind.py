@@ -0,0 +1,154 @@
+'''
+Write-behind queue for new messages
+new_entry() drops submissions in here and a worker thread commits them in batched writes
+once enough have built up or the oldest has waited long enough, so a burst of posts costs
+one Firestore round trip per batch instead of one per post
+'''
+import logging
+import queue
+import threading
+import time
+
+import retries
+
+
+class WriteBehindQueue(object):
+    '''
+    A bounded queue of (document id, data) waiting to be written by write_batch(list of pairs)
+    write_batch may return the ids it didn't write because they already existed (duplicates)
+    submit() gives up after put_timeout when the queue is full, which is the caller's cue
+    to write synchronously instead (that's the backpressure)
+    Until a submission is committed it can be read back with pending()
+    '''
+
+    def __init__(self, write_batch, max_batch=100, max_delay=0.5, max_depth=5000,
+                 put_timeout=0.2, max_retries=5, retryable_errors=(), on_commit=None, base_delay=0.5):
+        self.write_batch = write_batch
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        #First backoff between retries, see retries.py
+        self.base_delay = base_delay
+        #Exceptions from write_batch that are worth another go
+        self.retryable_errors = retryable_errors
+        #Called with the list of committed data dicts after every batch
+        self.on_commit = on_commit
+        self.batches = 0
+        self.committed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.duplicates = 0
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._worker.start()
+
+    def submit(self, doc_id, data):
+        '''
+        Queue data to be written as document doc_id
+        Returns False if the queue stayed full (or we're shutting down) and nothing was queued
+        '''
+        if self._closed:
+            return False
+        with self._pending_lock:
+            if doc_id in self._pending:
+                #Same id as a submission that's still queued, it's a resubmission so there's nothing to do
+                self.duplicates += 1
+                return True
+            self._pending[doc_id] = data
+        try:
+            self._queue.put((doc_id, data), timeout=self.put_timeout)
+        except queue.Full:
+            with self._pending_lock:
+                self._pending.pop(doc_id, None)
+            self.rejected += 1
+            return False
+        return True
+
+    def pending(self, doc_ids):
+        '''
+        The (doc_id, data) pairs out of doc_ids that haven't been committed yet
+        '''
+        with self._pending_lock:
+            return [(doc_id, self._pending[doc_id]) for doc_id in doc_ids if doc_id in self._pending]
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        '''
+        Wait until everything queued so far has been committed (or given up on)
+        '''
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=30.0):
+        '''
+        Stop taking submissions and flush what's queued, called on shutdown
+        '''
+        self._closed = True
+        self.flush(timeout)
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'batches': self.batches,
+            'committed': self.committed,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+        }
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            #The batch goes when it's full or the first item has waited max_delay
+            deadline = time.monotonic() + self.max_delay
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._commit(items)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _commit(self, items):
+        try:
+            skipped = set(retries.retry_with_backoff(lambda: self.write_batch(items), self.retryable_errors,
+                                                     self.max_retries, self.base_delay, 'Write-behind batch') or ())
+        except Exception as error:
+            self._give_up(items, error)
+            return
+
+        self.batches += 1
+        self.committed += len(items) - len(skipped)
+        self.duplicates += len(skipped)
+        with self._pending_lock:
+            for doc_id, data in items:
+                self._pending.pop(doc_id, None)
+        if self.on_commit is not None:
+            self.on_commit([data for doc_id, data in items if doc_id not in skipped])
+
+    def _give_up(self, items, error):
+        #Log the lost messages in full so they can be put back by hand
+        self.failed += len(items)
+        logging.error('Write-behind batch of %d dropped after %s: %r', len(items), error, items)
+        with self._pending_lock:
+            for doc_id, data in items:
+                self._pending.pop(doc_id, None)